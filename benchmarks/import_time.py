@@ -0,0 +1,107 @@
+"""
+Benchmark of the time xsiftx takes to start.
+
+Startup is paid once per course per sifter, by the command line and
+by every sifter importing xsiftx.tools, so this times importing each
+entry module in a fresh interpreter and reports the best and median
+of several runs, along with the wall time of the whole process.
+
+``command_line startup`` times what the command line does before it
+starts sifting, importing it, parsing its arguments and finding the
+sifter, rather than the import alone.
+
+Usage: python benchmarks/import_time.py [-n RUNS] [--sifter SIFTER]
+       [module ...]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+STARTUP = 'command_line startup'
+DEFAULT_MODULES = [
+    'xsiftx.tools',
+    'xsiftx.util',
+    'xsiftx.command_line',
+    STARTUP,
+    'xsiftx.config',
+    'xsiftx.lti',
+]
+
+TIMER = (
+    'import time; start = time.time(); import {0}; '
+    'print(time.time() - start)'
+)
+STARTUP_TIMER = (
+    'import time; start = time.time(); '
+    'from xsiftx.command_line import get_parser; '
+    'from xsiftx.util import find_sifter; '
+    'get_parser().parse_args([{0!r}]); find_sifter({0!r}); '
+    'print(time.time() - start)'
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(module, runs, sifter):
+    """
+    Returns lists of the import and process wall times of the module,
+    or of the command line startup finding the sifter, over the runs,
+    in seconds.
+    """
+    if module == STARTUP:
+        timer = STARTUP_TIMER.format(sifter)
+    else:
+        timer = TIMER.format(module)
+    imports = []
+    walls = []
+    for _ in range(runs):
+        start = time.time()
+        output = subprocess.check_output(
+            [sys.executable, '-c', timer], cwd=ROOT
+        )
+        walls.append(time.time() - start)
+        imports.append(float(output.split()[-1]))
+    return imports, walls
+
+
+def summarize(times):
+    """
+    Format the best and median of the times in milliseconds
+    """
+    times = sorted(times)
+    return '{0:8.1f} {1:8.1f}'.format(
+        times[0] * 1000, times[len(times) // 2] * 1000
+    )
+
+
+def main():
+    """
+    Time the modules and print a table of the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='Fresh interpreters to time each module in')
+    parser.add_argument('--sifter', type=str, default='test_sifters',
+                        help='Sifter the command line startup finds')
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                        help='Modules to time, or "{0}"'.format(STARTUP))
+    args = parser.parse_args()
+
+    print('{0:24} {1:>17} {2:>17}'.format(
+        'module', 'import best/med', 'process best/med'
+    ))
+    for module in args.modules:
+        try:
+            imports, walls = time_import(module, args.runs, args.sifter)
+        except subprocess.CalledProcessError:
+            print('{0:24} failed to import'.format(module))
+            continue
+        print('{0:24} {1} {2}'.format(
+            module, summarize(imports), summarize(walls)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Load test of the LTI web tier.
+
+Simulates concurrent course staff sessions. Each one launches the
+tool with an OAuth signed LTI launch, then repeatedly runs a sifter,
+polls the task status and clears completed tasks like the page's
+script does, and the latency percentiles of each endpoint and the
+overall throughput are reported.
+
+By default the app is driven in this process through the Flask test
+client with celery stubbed out, so only the web tier is measured.
+Use ``--celery eager`` to run the sifters inline instead, or
+``--url`` to load a running server, e.g. a single gunicorn worker:
+
+gunicorn xsiftx.web:app -w 1 -b 127.0.0.1:5000
+python benchmarks/lti_load.py --url http://127.0.0.1:5000 -s 20
+
+Consumers and their secrets are read from the xsiftx configuration.
+"""
+import argparse
+import cookielib
+import os
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+
+import oauth.oauth as oauth
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = [
+    ('launch', 'POST', '/'),
+    ('run', 'POST', '/api/v0.1/run'),
+    ('update_task_status', 'PUT', '/api/v0.1/update_task_status'),
+    ('clear_complete_tasks', 'DELETE', '/api/v0.1/clear_complete_tasks'),
+]
+PERCENTILES = [50, 90, 99]
+
+
+class AppClient(object):
+    """
+    Session against the app in this process
+    """
+    # pylint: disable=R0903
+    base_url = 'http://localhost'
+
+    def __init__(self, app):
+        """
+        Start with an empty cookie jar
+        """
+        self.client = app.test_client()
+
+    def request(self, method, path, data):
+        """
+        Returns the status code of the request
+        """
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class HttpClient(object):
+    """
+    Session against a running server
+    """
+    # pylint: disable=R0903
+
+    def __init__(self, base_url):
+        """
+        Start with an empty cookie jar
+        """
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar())
+        )
+
+    def request(self, method, path, data):
+        """
+        Returns the status code of the request
+        """
+        http_request = urllib2.Request(
+            self.base_url + path, urllib.urlencode(data or {})
+        )
+        http_request.get_method = lambda: method
+        try:
+            response = self.opener.open(http_request)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as err:
+            return err.code
+
+
+class StubResult(object):
+    """
+    Celery result of a sifter run that finished at once
+    """
+    # pylint: disable=R0903
+    state = status = 'SUCCESS'
+
+    def __init__(self, task_id=None, sifter='stub'):
+        """
+        Stand in for the result of the task
+        """
+        self.task_id = task_id or uuid.uuid4().hex
+        self.result = {
+            'success': True,
+            'limit_exceeded': False,
+            'sifter': sifter,
+            'error': u'',
+        }
+
+
+def signed_launch(consumer_key, secret, url):
+    """
+    Returns the form data of an LTI launch by course staff, signed
+    with HMAC-SHA1 for the consumer.
+    """
+    consumer = oauth.OAuthConsumer(consumer_key, secret)
+    launch = oauth.OAuthRequest.from_consumer_and_token(
+        consumer,
+        http_method='POST',
+        http_url=url,
+        parameters={
+            'lti_message_type': 'basic-lti-launch-request',
+            'lti_version': 'LTI-1p0',
+            'resource_link_id': 'xsiftx-load',
+            'context_id': 'LoadX/Load101/{0}'.format(uuid.uuid4().hex[:8]),
+            'user_id': uuid.uuid4().hex,
+            'roles': 'Instructor',
+        }
+    )
+    launch.sign_request(oauth.OAuthSignatureMethod_HMAC_SHA1(), consumer,
+                        None)
+    return launch.parameters
+
+
+def run_session(make_client, args, secret, timings):
+    """
+    Drive one staff session, appending (endpoint, seconds, status)
+    to the timings.
+    """
+    client = make_client()
+    data = {
+        'run': {'sifter': args.sifter, 'extra_args': args.extra_args},
+        'update_task_status': {},
+        'clear_complete_tasks': {},
+    }
+    launch, polling = ENDPOINTS[0], ENDPOINTS[1:]
+    data['launch'] = signed_launch(args.consumer, secret,
+                                   client.base_url + launch[2])
+    for name, method, path in [launch] + polling * args.iterations:
+        start = time.time()
+        status = client.request(method, path, data[name])
+        timings.append((name, time.time() - start, status))
+
+
+def percentile(values, percent):
+    """
+    Returns the value at the percentile of the sorted values
+    """
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def report(timings, elapsed):
+    """
+    Print latency percentiles per endpoint and overall throughput
+    """
+    print('{0:22} {1:>6} {2:>6} {3}'.format(
+        'endpoint', 'count', 'errors',
+        ' '.join('{0:>8}'.format(label) for label in
+                 ['p{0}ms'.format(p) for p in PERCENTILES] + ['maxms'])
+    ))
+    for name, _, _ in ENDPOINTS:
+        latencies = sorted(
+            latency for endpoint, latency, _ in timings if endpoint == name
+        )
+        if not latencies:
+            continue
+        errors = len([
+            status for endpoint, _, status in timings
+            if endpoint == name and status >= 400
+        ])
+        print('{0:22} {1:6d} {2:6d} {3} {4:8.1f}'.format(
+            name, len(latencies), errors,
+            ' '.join('{0:8.1f}'.format(percentile(latencies, p) * 1000)
+                     for p in PERCENTILES),
+            latencies[-1] * 1000
+        ))
+    print('{0} requests in {1:.2f}s, {2:.1f} requests/s'.format(
+        len(timings), elapsed, len(timings) / elapsed
+    ))
+
+
+def main():
+    """
+    Run the sessions and report the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-s', '--sessions', type=int, default=10,
+                        help='Concurrent staff sessions')
+    parser.add_argument('-i', '--iterations', type=int, default=20,
+                        help='Runs made by each session after launching')
+    parser.add_argument('--url', type=str,
+                        help='Server to load instead of the app in process')
+    parser.add_argument('--celery', choices=['stub', 'eager'],
+                        default='stub',
+                        help='Whether runs are stubbed or run inline when '
+                        'driving the app in process')
+    parser.add_argument('--consumer', type=str,
+                        help='Consumer key to launch as, by default the '
+                        'first configured consumer with a secret')
+    parser.add_argument('--secret', type=str,
+                        help='Consumer secret, by default from the '
+                        'configuration')
+    parser.add_argument('--sifter', type=str, default='test_sifters',
+                        help='Sifter to run')
+    parser.add_argument('--extra-args', type=str, default='',
+                        help='Extra arguments to run the sifter with')
+    args = parser.parse_args()
+
+    # Load the checkout's xsiftx rather than need it installed
+    sys.path.insert(0, ROOT)
+    secret = args.secret
+    if not secret:
+        from xsiftx.config import settings
+
+        consumers = [
+            consumer for consumer in settings.get('consumers', None) or []
+            if consumer.get('secret', None) and
+            args.consumer in (None, consumer['key'])
+        ]
+        if not consumers:
+            parser.error('No consumer with a secret is configured')
+        args.consumer = consumers[0]['key']
+        secret = consumers[0]['secret']
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+    else:
+        import xsiftx.lti
+        import xsiftx.web
+
+        if args.celery == 'stub':
+            xsiftx.lti.web_run_sifter.apply_async = (
+                lambda *_, **kwargs: StubResult(kwargs.get('task_id', None))
+            )
+            xsiftx.lti.celery.AsyncResult = StubResult
+        else:
+            xsiftx.lti.celery.conf.CELERY_ALWAYS_EAGER = True
+        make_client = lambda: AppClient(xsiftx.web.app)
+
+    timings = []
+    threads = [
+        threading.Thread(target=run_session,
+                         args=(make_client, args, secret, timings))
+        for _ in range(args.sessions)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(timings, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
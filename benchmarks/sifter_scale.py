@@ -0,0 +1,529 @@
+"""
+Benchmark of how sifters scale with course size.
+
+Loads synthetic StudentModule rows for a course into SQLite, with a
+configurable number of learners, problems and size of each learner's
+JSON answer state, and runs the core of the ``content_statistics``
+(``CourseAxis``) and ``xqanalyze`` (``XProblemAnalyzer``) sifters
+against it, reporting the time taken, queries made and peak memory.
+
+The sifters are loaded with a thin stand-in for the parts of
+edx-platform they use: StudentModule is a queryset translating the
+filters they use into SQL over the synthetic tables, and course keys
+are plain strings. No LMS or production database is needed, but
+query times are SQLite's, so compare runs with each other rather
+than with production.
+
+Each sifter runs in a fresh interpreter, so peak memory is its own.
+Every combination of the sizes given is run, e.g.:
+
+python benchmarks/sifter_scale.py -l 100 1000 10000 -p 20 -s 200 2000
+"""
+import argparse
+import datetime
+import imp
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIFTER_DIR = os.path.join(ROOT, 'xsiftx', 'sifters')
+SIFTERS = ['content_statistics', 'xqanalyze']
+
+COURSE_ID = 'BenchX/Scale101/2015_Spring'
+# Problems per sequential in the synthetic course
+SEQUENTIAL_SIZE = 10
+# Questions answered in each problem
+QUESTIONS = 2
+# Learners given the course staff role
+STAFF = 5
+
+SCHEMA = """
+CREATE TABLE auth_user (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    is_staff INTEGER NOT NULL
+);
+CREATE TABLE course_staff (
+    user_id INTEGER NOT NULL
+);
+CREATE TABLE courseware_studentmodule (
+    id INTEGER PRIMARY KEY,
+    module_type TEXT NOT NULL,
+    module_state_key TEXT NOT NULL,
+    student_id INTEGER NOT NULL,
+    course_id TEXT NOT NULL,
+    state TEXT,
+    grade REAL,
+    created TEXT NOT NULL,
+    UNIQUE (student_id, module_state_key, course_id)
+);
+CREATE INDEX courseware_studentmodule_module_state_key
+    ON courseware_studentmodule (module_state_key);
+CREATE INDEX courseware_studentmodule_course_id
+    ON courseware_studentmodule (course_id);
+"""
+
+# Query fields of StudentModule the sifters use, and their columns
+COLUMNS = {
+    'pk': 'sm.id',
+    'module_state_key': 'sm.module_state_key',
+    'course_id': 'sm.course_id',
+    'state': 'sm.state',
+    'grade': 'sm.grade',
+    'created': 'sm.created',
+    'student': 'sm.student_id',
+    'student__username': 'u.username',
+    'student__is_staff': 'u.is_staff',
+}
+
+
+def problem_location(number):
+    """
+    Returns the location of a problem of the synthetic course
+    """
+    return 'i4x://{0}/problem/p{1:04d}'.format(
+        COURSE_ID.rsplit('/', 1)[0], number
+    )
+
+
+def course_structure(problems):
+    """
+    Returns the rows of the module list of a synthetic course with
+    the problems, split into sequentials of a chapter.
+    """
+    org_course = COURSE_ID.rsplit('/', 1)[0]
+    modules = [['i4x://{0}/course/course'.format(org_course), 'course',
+                'Scale', 'course'],
+               ['i4x://{0}/chapter/c1'.format(org_course), 'chapter',
+                'Chapter 1', 'c1']]
+    for number in range(problems):
+        if number % SEQUENTIAL_SIZE == 0:
+            name = 's{0}'.format(number // SEQUENTIAL_SIZE)
+            modules.append(['i4x://{0}/sequential/{1}'.format(
+                org_course, name
+            ), 'sequential', 'Sequence {0}'.format(name), name])
+        modules.append([problem_location(number), 'problem',
+                        'Problem {0}'.format(number),
+                        'p{0:04d}'.format(number)])
+    return modules
+
+
+def answer_state(rand, number, state_size):
+    """
+    Returns the JSON state of a capa problem answered by a learner,
+    padded to about state_size bytes.
+    """
+    question_ids = [
+        '{0}_{1}_1'.format(
+            problem_location(number).replace('://', '-').replace('/', '-'),
+            question + 2
+        )
+        for question in range(QUESTIONS)
+    ]
+    state = {
+        'attempts': rand.randint(1, 3),
+        'done': True,
+        'seed': rand.randint(1, 1000),
+        'correct_map': dict(
+            (question_id, {'correctness': rand.choice(['correct',
+                                                       'incorrect']),
+                           'npoints': None, 'msg': '', 'hint': '',
+                           'hintmode': None, 'queuestate': None})
+            for question_id in question_ids
+        ),
+        'student_answers': dict(
+            (question_id, 'choice_{0}'.format(rand.randint(0, 3)))
+            for question_id in question_ids
+        ),
+    }
+    padding = state_size - len(json.dumps(state))
+    if padding > 0:
+        state['student_answers'][question_ids[0]] += ' ' * padding
+    return json.dumps(state)
+
+
+def generate(db_path, learners, problems, state_size, coverage, empty,
+             seed=0):
+    """
+    Load a synthetic course of the size into a new SQLite database
+    and return the number of StudentModule rows.
+    """
+    # pylint: disable=R0913
+    rand = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executemany(
+            'INSERT INTO auth_user (id, username, is_staff) VALUES (?, ?, ?)',
+            ((user, 'learner{0}'.format(user), 0)
+             for user in range(1, learners + 1))
+        )
+        conn.executemany(
+            'INSERT INTO course_staff (user_id) VALUES (?)',
+            ((user,) for user in range(1, min(STAFF, learners) + 1))
+        )
+        created = datetime.datetime(2015, 2, 1)
+
+        def rows():
+            """
+            The StudentModule rows of learners who opened each problem
+            """
+            for user, number in itertools.product(range(1, learners + 1),
+                                                  range(problems)):
+                if rand.random() >= coverage:
+                    continue
+                state = '{}'
+                grade = None
+                if rand.random() >= empty:
+                    state = answer_state(rand, number, state_size)
+                    grade = float(rand.randint(0, QUESTIONS))
+                yield ('problem', problem_location(number), user, COURSE_ID,
+                       state, grade, str(created + datetime.timedelta(
+                           minutes=user + number)))
+        conn.executemany(
+            'INSERT INTO courseware_studentmodule (module_type, '
+            'module_state_key, student_id, course_id, state, grade, created) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows()
+        )
+        conn.execute('CREATE TABLE structure (location TEXT, category TEXT, '
+                     'display_name TEXT, name TEXT)')
+        conn.executemany('INSERT INTO structure VALUES (?, ?, ?, ?)',
+                         course_structure(problems))
+        conn.commit()
+        return conn.execute(
+            'SELECT COUNT(*) FROM courseware_studentmodule'
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+
+class Database(object):
+    """
+    The synthetic course's database, counting the queries made
+    """
+
+    def __init__(self, db_path):
+        """
+        Open the database
+        """
+        self.conn = sqlite3.connect(db_path)
+        self.queries = 0
+
+    def query(self, sql, params=()):
+        """
+        Returns the rows of the query
+        """
+        self.queries += 1
+        return self.conn.execute(sql, params).fetchall()
+
+
+class Row(object):
+    """
+    A StudentModule object with the fields of its row
+    """
+    # pylint: disable=R0903
+    FIELDS = ['id', 'module_state_key', 'student_id', 'course_id', 'state',
+              'grade', 'created']
+
+    def __init__(self, values):
+        """
+        Hold the row's fields
+        """
+        self.__dict__.update(zip(self.FIELDS, values))
+        self.pk = self.id  # pylint: disable=C0103
+
+
+class QuerySet(object):
+    """
+    Just enough of a Django queryset of StudentModule for the sifters,
+    run as SQL over the synthetic tables.
+    """
+
+    def __init__(self, database, where=(), params=(), fields=None,
+                 ordered=False):
+        """
+        Hold the conditions of the query
+        """
+        # pylint: disable=R0913
+        self.database = database
+        self.where = where
+        self.params = params
+        self.fields = fields
+        self.ordered = ordered
+
+    def _clone(self, **changes):
+        """
+        Returns a copy of the queryset with the changes
+        """
+        values = dict(where=self.where, params=self.params,
+                      fields=self.fields, ordered=self.ordered)
+        values.update(changes)
+        return QuerySet(self.database, **values)
+
+    @staticmethod
+    def _conditions(lookups):
+        """
+        Returns the SQL and parameters of Django style lookups
+        """
+        conditions = []
+        params = []
+        for lookup, value in sorted(lookups.items()):
+            if lookup.endswith('__in'):
+                values = list(value)
+                conditions.append('{0} IN ({1})'.format(
+                    COLUMNS[lookup[:-4]], ', '.join('?' * len(values))
+                ))
+                params.extend(values)
+            elif lookup.endswith('__gt'):
+                conditions.append('{0} > ?'.format(COLUMNS[lookup[:-4]]))
+                params.append(value)
+            else:
+                conditions.append('{0} = ?'.format(COLUMNS[lookup]))
+                params.append(value)
+        return ' AND '.join(conditions), tuple(params)
+
+    def filter(self, **lookups):
+        """
+        Rows matching all the lookups
+        """
+        condition, params = self._conditions(lookups)
+        return self._clone(where=self.where + (condition,),
+                           params=self.params + params)
+
+    def exclude(self, **lookups):
+        """
+        Rows not matching all the lookups
+        """
+        condition, params = self._conditions(lookups)
+        return self._clone(where=self.where + ('NOT ({0})'.format(condition),),
+                           params=self.params + params)
+
+    def order_by(self, field):
+        """
+        Order by the field, only pk is supported
+        """
+        assert field == 'pk'
+        return self._clone(ordered=True)
+
+    def values_list(self, *fields):
+        """
+        Fetch tuples of the fields instead of objects
+        """
+        return self._clone(fields=fields)
+
+    def _select(self, columns):
+        """
+        Returns the SQL selecting the columns of the matching rows
+        """
+        sql = ('SELECT {0} FROM courseware_studentmodule sm '
+               'JOIN auth_user u ON u.id = sm.student_id'.format(columns))
+        if self.where:
+            sql += ' WHERE ' + ' AND '.join(self.where)
+        if self.ordered:
+            sql += ' ORDER BY sm.id'
+        return sql
+
+    def count(self):
+        """
+        Returns the number of matching rows
+        """
+        return self.database.query(self._select('COUNT(*)'),
+                                   self.params)[0][0]
+
+    def __getitem__(self, index):
+        """
+        Fetch a slice of the rows
+        """
+        if self.fields:
+            columns = ', '.join(COLUMNS[field] for field in self.fields)
+        else:
+            columns = ', '.join('sm.{0}'.format(field) for field in Row.FIELDS)
+        sql = self._select(columns)
+        params = self.params
+        if index.stop is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params += (index.stop - (index.start or 0), index.start or 0)
+        rows = self.database.query(sql, params)
+        return rows if self.fields else [Row(row) for row in rows]
+
+    def __iter__(self):
+        """
+        Fetch all the rows
+        """
+        return iter(self[:])
+
+
+def install_stand_ins(database):
+    """
+    Register the parts of edx-platform the sifters import, backed by
+    the database, and return the course structure they're given.
+    """
+    import xsiftx.tools
+
+    student_module = type('StudentModule', (object,), {
+        'objects': QuerySet(database),
+    })
+    staff_role = type('CourseStaffRole', (object,), {
+        '__init__': lambda self, course: None,
+        'users_with_role': lambda self: [
+            row[0] for row in
+            database.query('SELECT user_id FROM course_staff')
+        ],
+    })
+    identity = staticmethod(lambda value: value)
+    attributes = {
+        'courseware': {},
+        'courseware.models': {'StudentModule': student_module},
+        # Sifters pick these up from courseware.views with import *
+        'courseware.views': {'StudentModule': student_module,
+                             'datetime': datetime.datetime},
+        'opaque_keys': {},
+        'opaque_keys.edx': {},
+        'opaque_keys.edx.keys': {
+            'UsageKey': type('UsageKey', (object,), {
+                'from_string': identity,
+            }),
+        },
+        'opaque_keys.edx.locator': {
+            'CourseLocator': lambda *parts: '/'.join(parts),
+        },
+        'opaque_keys.edx.locations': {
+            'SlashSeparatedCourseKey': type('SlashSeparatedCourseKey',
+                                            (object,), {
+                'from_deprecated_string': identity,
+            }),
+        },
+        'student': {},
+        'student.roles': {'CourseStaffRole': staff_role},
+    }
+    for name, values in attributes.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(values)
+        sys.modules[name] = module
+
+    structure = database.query('SELECT * FROM structure')
+    xsiftx.tools.enter_lms = lambda venv, edx_platform: None
+    xsiftx.tools.get_course_structure = lambda course_key: [
+        xsiftx.tools.CourseModule(*row) for row in structure
+    ]
+
+
+def load_sifter(name):
+    """
+    Returns the sifter loaded as a module, without running it
+    """
+    sys.argv = [name, 'venv', 'edx-platform']
+    return imp.load_source(name, os.path.join(SIFTER_DIR, name))
+
+
+def run_sifter(name, database, output_dir):
+    """
+    Run the core of the sifter over the synthetic course
+    """
+    sifter = load_sifter(name)
+    if name == 'content_statistics':
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as sys.stdout:
+            try:
+                sifter.CourseAxis(COURSE_ID).dump_csv('stats.csv')
+            finally:
+                sys.stdout = stdout
+    else:
+        sifter.XProblemAnalyzer(COURSE_ID, os.path.join(output_dir, 'xqa'))
+
+
+def measure(name, db_path):
+    """
+    Returns the seconds, queries and peak memory in MB of running the
+    sifter over the database, in this process.
+    """
+    database = Database(db_path)
+    install_stand_ins(database)
+    output_dir = tempfile.mkdtemp(prefix='xsiftx-bench')
+    queries = database.queries
+    start = time.time()
+    try:
+        run_sifter(name, database, output_dir)
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        'seconds': seconds,
+        'queries': database.queries - queries,
+        # Linux reports the peak resident set in KB
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def main():
+    """
+    Run each sifter over every size of course and print the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-l', '--learners', type=int, nargs='+',
+                        default=[100, 1000], help='Learners in the course')
+    parser.add_argument('-p', '--problems', type=int, nargs='+',
+                        default=[20], help='Problems in the course')
+    parser.add_argument('-s', '--state-size', type=int, nargs='+',
+                        default=[300], help='Bytes of answer state JSON')
+    parser.add_argument('--coverage', type=float, default=0.8,
+                        help='Fraction of learners who opened each problem')
+    parser.add_argument('--empty', type=float, default=0.1,
+                        help='Fraction of opened problems left unanswered')
+    parser.add_argument('--sifter', choices=SIFTERS, action='append',
+                        help='Sifter to run, by default all of them')
+    parser.add_argument('--measure', nargs=2, metavar=('SIFTER', 'DB'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(*args.measure)))
+        return
+
+    print('{0:20} {1:>8} {2:>8} {3:>6} {4:>9} {5:>9} {6:>8} {7:>8}'.format(
+        'sifter', 'learners', 'problems', 'state', 'rows', 'seconds',
+        'queries', 'peak MB'
+    ))
+    # Measure this checkout of xsiftx rather than an installed one
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + filter(None, [env.get('PYTHONPATH', None)])
+    )
+    temp_dir = tempfile.mkdtemp(prefix='xsiftx-bench')
+    try:
+        for learners, problems, state_size in itertools.product(
+                args.learners, args.problems, args.state_size
+        ):
+            db_path = os.path.join(temp_dir, '{0}-{1}-{2}.db'.format(
+                learners, problems, state_size
+            ))
+            rows = generate(db_path, learners, problems, state_size,
+                            args.coverage, args.empty)
+            for name in args.sifter or SIFTERS:
+                output = subprocess.check_output([
+                    sys.executable, os.path.abspath(__file__),
+                    '--measure', name, db_path
+                ], cwd=ROOT, env=env)
+                result = json.loads(output.splitlines()[-1])
+                print('{0:20} {1:8d} {2:8d} {3:6d} {4:9d} {5:9.2f} {6:8d} '
+                      '{7:8.1f}'.format(name, learners, problems, state_size,
+                                        rows, result['seconds'],
+                                        result['queries'],
+                                        result['peak_mb']))
+            os.remove(db_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Probe that prints the activity watermark of every course, the latest
+StudentModule modification time, as tab separated course ID and ISO
+8601 time lines.
+
+It is run by xsiftx inside the edx-platform environment with:
+python -m xsiftx.activity edx_venv_path edx_platform_path
+
+All courses are covered by a single grouped query, so one LMS start
+up is enough to tell which courses have changed since the last sweep.
+"""
+import sys
+
+from xsiftx.tools import enter_lms
+
+
+def dump_course_activity(output):
+    """
+    Write the course watermarks to the output file
+    """
+    # pylint: disable=F0401
+    from django.db.models import Max
+    from courseware.models import StudentModule
+
+    watermarks = StudentModule.objects.values_list('course_id').annotate(
+        Max('modified')
+    ).order_by()
+    for course_id, modified in watermarks:
+        output.write('{0}\t{1}\n'.format(course_id, modified.isoformat()))
+
+
+if __name__ == '__main__':
+    enter_lms(sys.argv[1], sys.argv[2])
+    dump_course_activity(sys.stdout)
@@ -0,0 +1,97 @@
+"""
+Catalog of the reports xsiftx has stored, kept in SQLite in the
+xsiftx state directory and updated by the stores on every write.
+
+It answers what has been generated for a course with an indexed
+lookup instead of listing the store, which for S3 means a LIST over
+every course's hashed prefix.
+"""
+import sqlite3
+import time
+
+from xsiftx.util import get_state_path
+
+CATALOG_DB = 'catalog.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    course TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    sifter TEXT,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    location TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    PRIMARY KEY (course, filename)
+);
+CREATE INDEX IF NOT EXISTS reports_sifter ON reports (sifter, stored_at);
+"""
+
+FIELDS = ('course', 'filename', 'sifter', 'size', 'sha256', 'location',
+          'stored_at')
+
+
+class ReportCatalog(object):
+    """
+    Index of stored reports by course and sifter
+    """
+
+    def __init__(self, state_dir):
+        """
+        Create the catalog database if needed
+        """
+        self.db_path = get_state_path(state_dir, CATALOG_DB)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        """
+        Connections are opened per call, so the catalog can be used
+        from upload threads and several processes at once.
+        """
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def record(self, course, filename, sifter, size, sha256, location):
+        """
+        Record a stored report, replacing any earlier one stored
+        under the same name for the course.
+        """
+        # pylint: disable=R0913
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO reports ({0}) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)'.format(', '.join(FIELDS)),
+                    (course, filename, sifter, size, sha256, location,
+                     time.time())
+                )
+        finally:
+            conn.close()
+
+    def reports(self, course=None, sifter=None):
+        """
+        Returns the reports stored for the course and sifter, all
+        courses or sifters when not given, newest first.
+        """
+        query = 'SELECT {0} FROM reports'.format(', '.join(FIELDS))
+        conditions = []
+        params = []
+        if course is not None:
+            conditions.append('course = ?')
+            params.append(course)
+        if sifter is not None:
+            conditions.append('sifter = ?')
+            params.append(sifter)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY stored_at DESC'
+        conn = self._connect()
+        try:
+            return [dict(zip(FIELDS, row))
+                    for row in conn.execute(query, params)]
+        finally:
+            conn.close()
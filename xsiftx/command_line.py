@@ -18,33 +18,334 @@ extra arguments that were passed to sifter
 """
 
 import argparse
+import os
 import sys
+import time
 
-from xsiftx.util import VENV, EDX_PLATFORM
+from xsiftx.catalog import ReportCatalog
+from xsiftx.delta import delta_output
+from xsiftx.history import RunHistory, format_since
+from xsiftx.journal import (
+    RunJournal,
+    SUCCESS,
+    FAILURE,
+    merge_summaries,
+    new_run_id
+)
+from xsiftx.pipeline import UploadPipeline, MAX_SPOOL
+from xsiftx.shards import parse_shard, select_courses
+from xsiftx.util import VENV, EDX_PLATFORM, STATE_DIR, SIFTER_LIMITS
 from xsiftx.util import (
+    find_sifter,
     get_sifters,
     get_course_list,
-    run_sifter,
-    SifterException
+    get_course_activity,
+    get_data_store,
+    get_sifter_manifest,
+    is_python_sifter,
+    sift,
+    sift_batch,
+    SifterException,
+    XsiftxNoConfigException
 )
 
+# Courses given to each run of a batch sifter during a sweep
+BATCH_SIZE = 50
 
-def execute():
+
+def format_duration(seconds):
     """
-    Begin command processing
+    Format seconds as e.g. 1h02m, 4m05s or 12s
     """
-    sifter_dict = get_sifters()
-    parser = argparse.ArgumentParser(
-        prog='xsiftx.py',
-        formatter_class=argparse.RawTextHelpFormatter,
-        description=(
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{0}h{1:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{0}m{1:02d}s'.format(seconds // 60, seconds % 60)
+    return '{0}s'.format(seconds)
+
+
+class Sweep(object):
+    """
+    Runs a sifter over a list of courses, storing each course's
+    reports in the background while the sifter runs on the next
+    one, and recording outcomes in the run journal and history.
+    """
+    # pylint: disable=R0903
+
+    def __init__(self, args, journal, history, watermarks, limits):
+        """
+        Keep what's needed to run and record each course
+        """
+        # pylint: disable=R0913
+        self.args = args
+        self.journal = journal
+        self.history = history
+        self.watermarks = watermarks
+        self.limits = limits
+        self.estimates = {}
+        self.runtimes = []
+
+    def schedule(self, courses):
+        """
+        Returns the courses with the longest running first, by the
+        runtime of the sifter's last run on each, so a sweep doesn't
+        end waiting on a few giant courses. Courses it hasn't run on
+        yet are estimated at the median of the others.
+        """
+        runtimes = self.history.runtimes(self.args.sifter,
+                                         self.args.extra_args)
+        known = sorted(runtimes[course] for course in courses
+                       if course in runtimes)
+        median = known[len(known) // 2] if known else None
+        self.estimates = dict(
+            (course, runtimes.get(course, median)) for course in courses
+        )
+        if self.args.in_order:
+            return list(courses)
+        return sorted(courses, key=lambda course: -(self.estimates[course]
+                                                    or 0))
+
+    def _time_left(self, remaining):
+        """
+        Estimate the seconds the remaining courses will take, from
+        their history scaled by how this sweep compares to it so far.
+        """
+        observed = [runtime for _, runtime in self.runtimes]
+        average = sum(observed) / len(observed)
+        estimated = [
+            (self.estimates[course], runtime)
+            for course, runtime in self.runtimes
+            if self.estimates[course]
+        ]
+        scale = 1.0
+        if estimated:
+            scale = (sum(runtime for _, runtime in estimated) /
+                     sum(estimate for estimate, _ in estimated))
+        return sum(
+            average if self.estimates[course] is None
+            else self.estimates[course] * scale
+            for course in remaining
+        )
+
+    def _progress(self, course, runtime, remaining):
+        """
+        Report a course the sifter finished and the time left
+        """
+        self.runtimes.append((course, runtime))
+        sys.stderr.write('[{0}/{1}] {2} took {3}, about {4} left\n'.format(
+            len(self.runtimes), len(self.runtimes) + len(remaining), course,
+            format_duration(runtime),
+            format_duration(self._time_left(remaining))
+        ))
+
+    def _succeeded(self, course, started_at, runtime=None, output_size=None):
+        """
+        Record a course whose reports are stored
+        """
+        self.journal.record(course, SUCCESS)
+        self.history.record(
+            self.args.sifter, self.args.extra_args, course, started_at,
+            self.watermarks.get(course, '') if self.args.skip_unchanged
+            else None,
+            runtime, output_size
+        )
+
+    def _failed(self, course, error):
+        """
+        Report and record a failed course
+        """
+        sys.stderr.write(unicode(error))
+        self.journal.record(course, FAILURE, unicode(error))
+
+    def _stored(self, results):
+        """
+        Record the outcome of finished uploads
+        """
+        for context, error in results:
+            if error:
+                self._failed(context[0], error)
+            else:
+                self._succeeded(*context)
+
+    def _since(self, courses):
+        """
+        Returns XSIFTX_SINCE for a run over the courses, the oldest of
+        their last successful runs, or None if not incremental or any
+        of them hasn't run before.
+        """
+        if not self.args.incremental:
+            return None
+        last_runs = [
+            self.history.last_run(self.args.sifter, self.args.extra_args,
+                                  course)
+            for course in courses
+        ]
+        if not all(last_runs):
+            return None
+        return format_since(min(run['started_at'] for run in last_runs))
+
+    def _sift(self, sifter, courses):
+        """
+        Run the sifter over the courses, in one batch if there are
+        several, returning a dictionary of each course to its output
+        or the SifterException it failed with.
+        """
+        args = self.args
+        since = self._since(courses)
+        try:
+            if len(courses) == 1:
+                return {courses[0]: sift(sifter, courses[0], args.venv,
+                                         args.edx_platform, args.extra_args,
+                                         self.limits, since, args.state_dir,
+                                         None, args.profile)}
+            return sift_batch(sifter, courses, args.venv, args.edx_platform,
+                              args.extra_args, self.limits, since,
+                              args.state_dir)
+        except SifterException, error:
+            return dict((course, error) for course in courses)
+
+    def run(self, sifter, courses):
+        """
+        Run the sifter at path ``sifter`` over the courses
+        """
+        args = self.args
+        data_store = get_data_store(args.edx_platform, args.state_dir)
+        pipeline = UploadPipeline(data_store, args.max_spool)
+        batch_size = 1
+        # Profiles are of a single course
+        if (not is_python_sifter(sifter) and not args.profile and
+                get_sifter_manifest(sifter)['batch']):
+            batch_size = max(args.batch_size, 1)
+        courses = self.schedule(courses)
+        try:
+            for start in range(0, len(courses), batch_size):
+                batch = courses[start:start + batch_size]
+                started_at = time.time()
+                results = self._sift(sifter, batch)
+                # A batch's runtime is shared evenly between its courses
+                runtime = (time.time() - started_at) / len(batch)
+                for index, course in enumerate(batch, start):
+                    output = results[course]
+                    self._progress(course, runtime, courses[index + 1:])
+                    if isinstance(output, SifterException):
+                        self._failed(course, output)
+                    elif output:
+                        output = delta_output(output, sifter,
+                                              args.extra_args,
+                                              args.state_dir)
+                        pipeline.submit(
+                            output, (course, started_at, runtime, output.size)
+                        )
+                    else:
+                        self._succeeded(course, started_at, runtime, 0)
+                    self._stored(pipeline.finished())
+        finally:
+            self._stored(pipeline.close())
+            data_store.close()
+
+
+def list_reports(args):
+    """
+    Write the cataloged reports for the course, or all courses, as
+    tab separated lines to standard out.
+    """
+    reports = ReportCatalog(args.state_dir).reports(args.course, args.sifter)
+    for report in reports:
+        sys.stdout.write('{0}\n'.format('\t'.join([
+            report['course'],
+            report['sifter'] or '',
+            report['filename'],
+            str(report['size']),
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(report['stored_at'])),
+            report['location'],
+        ])))
+
+
+def merge_runs(args):
+    """
+    Write the combined outcome of the runs, given as run IDs or paths
+    of journals copied from other hosts, to standard out.
+    """
+    journals = []
+    for run in args.merge_runs:
+        if os.path.isfile(run):
+            journals.append(RunJournal(run))
+        else:
+            journals.append(RunJournal.load(args.state_dir, run))
+    for journal in journals:
+        counts = journal.summary()
+        sys.stdout.write('{0}\t{1}\t{2} succeeded\t{3} failed\n'.format(
+            journal.run_id, journal.shard or '-', counts[SUCCESS],
+            counts[FAILURE]
+        ))
+    summary = merge_summaries(journals)
+    sys.stdout.write('total\t-\t{0} succeeded\t{1} failed\n'.format(
+        summary[SUCCESS], summary[FAILURE]
+    ))
+    for course, error in sorted(summary['failed'].items()):
+        sys.stdout.write('failed\t{0}\t{1}\n'.format(
+            course, (error or '').strip().replace('\n', ' ')
+        ))
+    if summary['missing_shards']:
+        sys.stderr.write('Missing shards: {0}\n'.format(
+            ', '.join(summary['missing_shards'])
+        ))
+
+
+def shard_arg(value):
+    """
+    Argument type of a shard given as i/N
+    """
+    try:
+        return parse_shard(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+def configured_limits(sifter_name):
+    """
+    Returns the limits the xsiftx configuration's sifter_limits sets
+    for the sifter, or none if there is no configuration.
+    """
+    # The configuration is loaded here, since the command line works
+    # without one
+    try:
+        from xsiftx.config import get_sifter_limits
+    except XsiftxNoConfigException:
+        return {}
+    return get_sifter_limits(sifter_name)
+
+
+class SifterArgumentParser(argparse.ArgumentParser):
+    """
+    Argument parser whose help lists the available sifters, which are
+    only looked up when the help is shown.
+    """
+
+    def format_help(self):
+        """
+        Add the available sifters to the description
+        """
+        self.description = (
             'Run a sifter against one or all courses.\n'
             'Current available sifters:\n{0}'.format(
-                '\n'.join(sifter_dict.keys())
+                '\n'.join(get_sifters().keys())
             )
         )
+        return super(SifterArgumentParser, self).format_help()
+
+
+def get_parser():
+    """
+    Returns the parser of the command line arguments
+    """
+    parser = SifterArgumentParser(
+        prog='xsiftx.py',
+        formatter_class=argparse.RawTextHelpFormatter,
     )
-    parser.add_argument('sifter',
+    parser.add_argument('sifter', nargs='?',
                         help='script in sifter library to run')
     parser.add_argument('-c', '--course', type=str,
                         help='Course ID e.g. org/number/term')
@@ -53,13 +354,86 @@ def execute():
     parser.add_argument('-e', '--edx-platform', type=str,
                         default=EDX_PLATFORM[1],
                         help='Root path to edx-platform')
+    parser.add_argument('--state-dir', type=str, default=STATE_DIR[1],
+                        help='Directory for run journals and other state')
+    parser.add_argument('--list-reports', action='store_true',
+                        help='List the stored reports of the course, or '
+                        'all courses, optionally only those of the sifter')
+    parser.add_argument('--merge-runs', type=str, nargs='+', metavar='RUN',
+                        help='Summarize the runs of the shards of a sweep, '
+                        'given as run IDs or journal files')
+    parser.add_argument('--shard', type=shard_arg, metavar='I/N',
+                        help='Only run the courses in shard I of N')
+    parser.add_argument('--include', type=str, action='append',
+                        metavar='PATTERN',
+                        help='Only run courses matching the pattern, '
+                        'e.g. "MITx/*", may be repeated')
+    parser.add_argument('--exclude', type=str, action='append',
+                        metavar='PATTERN',
+                        help='Skip courses matching the pattern, may be '
+                        'repeated')
+    parser.add_argument('--run-id', type=str,
+                        help='ID to record this run under for resuming')
+    parser.add_argument('--resume', type=str, metavar='RUN_ID',
+                        help='Resume a run, skipping courses that '
+                        'already finished successfully')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Pass the time of the last successful run of '
+                        'the sifter on each course as XSIFTX_SINCE')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='Skip courses without student activity since '
+                        'the last successful run of the sifter')
+    parser.add_argument('--in-order', action='store_true',
+                        help='Run courses in the order listed instead of '
+                        'the longest running first')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Courses given to each run of a sifter whose '
+                        'manifest declares batch')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile Python sifters and store the profile '
+                        'next to each report')
+    parser.add_argument('--max-spool', type=int, default=MAX_SPOOL,
+                        help='Bytes of finished reports allowed to wait '
+                        'for upload before sifting pauses')
+    parser.add_argument('--timeout', type=float,
+                        help='Wall clock seconds before a sifter is killed')
+    parser.add_argument('--max-memory', type=int,
+                        help='Address space limit for a sifter in bytes')
+    parser.add_argument('--max-cpu', type=int,
+                        help='CPU time limit for a sifter in seconds')
+    parser.add_argument('--max-output', type=int,
+                        help='Largest report a sifter may write in bytes')
+    parser.add_argument('--nice', type=int,
+                        help='Niceness increment to run sifters with')
+    parser.add_argument('--ionice', type=str,
+                        help='IO scheduling class to run sifters with '
+                        '(realtime, best-effort or idle)')
+    parser.add_argument('--ionice-level', type=int,
+                        help='IO priority within the ionice class (0-7)')
 
     # Grab any extra arguments passed in
     parser.add_argument('extra_args', nargs=argparse.REMAINDER)
+    return parser
+
 
+def execute():
+    """
+    Begin command processing
+    """
+    parser = get_parser()
     args = parser.parse_args()
 
-    if args.sifter not in sifter_dict.keys():
+    if args.list_reports:
+        list_reports(args)
+        return
+    if args.merge_runs:
+        merge_runs(args)
+        return
+    if not args.sifter:
+        parser.error('a sifter is required')
+
+    sifter = find_sifter(args.sifter)
+    if sifter is None:
         sys.stderr.write("You have specified a sifter that doesn't exist\n")
         sys.exit(-1)
 
@@ -76,22 +450,67 @@ def execute():
 
     # Everything is all setup, now run the sifter and write the output
     # to the grade download location.
+    limits = configured_limits(args.sifter)
+    limits.update(
+        (limit, getattr(args, limit)) for limit in SIFTER_LIMITS
+        if getattr(args, limit) is not None
+    )
     courses_to_run = []
     if args.course:
         courses_to_run = [args.course, ]
     else:
         courses_to_run = courses
-    for course in courses_to_run:
-        try:
-            run_sifter(
-                sifter_dict[args.sifter],
-                course,
-                args.venv,
-                args.edx_platform,
-                args.extra_args
+
+    if args.resume:
+        journal = RunJournal.load(args.state_dir, args.resume)
+        if journal.sifter != args.sifter:
+            sys.stderr.write(
+                'Run {0} is for the sifter {1}\n'.format(
+                    journal.run_id, journal.sifter
+                )
             )
-        except SifterException, error:
-            sys.stderr.write(unicode(error))
+            sys.exit(-3)
+        if not args.extra_args:
+            args.extra_args = journal.extra_args
+        if not args.shard and journal.shard:
+            args.shard = parse_shard(journal.shard)
+        finished = journal.succeeded()
+        courses_to_run = [
+            course for course in courses_to_run if course not in finished
+        ]
+    else:
+        journal = RunJournal.create(
+            args.state_dir,
+            args.run_id or new_run_id(args.sifter),
+            args.sifter,
+            args.extra_args,
+            '{0}/{1}'.format(*args.shard) if args.shard else None
+        )
+    if not args.course:
+        courses_to_run = select_courses(
+            courses_to_run, args.shard, args.include, args.exclude
+        )
+    sys.stderr.write('Run ID: {0}\n'.format(journal.run_id))
+
+    history = RunHistory(args.state_dir)
+    watermarks = {}
+    if args.skip_unchanged:
+        watermarks = get_course_activity(args.venv, args.edx_platform)
+        unchanged = [
+            course for course in courses_to_run
+            if history.unchanged(args.sifter, args.extra_args, course,
+                                 watermarks.get(course, ''))
+        ]
+        sys.stderr.write('Skipping {0} unchanged courses\n'.format(
+            len(unchanged)
+        ))
+        courses_to_run = [
+            course for course in courses_to_run if course not in unchanged
+        ]
+
+    Sweep(args, journal, history, watermarks, limits).run(
+        sifter, courses_to_run
+    )
 
 if __name__ == '__main__':
     execute()
@@ -13,21 +13,60 @@ The format is:
 
 edx_venv_path: "/edx/app/edxapp/venvs/edxapp"
 edx_platform_path: "/edx/app/edxapp/edx-platform"
+state_dir: "~/.xsiftx"
 consumers:
   - key: <lti_app_identifier. e.g MITx-6.00x>
     secret: <oath_secret>
+    max_concurrent: 2
+    max_queued: 10
     allowed_sifters:
       - dump_grades
       - ...
+sifter_limits:
+  default:
+    timeout: 3600
+  xqanalyze:
+    timeout: 7200
+    max_memory: 4294967296
+    nice: 10
+result_ttl:
+  default: 0
+  content_statistics: 900
+shared_nonce_cache: true
+
+state_dir holds local state shared by the web and worker processes,
+and defaults to $XSIFTX_STATE_DIR or ~/.xsiftx.
+
+max_concurrent caps how many runs a consumer may have with the celery
+workers at once, and max_queued how many more may wait their turn.
+Both are unlimited when unspecified. Runs only wait with a
+max_concurrent set, so max_queued has no effect without one.
 
 if sifter list is empty or unspecified, all sifters are allowed. It
 also requires a server secret in order to use secure client cookies to
 store session information as flask_secret_key: <long crypto secret>
+
+sifter_limits are optional and keyed by sifter name, with the
+``default`` entry applying to any sifter without its own. See
+``xsiftx.util.SIFTER_LIMITS`` for the available limits. They apply to
+command line runs too, unless overridden by its options.
+
+result_ttl is the number of seconds, keyed by sifter name like
+sifter_limits, for which an LTI run returns the reports of the last
+successful run of the sifter on the course with the same arguments
+instead of running it again. It is 0, never reusing results, by
+default.
+
+LTI launch nonces are remembered by each web process to refuse
+replays. Set shared_nonce_cache to keep them in state_dir instead, so
+every web process on the host refuses launches seen by the others.
 """
 import os
-import yaml
 
-from xsiftx.util import VENV, EDX_PLATFORM
+from xsiftx.util import VENV, EDX_PLATFORM, STATE_DIR, load_yaml
+# Raised here, but defined with the other exceptions so code that
+# works without a configuration can catch it
+from xsiftx.util import XsiftxNoConfigException  # pylint: disable=W0611
 
 CONFIG_PATHS = [
     os.path.join(os.getcwd(), 'xsiftx.yml'),
@@ -36,13 +75,6 @@ CONFIG_PATHS = [
 ]
 
 
-class XsiftxNoConfigException(Exception):
-    """
-    Customized exception for when the configuration doesn't exist
-    """
-    pass
-
-
 def get_consumer(key):
     """
     Returns the consumer object based on key
@@ -56,6 +88,24 @@ def get_consumer(key):
     return consumer
 
 
+def get_sifter_limits(sifter_name):
+    """
+    Returns the resource limits dictionary configured for the sifter
+    """
+    sifter_limits = settings.get('sifter_limits', None) or {}
+    limits = dict(sifter_limits.get('default', None) or {})
+    limits.update(sifter_limits.get(sifter_name, None) or {})
+    return limits
+
+
+def get_result_ttl(sifter_name):
+    """
+    Returns the seconds results of the sifter may be reused for
+    """
+    result_ttl = settings.get('result_ttl', None) or {}
+    return result_ttl.get(sifter_name, result_ttl.get('default', 0)) or 0
+
+
 def get_config():
     """
     Find config file and load or return None
@@ -74,7 +124,7 @@ def get_config():
 
     if config_file:
         with open(config_file) as conf_yaml:
-            conf = yaml.load(conf_yaml)
+            conf = load_yaml(conf_yaml)
 
     if not conf:
         raise XsiftxNoConfigException('No configuration found')
@@ -86,6 +136,9 @@ def get_config():
     if not conf.get(EDX_PLATFORM[0], None):
         conf[EDX_PLATFORM[0]] = EDX_PLATFORM[1]
 
+    if not conf.get(STATE_DIR[0], None):
+        conf[STATE_DIR[0]] = STATE_DIR[1]
+
     return conf
 
 settings = get_config()  # pylint: disable=C0103
@@ -0,0 +1,288 @@
+"""
+Delta reports of keyed CSV reports.
+
+A sifter whose manifest sets ``delta_key`` to the columns identifying
+a row of its CSV report has each report compared with the last one
+for the course. What's stored is ``<report>.delta.csv``, listing the
+rows added, changed or removed since, and the full report only when
+none has been stored for ``snapshot_days`` days. The last full report
+of each sifter, set of extra arguments and course is kept in the
+state directory to compare the next one with, along with when a full
+report was last stored, so nothing is read back from the store and
+report names that change from run to run don't matter.
+"""
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from xsiftx.util import get_sifter_manifest, get_state_path
+
+log = logging.getLogger('xsiftx')  # pylint: disable=C0103
+
+# Directory of the last full report of each sifter, extra arguments
+# and course in the state directory
+DELTA_DIR = 'deltas'
+DELTA_SUFFIX = '.delta'
+# Suffix of the file next to a baseline whose modification time is
+# when the full report was last stored
+SNAPSHOT_SUFFIX = '.snapshot'
+
+# First column of a delta report, saying how each row changed
+CHANGE_COLUMN = 'change'
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+
+def delta_filename(filename):
+    """
+    Returns the name of the delta of a report, e.g. grades.delta.csv
+    """
+    stem, extension = os.path.splitext(filename)
+    return '{0}{1}{2}'.format(stem, DELTA_SUFFIX, extension)
+
+
+def _key_indexes(header, key):
+    """
+    Returns the indexes of the key columns in the header
+    """
+    missing = [column for column in key if column not in header]
+    if missing:
+        raise ValueError('The report has no {0} column'.format(
+            ', '.join(missing)
+        ))
+    return [header.index(column) for column in key]
+
+
+def _row_key(row, indexes):
+    """
+    Returns the key of a CSV row
+    """
+    try:
+        return tuple(row[index] for index in indexes)
+    except IndexError:
+        raise ValueError('The report has a row missing key columns')
+
+
+def _read_keyed(reader, indexes):
+    """
+    Returns a dictionary of the rows of the CSV reader by their key
+    """
+    rows = {}
+    for row in reader:
+        row_key = _row_key(row, indexes)
+        if row_key in rows:
+            raise ValueError('The key {0} is not unique'.format(
+                ', '.join(row_key)
+            ))
+        rows[row_key] = row
+    return rows
+
+
+def write_delta(baseline_path, report_path, key, delta_path):
+    """
+    Write the rows of the CSV report at report_path that were added,
+    changed or removed since the baseline report to delta_path, and
+    return the number of each. Raises ValueError if the reports'
+    columns differ or the key columns don't identify their rows.
+    """
+    counts = {ADDED: 0, CHANGED: 0, REMOVED: 0}
+    with open(baseline_path, 'rb') as baseline_file:
+        baseline = csv.reader(baseline_file)
+        header = next(baseline, None)
+        if header is None:
+            raise ValueError('The last report is empty')
+        indexes = _key_indexes(header, key)
+        old_rows = _read_keyed(baseline, indexes)
+
+    with open(report_path, 'rb') as report_file, \
+            open(delta_path, 'wb') as delta_file:
+        report = csv.reader(report_file)
+        if next(report, None) != header:
+            raise ValueError('The report columns changed')
+        writer = csv.writer(delta_file)
+        writer.writerow([CHANGE_COLUMN] + header)
+        seen = set()
+        for row in report:
+            row_key = _row_key(row, indexes)
+            if row_key in seen:
+                raise ValueError('The key {0} is not unique'.format(
+                    ', '.join(row_key)
+                ))
+            seen.add(row_key)
+            old_row = old_rows.pop(row_key, None)
+            if old_row is None:
+                change = ADDED
+            elif old_row != row:
+                change = CHANGED
+            else:
+                continue
+            counts[change] += 1
+            writer.writerow([change] + row)
+        for row_key in sorted(old_rows):
+            counts[REMOVED] += 1
+            writer.writerow([REMOVED] + old_rows[row_key])
+    return counts
+
+
+class DeltaReports(object):
+    """
+    Last full reports of each sifter run, kept in the state directory
+    to compare new reports with.
+    """
+
+    def __init__(self, state_dir):
+        """
+        Create the baseline directory if needed
+        """
+        self.baseline_dir = get_state_path(state_dir, DELTA_DIR)
+        try:
+            os.makedirs(self.baseline_dir, 0o700)
+        except OSError:
+            if not os.path.isdir(self.baseline_dir):
+                raise
+
+    def _run_path(self, sifter, extra_args, course):
+        """
+        Returns the path, without an extension, of the files kept for
+        the sifter run with the extra arguments for the course
+        """
+        name = hashlib.sha1('{0}\0{1}\0{2}'.format(
+            sifter, json.dumps(extra_args), course
+        )).hexdigest()
+        return os.path.join(self.baseline_dir, name)
+
+    def baseline_path(self, sifter, extra_args, course):
+        """
+        Returns the path of the last full report of the sifter run
+        with the extra arguments for the course
+        """
+        return self._run_path(sifter, extra_args, course) + '.csv'
+
+    def snapshot_path(self, sifter, extra_args, course):
+        """
+        Returns the path of the file marking when the full report of
+        the sifter run with the extra arguments for the course was
+        last stored
+        """
+        return self._run_path(sifter, extra_args, course) + SNAPSHOT_SUFFIX
+
+    def snapshot_due(self, sifter, extra_args, course, snapshot_days):
+        """
+        Whether the full report of the sifter run with the extra
+        arguments hasn't been stored for the course in the last
+        snapshot_days days
+        """
+        cutoff = time.time() - snapshot_days * 24 * 60 * 60
+        try:
+            return os.path.getmtime(
+                self.snapshot_path(sifter, extra_args, course)
+            ) < cutoff
+        except OSError:
+            return True
+
+    def _mark_snapshot(self, snapshot_path):
+        """
+        Record that the full report was stored now. Like the baseline,
+        failing to is only logged and the next report is stored in
+        full.
+        """
+        try:
+            with open(snapshot_path, 'w'):
+                pass
+            os.utime(snapshot_path, None)
+        except (IOError, OSError):
+            log.exception('Failed to record the snapshot %s',
+                          snapshot_path)
+
+    def _keep_baseline(self, report_path, baseline_path):
+        """
+        Move a stored report into place as the baseline. The report
+        is already stored, so failing to keep it is only logged and
+        the next report is stored in full.
+        """
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=self.baseline_dir)
+            os.close(handle)
+            shutil.move(report_path, temp_path)
+            os.rename(temp_path, baseline_path)
+        except (IOError, OSError):
+            log.exception('Failed to keep %s as the last report',
+                          report_path)
+
+    def apply(self, output, extra_args, key, snapshot_days):
+        """
+        Replace the report of the SifterOutput with its delta against
+        the last one of the sifter run with the same extra arguments,
+        adding the full report when a snapshot is due,
+        and keep the report as the new baseline once it's stored.
+        Outputs of several reports are left as they are.
+        """
+        if output.filename is None:
+            return
+        if output.output_dir is None:
+            output.output_dir = tempfile.mkdtemp(prefix='xsiftx')
+        handle, report_path = tempfile.mkstemp(dir=output.output_dir)
+        with os.fdopen(handle, 'wb') as report_file:
+            shutil.copyfileobj(output.spool, report_file)
+
+        baseline_path = self.baseline_path(output.sifter, extra_args,
+                                           output.course)
+        outputs = [(output.filename, report_path)]
+        if os.path.isfile(baseline_path):
+            handle, delta_path = tempfile.mkstemp(dir=output.output_dir)
+            os.close(handle)
+            try:
+                counts = write_delta(baseline_path, report_path, key,
+                                     delta_path)
+            except ValueError as err:
+                log.warning('Storing all of %s for %s instead of a delta: '
+                            '%s', output.filename, output.course, err)
+            else:
+                log.info('%s for %s has %d added, %d changed and %d '
+                         'removed rows', output.filename, output.course,
+                         counts[ADDED], counts[CHANGED], counts[REMOVED])
+                outputs = [(delta_filename(output.filename), delta_path)]
+                if self.snapshot_due(output.sifter, extra_args,
+                                     output.course, snapshot_days):
+                    outputs.append((output.filename, report_path))
+
+        snapshot = (output.filename, report_path) in outputs
+        snapshot_path = self.snapshot_path(output.sifter, extra_args,
+                                           output.course)
+        output.filename = None
+        output.outputs = outputs
+        output.size = sum(os.path.getsize(path)
+                          for _, path in outputs + output.attachments)
+        if snapshot:
+            output.on_stored.append(
+                lambda: self._mark_snapshot(snapshot_path)
+            )
+        output.on_stored.append(
+            lambda: self._keep_baseline(report_path, baseline_path)
+        )
+
+
+def delta_output(output, sifter, extra_args, state_dir):
+    """
+    Turn the output of the sifter at path ``sifter``, run with the
+    extra arguments, into a delta
+    report if its manifest declares a ``delta_key`` and there is a
+    state directory to keep the last reports in. Returns the output.
+    """
+    if not output or not state_dir:
+        return output
+    manifest = get_sifter_manifest(sifter)
+    key = manifest['delta_key']
+    if not key:
+        return output
+    if isinstance(key, basestring):
+        key = [key]
+    DeltaReports(state_dir).apply(output, extra_args, key,
+                                  manifest['snapshot_days'])
+    return output
@@ -0,0 +1,116 @@
+"""
+History of sifter runs against each course, kept in SQLite in the
+xsiftx state directory so sweeps can work incrementally.
+
+Runs are keyed by sifter name, extra arguments and course, since
+the same sifter with different arguments writes different reports.
+Each run also records how long the sifter took and how much it wrote,
+which sweeps use to run the longest courses first and estimate how
+long they have left.
+"""
+import json
+import sqlite3
+import time
+
+from xsiftx.util import get_state_path
+
+HISTORY_DB = 'history.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS last_runs (
+    sifter TEXT NOT NULL,
+    extra_args TEXT NOT NULL,
+    course TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    watermark TEXT,
+    runtime REAL,
+    output_size INTEGER,
+    PRIMARY KEY (sifter, extra_args, course)
+);
+"""
+
+
+def format_since(timestamp):
+    """
+    Format a unix timestamp as the ISO 8601 UTC time passed to
+    sifters in XSIFTX_SINCE.
+    """
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class RunHistory(object):
+    """
+    Record of the last successful run of each sifter for each course
+    """
+
+    def __init__(self, state_dir):
+        """
+        Open the history database, creating it if needed
+        """
+        self.conn = sqlite3.connect(
+            get_state_path(state_dir, HISTORY_DB), timeout=30
+        )
+        self.conn.executescript(SCHEMA)
+
+    def last_run(self, sifter, extra_args, course):
+        """
+        Returns the last successful run as a dictionary of its
+        started_at, finished_at and activity watermark, or None.
+        """
+        row = self.conn.execute(
+            'SELECT started_at, finished_at, watermark FROM last_runs '
+            'WHERE sifter = ? AND extra_args = ? AND course = ?',
+            (sifter, json.dumps(extra_args), course)
+        ).fetchone()
+        if not row:
+            return None
+        return dict(zip(('started_at', 'finished_at', 'watermark'), row))
+
+    def record(self, sifter, extra_args, course, started_at, watermark=None,
+               runtime=None, output_size=None):
+        """
+        Record a successful run that began at ``started_at``. The
+        watermark is the course's activity watermark when the run
+        began, or None if it wasn't probed. ``runtime`` is the
+        seconds the sifter took and ``output_size`` the bytes of
+        reports it wrote.
+        """
+        # pylint: disable=R0913
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO last_runs (sifter, extra_args, '
+                'course, started_at, finished_at, watermark, runtime, '
+                'output_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (sifter, json.dumps(extra_args), course, started_at,
+                 time.time(), watermark, runtime, output_size)
+            )
+
+    def runtimes(self, sifter, extra_args):
+        """
+        Returns the runtime of the last successful run of the sifter
+        on each course it has run on, by course. Runs with other
+        extra arguments are used for courses without one with the
+        same arguments.
+        """
+        runtimes = {}
+        exact = json.dumps(extra_args)
+        # Runs with the same arguments come last to take precedence
+        rows = self.conn.execute(
+            'SELECT course, runtime FROM last_runs '
+            'WHERE sifter = ? AND runtime IS NOT NULL '
+            'ORDER BY extra_args = ?, finished_at',
+            (sifter, exact)
+        )
+        for course, runtime in rows:
+            runtimes[course] = runtime
+        return runtimes
+
+    def unchanged(self, sifter, extra_args, course, watermark):
+        """
+        Whether the course's activity watermark hasn't moved since
+        the last successful run.
+        """
+        last_run = self.last_run(sifter, extra_args, course)
+        return bool(last_run and last_run['watermark'] is not None and
+                    last_run['watermark'] == watermark)
@@ -0,0 +1,211 @@
+"""
+Run journal for command line sweeps, recording the outcome of each
+course as it finishes so an interrupted run can be resumed.
+
+Journals live in the runs directory of the xsiftx state directory,
+one append only file of JSON lines per run ID. The first line
+describes the run and each following line records a course outcome,
+where a later line for the same course replaces an earlier one.
+"""
+import json
+import os
+import time
+import uuid
+
+from xsiftx.util import XsiftxException, get_state_path
+
+JOURNAL_DIR = 'runs'
+JOURNAL_EXTENSION = '.jsonl'
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+
+
+def new_run_id(sifter):
+    """
+    Generate a run ID for a new run of the sifter
+    """
+    return '{0}-{1}-{2}'.format(
+        sifter, time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8]
+    )
+
+
+class RunJournal(object):
+    """
+    Append only record of the per course outcomes of a run
+    """
+
+    def __init__(self, path):
+        """
+        Load the journal at path
+        """
+        self.path = path
+        self.header = None
+        self.outcomes = {}
+        with open(path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partial line from a run that died mid write
+                    continue
+                if entry.get('event') == 'start':
+                    self.header = entry
+                elif entry.get('event') == 'course':
+                    self.outcomes[entry['course']] = entry
+        if not self.header:
+            raise XsiftxException(
+                'Run journal {0} is missing its header'.format(path)
+            )
+
+    @staticmethod
+    def path_for(state_dir, run_id):
+        """
+        Returns the path of the journal for the run ID
+        """
+        return get_state_path(
+            os.path.join(state_dir, JOURNAL_DIR),
+            '{0}{1}'.format(run_id, JOURNAL_EXTENSION)
+        )
+
+    @classmethod
+    def create(cls, state_dir, run_id, sifter, extra_args, shard=None):
+        """
+        Start the journal of a new run, of the ``i/N`` shard of the
+        courses if given.
+        """
+        path = cls.path_for(state_dir, run_id)
+        if os.path.exists(path):
+            raise XsiftxException(
+                'A run with ID {0} already exists, use --resume to '
+                'continue it'.format(run_id)
+            )
+        cls._append(path, {
+            'event': 'start',
+            'run_id': run_id,
+            'sifter': sifter,
+            'extra_args': extra_args,
+            'shard': shard,
+            'time': time.time(),
+        })
+        return cls(path)
+
+    @classmethod
+    def load(cls, state_dir, run_id):
+        """
+        Open the journal of an existing run
+        """
+        path = cls.path_for(state_dir, run_id)
+        if not os.path.isfile(path):
+            raise XsiftxException('No run found with ID {0}'.format(run_id))
+        return cls(path)
+
+    @staticmethod
+    def _append(path, entry):
+        """
+        Durably append an entry to the journal file
+        """
+        with open(path, 'a') as journal_file:
+            journal_file.write(json.dumps(entry) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    @property
+    def run_id(self):
+        """
+        ID of the run this journal records
+        """
+        return self.header['run_id']
+
+    @property
+    def sifter(self):
+        """
+        Name of the sifter the run is for
+        """
+        return self.header['sifter']
+
+    @property
+    def extra_args(self):
+        """
+        Extra arguments the run passes to the sifter
+        """
+        return self.header['extra_args']
+
+    @property
+    def shard(self):
+        """
+        Shard of the courses the run is for as i/N, or None
+        """
+        return self.header.get('shard', None)
+
+    def record(self, course, status, error=None):
+        """
+        Record the outcome of a course
+        """
+        entry = {
+            'event': 'course',
+            'course': course,
+            'status': status,
+            'error': error,
+            'time': time.time(),
+        }
+        self._append(self.path, entry)
+        self.outcomes[course] = entry
+
+    def succeeded(self):
+        """
+        Set of courses that have finished successfully
+        """
+        return set(
+            course for course, entry in self.outcomes.items()
+            if entry['status'] == SUCCESS
+        )
+
+    def failed(self):
+        """
+        Dictionary of the courses that failed to their errors
+        """
+        return dict(
+            (course, entry['error']) for course, entry in self.outcomes.items()
+            if entry['status'] == FAILURE
+        )
+
+    def summary(self):
+        """
+        Count of courses by outcome
+        """
+        counts = {SUCCESS: 0, FAILURE: 0}
+        for entry in self.outcomes.values():
+            counts[entry['status']] += 1
+        return counts
+
+
+def merge_summaries(journals):
+    """
+    Combine the journals of the shards of a sweep into a dictionary of
+    the count of courses by outcome, the failed courses and their
+    errors, and the shards missing from the journals. A course in more
+    than one journal counts with its latest outcome.
+    """
+    outcomes = {}
+    shards = set()
+    count = None
+    for journal in journals:
+        for course, entry in journal.outcomes.items():
+            if entry['time'] >= outcomes.get(course, {}).get('time', 0):
+                outcomes[course] = entry
+        if journal.shard:
+            index, count = [int(part) for part in journal.shard.split('/')]
+            shards.add(index)
+    summary = {SUCCESS: 0, FAILURE: 0}
+    for entry in outcomes.values():
+        summary[entry['status']] += 1
+    summary['failed'] = dict(
+        (course, entry['error']) for course, entry in outcomes.items()
+        if entry['status'] == FAILURE
+    )
+    summary['missing_shards'] = [
+        '{0}/{1}'.format(index, count) for index in range(1, (count or 0) + 1)
+        if index not in shards
+    ]
+    return summary
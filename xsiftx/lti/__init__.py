@@ -4,9 +4,10 @@ for flask that allows user's to run a sifter from
 inside their courseware (if authorized)
 """
 # pylint: disable=C0103
-import os
+import logging
 import shlex
 import time
+import uuid
 
 from celery import Celery
 from flask import (
@@ -19,23 +20,50 @@ from flask import (
 )
 
 from .decorators import lti_authentication, lti_staff_required
+from .scheduler import ConsumerScheduler, QueueFullException
 from .util import (
     InvalidAPIUsage,
     LTIException,
     LTIRoleException,
     get_allowed_sifters
 )
-from xsiftx.config import settings, get_consumer, VENV, EDX_PLATFORM
+from xsiftx.catalog import ReportCatalog
+from xsiftx.config import (
+    settings,
+    get_consumer,
+    get_result_ttl,
+    get_sifter_limits,
+    VENV,
+    EDX_PLATFORM,
+    STATE_DIR
+)
+from xsiftx.history import RunHistory
 from xsiftx.util import (
     XsiftxException,
     SifterException,
+    SifterLimitException,
+    cancel_on_signal,
+    get_sifter_manifest,
+    get_sifter_name,
+    get_state_path,
     run_sifter
 )
 
+log = logging.getLogger('xsiftx')
 
 API_VERSION = 'v0.1'
 
-JOB_CLEAR_STATUSES = ['SUCCESS', 'FAILURE', 'REVOKED', 'SIFTER_FAILURE', ]
+SCHEDULER_DB = 'scheduler.db'
+
+# Least seconds between progress updates a run sends to the result
+# backend, so chatty sifters don't flood it
+PROGRESS_INTERVAL = 5
+
+JOB_CLEAR_STATUSES = [
+    'SUCCESS', 'FAILURE', 'REVOKED', 'SIFTER_FAILURE',
+    'SIFTER_LIMIT_EXCEEDED', 'CACHED',
+]
+TRUE_VALUES = ['1', 'true', 'yes', 'on']
 
 
 # Define our app as a blueprint
@@ -59,6 +87,82 @@ celery = Celery(
 )
 celery.conf.update(settings)
 
+_scheduler = None
+
+
+def get_sifter_queue(sifter):
+    """
+    Returns the celery queue configured for the cost class the
+    sifter declares in its manifest, or None for the default queue.
+    """
+    cost_class = get_sifter_manifest(sifter)['cost_class']
+    return (settings.get('sifter_queues', None) or {}).get(cost_class, None)
+
+
+def _dispatch_sifter(task_id, job):
+    """
+    Send a job admitted by the scheduler to the celery workers
+    """
+    web_run_sifter.apply_async(
+        (job['sifter'], job['course'], job['extra_args']),
+        {'consumer_key': job['consumer_key'],
+         'profile': job.get('profile', False)},
+        task_id=task_id,
+        queue=get_sifter_queue(job['sifter'])
+    )
+
+
+def _consumer_limits(key):
+    """
+    Returns the (max_concurrent, max_queued) limits of the consumer
+    """
+    consumer = get_consumer(key) or {}
+    return consumer.get('max_concurrent', None), consumer.get('max_queued',
+                                                              None)
+
+
+def _task_finished(task_id):
+    """
+    Whether celery has a final state for the task
+    """
+    return celery.AsyncResult(task_id).ready()  # pylint: disable=e1121
+
+
+def get_cached_result(sifter_name, course, extra_args):
+    """
+    Returns the finish time and stored reports of the last successful
+    run of the sifter on the course with the same arguments, if it
+    finished within the sifter's result TTL, or else None.
+    """
+    ttl = get_result_ttl(sifter_name)
+    if not ttl:
+        return None
+    state_dir = settings[STATE_DIR[0]]
+    last_run = RunHistory(state_dir).last_run(sifter_name, extra_args,
+                                              course)
+    if not last_run or time.time() - last_run['finished_at'] > ttl:
+        return None
+    reports = [
+        report for report in ReportCatalog(state_dir).reports(course,
+                                                              sifter_name)
+        if report['stored_at'] >= last_run['started_at']
+    ]
+    return {'finished_at': last_run['finished_at'], 'reports': reports}
+
+
+def get_scheduler():
+    """
+    Returns the process wide consumer scheduler
+    """
+    global _scheduler  # pylint: disable=W0603
+    if _scheduler is None:
+        _scheduler = ConsumerScheduler(
+            get_state_path(settings[STATE_DIR[0]], SCHEDULER_DB),
+            _dispatch_sifter,
+            _consumer_limits
+        )
+    return _scheduler
+
 
 @xsiftx_lti.route('/', methods=['GET', 'POST'])
 @lti_authentication
@@ -68,11 +172,15 @@ def index():
     Show the xsift interface page
     """
     consumer = get_consumer(session['oauth_consumer_key'])
-    sifters = get_allowed_sifters(consumer)
+    sifters = get_allowed_sifters(consumer, True)
+    manifests = dict(
+        (name, get_sifter_manifest(path)) for name, path in sifters.items()
+    )
 
     return render_template(
         'index.html',
-        sifters=sifters,
+        sifters=sorted(sifters.keys()),
+        manifests=manifests,
     )
 
 
@@ -80,7 +188,10 @@ def index():
 @lti_authentication
 def run():
     """
-    Runs a given sifter for the course in the LTI component.
+    Runs a given sifter for the course in the LTI component, or
+    returns the reports of a recent enough run of it unless
+    ``force_refresh`` is set. With ``profile`` set, Python sifters
+    are profiled and the profile stored next to the report.
     """
     sifter_name = request.form.get('sifter', None)
     if not sifter_name:
@@ -99,18 +210,70 @@ def run():
 
     course = session['context_id']
     extra_args = shlex.split(request.form.get('extra_args', ''))
-    task = web_run_sifter.apply_async((
-        sifter,
-        course,
-        extra_args
-    ))
     managed_tasks = list(session.get('managed_tasks', []))
+    force_refresh = (request.form.get('force_refresh', '').lower() in
+                     TRUE_VALUES)
+    profile = request.form.get('profile', '').lower() in TRUE_VALUES
+    cached = None
+    # A profile needs a fresh run
+    if not (force_refresh or profile):
+        cached = get_cached_result(sifter_name, course, extra_args)
+    if cached:
+        managed_tasks.append({
+            'sifter': sifter_name,
+            'task_id': 'cached-{0}'.format(uuid.uuid4()),
+            'time': time.strftime('%Y-%m-%d %H:%M:%SZ', time.localtime()),
+            'extra_args': extra_args,
+            'course': course,
+            'scheduled': False,
+            'cached': True,
+            'status': 'CACHED',
+            'results': cached,
+        })
+        session['managed_tasks'] = managed_tasks
+        return get_task_status()
+
+    max_queued = consumer.get('max_queued', None)
+    scheduled = bool(consumer.get('max_concurrent', None) or
+                     max_queued is not None)
+    if scheduled and not consumer.get('max_concurrent', None):
+        log.warning('Consumer %s sets max_queued without max_concurrent, '
+                    'so its runs never wait and max_queued has no effect',
+                    consumer['key'])
+    if scheduled:
+        # Leave it to the scheduler to share workers fairly
+        try:
+            task_id, _ = get_scheduler().submit(
+                consumer['key'],
+                {
+                    'sifter': sifter,
+                    'course': course,
+                    'extra_args': extra_args,
+                    'consumer_key': consumer['key'],
+                    'profile': profile,
+                },
+                _task_finished
+            )
+        except QueueFullException as err:
+            raise InvalidAPIUsage(
+                unicode(err),
+                429,
+                {'queue_depth': err.queue_depth,
+                 'estimated_wait': err.estimated_wait}
+            )
+    else:
+        task_id = web_run_sifter.apply_async(
+            (sifter, course, extra_args),
+            {'profile': profile},
+            queue=get_sifter_queue(sifter)
+        ).task_id
     task_dict = {
         'sifter': sifter_name,
-        'task_id': task.task_id,
+        'task_id': task_id,
         'time': time.strftime('%Y-%m-%d %H:%M:%SZ', time.localtime()),
         'extra_args': extra_args,
         'course': course,
+        'scheduled': scheduled,
     }
     managed_tasks.append(task_dict)
     session['managed_tasks'] = managed_tasks
@@ -127,17 +290,80 @@ def get_task_status():
     Grabs a status of all the tasks that are stored in the session
     """
     managed_tasks = session.get('managed_tasks', [])
+    if any(task.get('scheduled', False) for task in managed_tasks):
+        # Hand on the slots of runs that ended without telling us
+        get_scheduler().reconcile(session['oauth_consumer_key'],
+                                  _task_finished)
     for task in managed_tasks:
+        if task.get('cached', False):
+            continue
+        if task.get('scheduled', False):
+            position = get_scheduler().position(task['task_id'])
+            if position:
+                task['status'] = 'QUEUED'
+                task['queue_position'] = position
+                task['estimated_wait'] = get_scheduler().estimated_wait(
+                    task['task_id']
+                )
+                continue
+            task['scheduled'] = False
         result = celery.AsyncResult(task['task_id'])  # pylint: disable=e1121
         task['status'] = result.status
-        if result.state == 'SUCCESS':
+        task.pop('progress', None)
+        if task.get('cancelled', False) and not result.ready():
+            # Revoked before it started, or still being killed
+            task['status'] = 'REVOKED'
+        elif result.state == 'PROGRESS':
+            task['progress'] = result.info
+        elif result.state == 'SUCCESS':
             task['results'] = result.result
-            if not task['results']['success']:
+            if task['results'].get('limit_exceeded', False):
+                task['status'] = 'SIFTER_LIMIT_EXCEEDED'
+            elif not task['results']['success']:
                 task['status'] = 'SIFTER_FAILURE'
     session['managed_tasks'] = managed_tasks
     return jsonify({'tasks': managed_tasks})
 
 
+@xsiftx_lti.route('/api/{0}/cancel_task'.format(API_VERSION),
+                  methods=['POST'])
+@lti_authentication
+def cancel_task():
+    """
+    Cancels a task of the session given by ``task_id``, revoking it
+    and killing its sifter if it's already running.
+    """
+    task_id = request.form.get('task_id', None)
+    managed_tasks = session.get('managed_tasks', [])
+    task = next(
+        (task for task in managed_tasks if task['task_id'] == task_id), None
+    )
+    if not task:
+        raise InvalidAPIUsage('You have specified an unknown task.', 404)
+    if task.get('cached', False):
+        # Nothing ran, so there is nothing to cancel
+        return get_task_status()
+    # Runs the scheduler doesn't know are left to celery alone
+    if not get_scheduler().cancel(task_id):
+        celery.control.revoke(task_id, terminate=True, signal='SIGTERM')
+    task['cancelled'] = True
+    session['managed_tasks'] = managed_tasks
+    return get_task_status()
+
+
+@xsiftx_lti.route('/api/{0}/reports'.format(API_VERSION), methods=['GET'])
+@lti_authentication
+def get_reports():
+    """
+    Lists the reports stored for the course in the LTI component,
+    newest first, optionally only those of the ``sifter`` given.
+    """
+    reports = ReportCatalog(settings[STATE_DIR[0]]).reports(
+        session['context_id'], request.args.get('sifter', None)
+    )
+    return jsonify({'reports': reports})
+
+
 @xsiftx_lti.route(
     '/api/{0}/clear_complete_tasks'.format(API_VERSION),
     methods=['DELETE'])
@@ -156,20 +382,69 @@ def clear_complete_tasks():
     return jsonify({'tasks': managed_tasks})
 
 
-@celery.task(name='xsiftx.run_sifter')
-def web_run_sifter(sifter, course, extra_args):
+def progress_reporter(task):
+    """
+    Returns a callback for the (done, total) progress of a sifter
+    that sets the state of the celery task to PROGRESS, with the done,
+    total, percent and estimated seconds left, at most once every
+    ``PROGRESS_INTERVAL`` seconds.
+    """
+    started_at = time.time()
+    last_update = [started_at]
+
+    def report(done, total):
+        """
+        Update the task state if it's been long enough
+        """
+        now = time.time()
+        if total <= 0 or now - last_update[0] < PROGRESS_INTERVAL:
+            return
+        last_update[0] = now
+        done = max(0, min(done, total))
+        estimated_left = None
+        if done:
+            estimated_left = (now - started_at) * (total - done) / done
+        task.update_state(state='PROGRESS', meta={
+            'done': done,
+            'total': total,
+            'percent': round(100.0 * done / total, 1),
+            'estimated_left': estimated_left,
+        })
+    return report
+
+
+@celery.task(name='xsiftx.run_sifter', bind=True)
+def web_run_sifter(self, sifter, course, extra_args, consumer_key=None,
+                   profile=False):
     """
-    Run the given sifter and handle errors from the internal call
+    Run the given sifter and handle errors from the internal call.
+    Runs admitted by the scheduler pass their ``consumer_key`` so
+    their slot can be handed on when they finish, or are cancelled.
     """
+    # pylint: disable=R0913
     error = u''
     success = True
+    limit_exceeded = False
+    started_at = time.time()
     try:
-        run_sifter(
-            sifter,
-            course,
-            settings[VENV[0]],
-            settings[EDX_PLATFORM[0]],
-            extra_args
+        # Revoking with terminate sends SIGTERM, which has to kill the
+        # sifter's process group too
+        with cancel_on_signal():
+            run_sifter(
+                sifter,
+                course,
+                settings[VENV[0]],
+                settings[EDX_PLATFORM[0]],
+                extra_args,
+                get_sifter_limits(get_sifter_name(sifter)),
+                state_dir=settings[STATE_DIR[0]],
+                progress=progress_reporter(self),
+                profile=profile
+            )
+        # Recorded so repeat requests can reuse the reports
+        RunHistory(settings[STATE_DIR[0]]).record(
+            get_sifter_name(sifter), extra_args, course, started_at,
+            runtime=time.time() - started_at
         )
     except XsiftxException as err:
         error = unicode(err)
@@ -177,10 +452,15 @@ def web_run_sifter(sifter, course, extra_args):
     except SifterException as err:
         error = unicode(err)
         success = False
+        limit_exceeded = isinstance(err, SifterLimitException)
+    finally:
+        if consumer_key:
+            get_scheduler().finish(self.request.id)
 
     return {
         'success': success,
-        'sifter': os.path.basename(sifter),
+        'limit_exceeded': limit_exceeded,
+        'sifter': get_sifter_name(sifter),
         'error': error,
     }
 
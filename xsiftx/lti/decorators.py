@@ -6,7 +6,7 @@ authentication, etc.
 from functools import wraps
 import logging
 
-from flask import request, session
+from flask import g, request, session
 import oauth.oauth as oauth
 
 from .oauthstore import LTIOAuthDataStore
@@ -39,6 +39,25 @@ LTI_STAFF_ROLES = ['Instructor', 'Administrator', ]
 
 LTI_SESSION_KEY = 'lti_authenticated'
 
+# OAuth server shared by every request of the process, which also
+# holds the cache of nonces it has seen
+_oauth_server = None
+
+
+def get_oauth_server():
+    """
+    Returns the process's OAuth server, creating it if needed
+    """
+    global _oauth_server  # pylint: disable=W0603
+    if _oauth_server is None:
+        server = oauth.OAuthServer(LTIOAuthDataStore())
+        server.add_signature_method(
+            oauth.OAuthSignatureMethod_PLAINTEXT())
+        server.add_signature_method(
+            oauth.OAuthSignatureMethod_HMAC_SHA1())
+        _oauth_server = server
+    return _oauth_server
+
 
 def lti_authentication(func):
     """
@@ -64,6 +83,11 @@ def lti_authentication(func):
                 not params.get('oauth_consumer_key', None)):
             return func(*args, **kwargs)
 
+        # Views calling other views verify the request once, since
+        # its nonce is spent the first time
+        if getattr(g, LTI_SESSION_KEY, False):
+            return func(*args, **kwargs)
+
         # Clear session to ensure authorization is happening fresh for
         # each lti instance.
         for prop in LTI_PROPERTY_LIST:
@@ -71,11 +95,7 @@ def lti_authentication(func):
                 del session[prop]
 
         # Try and authentication if session is being initiated
-        oauth_server = oauth.OAuthServer(LTIOAuthDataStore())
-        oauth_server.add_signature_method(
-            oauth.OAuthSignatureMethod_PLAINTEXT())
-        oauth_server.add_signature_method(
-            oauth.OAuthSignatureMethod_HMAC_SHA1())
+        oauth_server = get_oauth_server()
 
         # Check header for SSL before selecting the url
         url = request.url
@@ -95,7 +115,13 @@ def lti_authentication(func):
                                'or request')
         try:
             consumer = oauth_server._get_consumer(oauth_request)
+            # Also refuses stale timestamps and nonces already used
             oauth_server._check_signature(oauth_request, consumer, None)
+            # Only spend the nonce once the signature checks out
+            timestamp, nonce = oauth_request._get_timestamp_nonce()
+            if not oauth_server.data_store.record_nonce(consumer, nonce,
+                                                        timestamp):
+                raise oauth.OAuthError('Nonce already used: %s' % nonce)
         except oauth.OAuthError as err:
             # Rethrow our own for nice error handling (don't print
             # error message as it will contain the key
@@ -110,6 +136,7 @@ def lti_authentication(func):
 
         # Set logged in session key
         session[LTI_SESSION_KEY] = True
+        setattr(g, LTI_SESSION_KEY, True)
 
         return func(*args, **kwargs)
 
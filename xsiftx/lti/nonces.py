@@ -0,0 +1,149 @@
+"""
+Caches of the OAuth nonces seen in LTI launches, so a captured
+launch can't be replayed.
+
+A nonce only has to be remembered for as long as the timestamp sent
+with it is accepted, so entries expire ``NONCE_TTL`` seconds after
+that timestamp. Nonces are only looked up while the launch is
+checked and recorded once its signature is verified, so forged
+launches can't fill the caches. The in process cache is also
+bounded to ``NONCE_CACHE_SIZE`` entries, evicting the oldest first.
+With several web processes, the shared cache keeps nonces in SQLite
+in the state directory instead so every process on the host agrees
+on them.
+"""
+# pylint: disable=C0103
+import collections
+import sqlite3
+import threading
+import time
+
+import oauth.oauth as oauth
+
+from xsiftx.util import get_state_path
+
+# Seconds a nonce is remembered, which is how old a launch's
+# timestamp may be before it is refused anyway
+NONCE_TTL = oauth.OAuthServer.timestamp_threshold
+# Most nonces held by the in process cache
+NONCE_CACHE_SIZE = 100000
+
+NONCE_DB = 'nonces.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nonces (
+    consumer TEXT NOT NULL,
+    nonce TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (consumer, nonce)
+);
+CREATE INDEX IF NOT EXISTS nonces_expires ON nonces (expires);
+"""
+
+
+class NonceCache(object):
+    """
+    Nonces seen by this process, in the order they expire
+    """
+
+    def __init__(self, ttl=NONCE_TTL, size=NONCE_CACHE_SIZE):
+        """
+        Create an empty cache
+        """
+        self.ttl = ttl
+        self.size = size
+        self._expiries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Number of nonces held
+        """
+        return len(self._expiries)
+
+    def _purge(self, now):
+        """
+        Drop the oldest nonces that have expired
+        """
+        while self._expiries:
+            oldest, expires = next(self._expiries.iteritems())
+            if expires > now:
+                break
+            del self._expiries[oldest]
+
+    def seen(self, consumer_key, nonce):
+        """
+        Returns whether the consumer already used the nonce
+        """
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            return self._expiries.get((consumer_key, nonce), now) > now
+
+    def record(self, consumer_key, nonce, timestamp):
+        """
+        Record the nonce as used by the consumer in a launch with
+        the timestamp. Returns False if it was recorded already.
+        """
+        now = time.time()
+        key = (consumer_key, nonce)
+        with self._lock:
+            self._purge(now)
+            if self._expiries.get(key, now) > now:
+                return False
+            self._expiries.pop(key, None)
+            self._expiries[key] = int(timestamp) + self.ttl
+            if len(self._expiries) > self.size:
+                self._expiries.popitem(last=False)
+            return True
+
+
+class SharedNonceCache(object):
+    """
+    Nonces seen by any process using the same state directory
+    """
+
+    def __init__(self, state_dir, ttl=NONCE_TTL):
+        """
+        Create the nonce database if needed
+        """
+        self.ttl = ttl
+        self.db_path = get_state_path(state_dir, NONCE_DB)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def seen(self, consumer_key, nonce):
+        """
+        Returns whether the consumer already used the nonce
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            row = conn.execute(
+                'SELECT 1 FROM nonces WHERE consumer = ? AND nonce = ? '
+                'AND expires > ?', (consumer_key, nonce, time.time())
+            ).fetchone()
+            return row is not None
+        finally:
+            conn.close()
+
+    def record(self, consumer_key, nonce, timestamp):
+        """
+        Record the nonce as used by the consumer in a launch with
+        the timestamp. Returns False if it was recorded already.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                conn.execute('DELETE FROM nonces WHERE expires <= ?',
+                             (time.time(),))
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO nonces (consumer, nonce, expires) '
+                    'VALUES (?, ?, ?)',
+                    (consumer_key, nonce, int(timestamp) + self.ttl)
+                )
+                return cursor.rowcount == 1
+        finally:
+            conn.close()
@@ -6,7 +6,8 @@ import logging
 
 import oauth.oauth as oauth
 
-from xsiftx.config import settings, get_consumer
+from xsiftx.config import settings, get_consumer, STATE_DIR
+from .nonces import NonceCache, SharedNonceCache
 
 log = logging.getLogger('xsiftx')
 
@@ -22,13 +23,16 @@ class LTIOAuthDataStore(oauth.OAuthDataStore):
         Create OAuth store
         """
         oauth.OAuthDataStore.__init__(self)
-        self.consumers = settings.get('consumers', None)
+        if settings.get('shared_nonce_cache', False):
+            self.nonces = SharedNonceCache(settings[STATE_DIR[0]])
+        else:
+            self.nonces = NonceCache()
 
     def lookup_consumer(self, key):
         """
         Search through keys
         """
-        if not self.consumers:
+        if not settings.get('consumers', None):
             log.critical(("No consumers defined in settings."
                           "Have you created a configuration file?"))
             return None
@@ -51,8 +55,21 @@ class LTIOAuthDataStore(oauth.OAuthDataStore):
         return oauth.OAuthToken(None, None)  # pragma: no cover
 
     def lookup_nonce(self, oauth_consumer, oauth_token, nonce):
-        """Trust all nonces"""
-        return None  # pragma: no cover
+        """
+        Returns the nonce if the consumer already used it. It is
+        only recorded by record_nonce, once the launch is verified.
+        """
+        # pylint: disable=W0613
+        if self.nonces.seen(oauth_consumer.key, nonce):
+            return nonce
+        return None
+
+    def record_nonce(self, oauth_consumer, nonce, timestamp):
+        """
+        Record the nonce of a verified launch as used. Returns False
+        if another launch recorded it first.
+        """
+        return self.nonces.record(oauth_consumer.key, nonce, timestamp)
 
     def fetch_request_token(self, oauth_consumer, oauth_callback):
         """We don't do request_tokens"""
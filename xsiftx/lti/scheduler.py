@@ -0,0 +1,319 @@
+"""
+Per consumer admission control and fair share scheduling of
+sifter runs.
+
+Each consumer may have ``max_concurrent`` runs handed to celery at
+once, with the rest held here in a first in, first out queue that is
+at most ``max_queued`` deep. A finished run hands its slot to the next
+queued run of the same consumer, so one course team's backlog never
+sits in front of everyone else in the celery queue. State is kept in
+SQLite so every web and worker process on the host agrees on it.
+
+Slots are also released by ``reconcile``, for runs celery finished
+without telling us and for runs claimed by a process that died before
+handing them to celery.
+"""
+# pylint: disable=C0103
+import contextlib
+import json
+import logging
+import math
+import sqlite3
+import sys
+import time
+import uuid
+
+log = logging.getLogger('xsiftx')
+
+QUEUED = 'queued'
+DISPATCHED = 'dispatched'
+FINISHED = 'finished'
+
+# Number of recently finished runs used to estimate waits
+ESTIMATE_SAMPLE = 20
+# Seconds finished runs are kept around for estimates
+FINISHED_TTL = 7 * 24 * 60 * 60
+# Seconds a claimed run may take to be handed to celery before its
+# slot is released
+CLAIM_TTL = 5 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT UNIQUE NOT NULL,
+    consumer TEXT NOT NULL,
+    job TEXT NOT NULL,
+    state TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    started_at REAL,
+    dispatched_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_consumer_state ON jobs (consumer, state);
+"""
+
+
+class QueueFullException(Exception):
+    """
+    Raised when a consumer has no room left in its queue
+    """
+    def __init__(self, message, queue_depth, estimated_wait):
+        """
+        Keep the queue details for reporting back to the client
+        """
+        Exception.__init__(self, message)
+        self.queue_depth = queue_depth
+        self.estimated_wait = estimated_wait
+
+
+class ConsumerScheduler(object):
+    """
+    Decides when each consumer's sifter runs are handed to celery.
+
+    ``dispatch`` is called with a task ID and job dictionary to start
+    a run, and ``get_limits`` with a consumer key to get its
+    ``(max_concurrent, max_queued)`` limits, where None is unlimited.
+    """
+
+    def __init__(self, db_path, dispatch, get_limits):
+        """
+        Setup the database if it doesn't exist yet
+        """
+        self.db_path = db_path
+        self.dispatch = dispatch
+        self.get_limits = get_limits
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Yield a connection inside a write locked transaction
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30,
+                               isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _count(conn, consumer, state):
+        """
+        Number of the consumer's jobs in the given state
+        """
+        return conn.execute(
+            'SELECT COUNT(*) FROM jobs WHERE consumer = ? AND state = ?',
+            (consumer, state)
+        ).fetchone()[0]
+
+    def _claim(self, conn, consumer):
+        """
+        Mark as many queued jobs dispatched as the consumer has free
+        slots for, returning the ``(task_id, job)`` pairs to start.
+        """
+        max_concurrent = self.get_limits(consumer)[0]
+        free = None
+        if max_concurrent is not None:
+            free = max_concurrent - self._count(conn, consumer, DISPATCHED)
+            if free <= 0:
+                return []
+        rows = conn.execute(
+            'SELECT task_id, job FROM jobs WHERE consumer = ? AND state = ? '
+            'ORDER BY seq LIMIT ?',
+            (consumer, QUEUED, -1 if free is None else free)
+        ).fetchall()
+        now = time.time()
+        for task_id, _ in rows:
+            conn.execute(
+                'UPDATE jobs SET state = ?, started_at = ? WHERE task_id = ?',
+                (DISPATCHED, now, task_id)
+            )
+        return [(task_id, json.loads(job)) for task_id, job in rows]
+
+    def _start(self, claimed):
+        """
+        Hand claimed jobs to celery. The slot of any that couldn't be
+        sent goes to the next queued job, and the first error is
+        raised once all of them are handled.
+        """
+        claimed = list(claimed)
+        error = None
+        while claimed:
+            task_id, job = claimed.pop(0)
+            try:
+                self.dispatch(task_id, job)
+            except Exception:  # pylint: disable=W0703
+                log.exception('Failed to dispatch queued task %s', task_id)
+                error = error or sys.exc_info()
+                with self._transaction() as conn:
+                    claimed.extend(self._finish(conn, task_id))
+                continue
+            with self._transaction() as conn:
+                conn.execute(
+                    'UPDATE jobs SET dispatched_at = ? '
+                    'WHERE task_id = ? AND state = ?',
+                    (time.time(), task_id, DISPATCHED)
+                )
+        if error:
+            raise error[0], error[1], error[2]
+
+    def _estimate(self, conn, consumer, position):
+        """
+        Estimated seconds until the job at ``position`` in the
+        consumer's queue starts, or None without any history.
+        """
+        durations = [row[0] for row in conn.execute(
+            'SELECT finished_at - started_at FROM jobs '
+            'WHERE consumer = ? AND state = ? AND started_at IS NOT NULL '
+            'ORDER BY finished_at DESC LIMIT ?',
+            (consumer, FINISHED, ESTIMATE_SAMPLE)
+        )]
+        if not durations:
+            return None
+        max_concurrent = self.get_limits(consumer)[0] or 1
+        average = sum(durations) / len(durations)
+        return int(math.ceil(float(position) / max_concurrent) * average)
+
+    def submit(self, consumer, job, is_finished=None):
+        """
+        Admit a job for the consumer, starting it right away if it
+        has a free slot. Returns the task ID assigned to the job and
+        its position in the consumer's queue, 0 if it was started.
+
+        ``is_finished`` is an optional callable used to release the
+        slots of dispatched tasks that finished without telling us,
+        like those of a worker that died.
+
+        Raises QueueFullException if the consumer's queue is full.
+        """
+        if is_finished:
+            self.reconcile(consumer, is_finished)
+        task_id = str(uuid.uuid4())
+        max_queued = self.get_limits(consumer)[1]
+        with self._transaction() as conn:
+            queued = self._count(conn, consumer, QUEUED)
+            if max_queued is not None and queued >= max_queued:
+                raise QueueFullException(
+                    'There are already {0} runs queued for this course, '
+                    'which is the most allowed. Please try again '
+                    'later.'.format(queued),
+                    queued,
+                    self._estimate(conn, consumer, queued + 1)
+                )
+            conn.execute(
+                'INSERT INTO jobs (task_id, consumer, job, state, queued_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (task_id, consumer, json.dumps(job), QUEUED, time.time())
+            )
+            claimed = self._claim(conn, consumer)
+        self._start(claimed)
+        return task_id, self.position(task_id)
+
+    def _finish(self, conn, task_id):
+        """
+        Record the end of a run, returning the next queued runs of
+        its consumer claimed in its place.
+        """
+        row = conn.execute(
+            'SELECT consumer FROM jobs WHERE task_id = ?', (task_id,)
+        ).fetchone()
+        if not row:
+            return []
+        now = time.time()
+        conn.execute(
+            'UPDATE jobs SET state = ?, finished_at = ? WHERE task_id = ?',
+            (FINISHED, now, task_id)
+        )
+        conn.execute(
+            'DELETE FROM jobs WHERE state = ? AND finished_at < ?',
+            (FINISHED, now - FINISHED_TTL)
+        )
+        return self._claim(conn, row[0])
+
+    def finish(self, task_id):
+        """
+        Record the end of a run and start the next queued runs of
+        its consumer.
+        """
+        with self._transaction() as conn:
+            claimed = self._finish(conn, task_id)
+        self._start(claimed)
+
+    def cancel(self, task_id):
+        """
+        Drop the task from its consumer's queue, or if it was already
+        handed to celery finish it so its slot goes to the next run.
+        Returns whether the task was still queued.
+        """
+        with self._transaction() as conn:
+            queued = conn.execute(
+                'DELETE FROM jobs WHERE task_id = ? AND state = ?',
+                (task_id, QUEUED)
+            ).rowcount
+        if not queued:
+            self.finish(task_id)
+        return bool(queued)
+
+    def reconcile(self, consumer, is_finished):
+        """
+        Finish any dispatched tasks of the consumer for which
+        ``is_finished(task_id)`` is true, and any claimed over
+        ``CLAIM_TTL`` seconds ago that never made it to celery.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT task_id, started_at, dispatched_at FROM jobs '
+                'WHERE consumer = ? AND state = ?',
+                (consumer, DISPATCHED)
+            ).fetchall()
+        expired = time.time() - CLAIM_TTL
+        for task_id, started_at, dispatched_at in rows:
+            if dispatched_at is None:
+                if started_at < expired:
+                    log.warning('Releasing task %s, which was never '
+                                'dispatched', task_id)
+                    self.finish(task_id)
+            elif is_finished(task_id):
+                self.finish(task_id)
+
+    def position(self, task_id):
+        """
+        Position of the task in its consumer's queue, starting at 1,
+        or 0 if it isn't waiting.
+        """
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT consumer, seq, state FROM jobs WHERE task_id = ?',
+                (task_id,)
+            ).fetchone()
+            if not row or row[2] != QUEUED:
+                return 0
+            return conn.execute(
+                'SELECT COUNT(*) FROM jobs '
+                'WHERE consumer = ? AND state = ? AND seq <= ?',
+                (row[0], QUEUED, row[1])
+            ).fetchone()[0]
+
+    def estimated_wait(self, task_id):
+        """
+        Estimated seconds until the queued task starts, or None
+        if it isn't queued or there is no history to go by.
+        """
+        position = self.position(task_id)
+        if not position:
+            return None
+        with self._transaction() as conn:
+            consumer = conn.execute(
+                'SELECT consumer FROM jobs WHERE task_id = ?', (task_id,)
+            ).fetchone()[0]
+            return self._estimate(conn, consumer, position)
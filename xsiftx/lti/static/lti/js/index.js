@@ -1,3 +1,7 @@
+var FAILURE_STATUSES = ['SIFTER_FAILURE', 'SIFTER_LIMIT_EXCEEDED'];
+var FINISHED_STATUSES = ['SUCCESS', 'FAILURE', 'REVOKED', 'SIFTER_FAILURE',
+						 'SIFTER_LIMIT_EXCEEDED', 'CACHED'];
+
 function update_task_list(response) {
   // Replace task list table with most updated version
   var table = ''
@@ -5,19 +9,41 @@ function update_task_list(response) {
 	  var task = response.tasks[i]
 	  table += '<tr id="tr-' + task.task_id + '"><td>' + task.sifter + '</td><td>' +
 		  task.course + '</td><td>' + task.time + '</td><td>' + task.task_id + '</td>';
-	  if(task.status == 'SIFTER_FAILURE') {
+	  if($.inArray(task.status, FAILURE_STATUSES) != -1) {
 		  table += '<td><a href="#" id="a-' + task.task_id + '" class="failure_output">' +
 			  task.status.toLowerCase() + '</td>';
+	  } else if(task.status == 'QUEUED') {
+		  var queued = 'queued (#' + task.queue_position
+		  if(task.estimated_wait != null) {
+			  queued += ', about ' + Math.ceil(task.estimated_wait / 60) + ' min'
+		  }
+		  table += '<td>' + queued + ')</td>'
+	  } else if(task.status == 'CACHED') {
+		  var finished = new Date(task.results.finished_at * 1000)
+		  table += '<td title="Run again with Force refresh to replace it">' +
+			  'reused run from ' + finished.toLocaleString() + '</td>'
+	  } else if(task.status == 'PROGRESS' && task.progress) {
+		  var progress = 'running ' + task.progress.percent + '%'
+		  if(task.progress.estimated_left != null) {
+			  progress += ', about ' + Math.ceil(task.progress.estimated_left / 60) + ' min left'
+		  }
+		  table += '<td>' + progress + '</td>'
 	  } else {
 		  table += '<td>' + task.status.toLowerCase() + '</td>'
 	  }
+	  if($.inArray(task.status, FINISHED_STATUSES) == -1) {
+		  table += '<td><button type="button" class="task-cancel pure-button" ' +
+			  'data-task="' + task.task_id + '">Cancel</button></td>';
+	  } else {
+		  table += '<td></td>';
+	  }
 	  table += '</tr>'
 
   }
   $('#tasks-table tbody').hide().html(table).fadeIn(300, function() {
 	  for(var i=0; i < response.tasks.length; i++) {
 		  var task = response.tasks[i]
-		  if(task.status == 'SIFTER_FAILURE') {
+		  if($.inArray(task.status, FAILURE_STATUSES) != -1) {
 			  // Highlight row
 			  $('#tr-' + task.task_id).animate( { backgroundColor: '#ffcece' }, 500);
 			  // Now create dialog click handlers
@@ -48,7 +74,9 @@ $(document).ready(function() {
 		  type: 'POST',
 		  url: RUN_URL,
 		  data: { sifter: sifter_name,
-				  extra_args: $('#' + sifter_name + '-extra-args').val()
+				  extra_args: $('#' + sifter_name + '-extra-args').val(),
+				  force_refresh: $('#' + sifter_name + '-force-refresh').is(':checked'),
+				  profile: $('#' + sifter_name + '-profile').is(':checked')
 				},
 		  dataType: 'json',
 		  success: function(response) {
@@ -63,6 +91,25 @@ $(document).ready(function() {
 	  });
   });
 
+  // Click handler for cancelling a task
+  $('#tasks-table').on('click', 'button.task-cancel', function() {
+	  $.ajax({
+		  type: 'POST',
+		  url: CANCEL_TASK_URL,
+		  data: { task_id: $(this).data('task') },
+		  dataType: 'json',
+		  success: function(response) {
+			  update_task_list(response)
+		  },
+		  error: function(request, status, error) {
+			  var json = $.parseJSON(request.responseText);
+			  $('div#run-error').html('Something has gone wrong with \
+				 this request.  The server replied with a status of: '
+				 + error + ' - ' + json.message);
+		  }
+	  });
+  });
+
   // Click handler for updating status
   $('button#update-status').click(function() {
 	  $.ajax({
@@ -0,0 +1,101 @@
+"""
+Pipelined storing of sifter output, so the next sifter can run while
+the reports of the last one are uploaded.
+
+Finished sifter outputs are handed to a bounded upload stage running
+on its own threads. The stage holds at most ``max_spool`` bytes of
+spooled reports at once, and ``submit`` blocks until enough of them
+have been stored to make room, which keeps temporary space in check
+when sifting outpaces uploading. Nothing here depends on the process
+it runs in, so it works the same from the command line or a worker.
+"""
+import logging
+import Queue
+import threading
+
+log = logging.getLogger('xsiftx')  # pylint: disable=C0103
+
+# Default bytes of spooled reports waiting to be stored
+MAX_SPOOL = 1024 * 1024 * 1024
+
+
+class UploadPipeline(object):
+    """
+    Stores sifter outputs on background threads. Outputs are
+    submitted with a context object, and handed back with it and
+    the error storing them raised, if any, by ``finished``.
+    """
+
+    def __init__(self, data_store, max_spool=MAX_SPOOL, threads=1):
+        """
+        Start the upload threads
+        """
+        self.data_store = data_store
+        self.max_spool = max_spool
+        self.spooled = 0
+        self._room = threading.Condition()
+        self._uploads = Queue.Queue()
+        self._finished = Queue.Queue()
+        self._threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self._upload)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _upload(self):
+        """
+        Store queued outputs until told to stop with None
+        """
+        while True:
+            item = self._uploads.get()
+            if item is None:
+                break
+            output, context = item
+            error = None
+            try:
+                output.store(self.data_store)
+            except Exception as err:  # pylint: disable=W0703
+                log.exception('Failed to store output of %s', output.course)
+                error = err
+            finally:
+                output.close()
+                with self._room:
+                    self.spooled -= output.size
+                    self._room.notify_all()
+            self._finished.put((context, error))
+
+    def submit(self, output, context=None):
+        """
+        Queue the output to be stored, waiting for room in the spool
+        budget first. An output bigger than the whole budget is let
+        through once nothing else is spooled.
+        """
+        with self._room:
+            while self.spooled and self.spooled + output.size > self.max_spool:
+                self._room.wait()
+            self.spooled += output.size
+        self._uploads.put((output, context))
+
+    def finished(self):
+        """
+        Return the (context, error) pairs of outputs stored since the
+        last call, where error is None if storing succeeded.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._finished.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def close(self):
+        """
+        Wait for every submitted output to be stored and stop the
+        upload threads, returning the last of the finished results.
+        """
+        for _ in self._threads:
+            self._uploads.put(None)
+        for thread in self._threads:
+            thread.join()
+        return self.finished()
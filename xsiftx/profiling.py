@@ -0,0 +1,169 @@
+"""
+Profiling of Python sifters.
+
+A sifter run with ``--profile`` is profiled with cProfile, whose
+stats are saved for ``pstats`` or snakeviz, and its stack is sampled
+every ``SAMPLE_INTERVAL`` seconds into collapsed stacks, one
+``frame;frame;... count`` line per stack, for flamegraph.pl or
+speedscope. Both are stored next to the sifter's report.
+
+Python script sifters are run through this module, as ``python -m
+xsiftx.profiling <profile dir> <script> [args]``, and in process
+sifters within a ``Profiler``. Nothing is profiled otherwise.
+"""
+import collections
+import cProfile
+import os
+import runpy
+import sys
+import threading
+import time
+
+# Seconds between samples of the sifter's stack
+SAMPLE_INTERVAL = 0.005
+
+PSTATS_FILE = 'profile.pstats'
+COLLAPSED_FILE = 'profile.collapsed.txt'
+# Extensions the profile files are stored with
+PROFILE_EXTENSIONS = [
+    (PSTATS_FILE, '.pstats'),
+    (COLLAPSED_FILE, '.collapsed.txt'),
+]
+
+
+def _frame_name(frame):
+    """
+    Returns the name of a frame in a collapsed stack
+    """
+    return '{0}:{1}'.format(os.path.basename(frame.f_code.co_filename),
+                            frame.f_code.co_name)
+
+
+class StackSampler(object):
+    """
+    Counts the stacks of a thread, sampled from another thread
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        """
+        Sample the thread with the id every interval seconds
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        """
+        Count the thread's stack until stopped
+        """
+        # pylint: disable=W0212
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id, None)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """
+        Start sampling
+        """
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and wait for the last sample
+        """
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        """
+        Write the stacks sampled as collapsed stacks
+        """
+        with open(path, 'w') as collapsed:
+            for stack, count in sorted(self.stacks.items()):
+                collapsed.write('{0} {1}\n'.format(stack, count))
+
+
+class Profiler(object):
+    """
+    Profiles the code run in its context on the current thread
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """
+        Set up the profiler and sampler of the current thread
+        """
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.current_thread().ident,
+                                    interval)
+
+    def __enter__(self):
+        """
+        Start profiling
+        """
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        """
+        Stop profiling
+        """
+        self.profile.disable()
+        self.sampler.stop()
+
+    def save(self, profile_dir):
+        """
+        Write the profile and collapsed stacks into the directory
+        """
+        self.profile.dump_stats(os.path.join(profile_dir, PSTATS_FILE))
+        self.sampler.write(os.path.join(profile_dir, COLLAPSED_FILE))
+
+
+def profile_outputs(profile_dir, sifter_name):
+    """
+    Returns the (filename, path) pairs of the profile files saved in
+    the directory, named after the sifter and the time to be stored
+    next to its report.
+    """
+    stem = '{0}_profile_{1}'.format(
+        sifter_name, time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    )
+    return [
+        (stem + extension, os.path.join(profile_dir, filename))
+        for filename, extension in PROFILE_EXTENSIONS
+        if os.path.isfile(os.path.join(profile_dir, filename))
+    ]
+
+
+def main(argv=None):
+    """
+    Run a Python script sifter as __main__ under the profiler, saving
+    the profile into the directory given before it even if it fails.
+    """
+    argv = argv or sys.argv
+    if len(argv) < 3:
+        sys.stderr.write('Usage: python -m xsiftx.profiling PROFILE_DIR '
+                         'SCRIPT [ARG ...]\n')
+        sys.exit(2)
+    profile_dir, script = argv[1], argv[2]
+    sys.argv = argv[2:]
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    profiler = Profiler()
+    try:
+        with profiler:
+            runpy.run_path(script, run_name='__main__')
+    finally:
+        profiler.save(profile_dir)
+
+
+if __name__ == '__main__':
+    main()
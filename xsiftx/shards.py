@@ -0,0 +1,60 @@
+"""
+Splitting course sweeps between hosts.
+
+``--shard i/N`` picks the courses of shard i out of N, numbered from
+1. Courses are assigned with rendezvous hashing on the course ID, so
+every host agrees on the split without talking to the others, each
+course is in exactly one shard, and changing N only moves the courses
+of the shards added or removed.
+"""
+import fnmatch
+import hashlib
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as i/N into a tuple of (i, N), raising a
+    ValueError if it isn't one.
+    """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError('Shards are given as i/N, e.g. 1/3')
+    if not 1 <= index <= count:
+        raise ValueError('Shard {0} is not between 1 and {1}'.format(
+            index, count
+        ))
+    return index, count
+
+
+def shard_for(course, count):
+    """
+    Returns the shard, from 1 to count, the course belongs to
+    """
+    weights = [
+        hashlib.md5('{0}:{1}'.format(shard, course)).hexdigest()
+        for shard in range(1, count + 1)
+    ]
+    return weights.index(max(weights)) + 1
+
+
+def select_courses(courses, shard=None, include=None, exclude=None):
+    """
+    Returns the courses in the (i, N) shard that match any of the
+    include patterns and none of the exclude patterns, which are shell
+    style wildcards like ``MITx/*``.
+    """
+    selected = []
+    for course in courses:
+        if include and not any(
+                fnmatch.fnmatchcase(course, pattern) for pattern in include
+        ):
+            continue
+        if exclude and any(
+                fnmatch.fnmatchcase(course, pattern) for pattern in exclude
+        ):
+            continue
+        if shard and shard_for(course, shard[1]) != shard[0]:
+            continue
+        selected.append(course)
+    return selected
@@ -6,8 +6,26 @@ The expectations of sifters are that the first line output
 is the filename to use, and everything else on stdout is
 the file to upload to the dashboard.
 
+To write several files, write them to the directory in the
+XSIFTX_OUTPUT_DIR environment variable and output the line
+xsiftx-output-manifest followed by their names, one per line.
+
 You can write to stderr without consequence if neccessary,
 and returning anything but 0 will cause the upload to be
 aborted. Command is run with the following arguments:
 <sifter> edx_venv_path edx_platform_path course_id [extra_arg, extra_arg,....]
+
+A sifter can optionally describe itself with a YAML manifest next to
+it, named after the sifter with .yml added (e.g. copy_file.yml):
+
+description: Copy a local file into the course's data downloads
+cost_class: light
+arguments:
+  - name: file
+    help: Path of the file to copy
+    required: true
+output_type: text/plain
+
+The cost_class is used by the LTI application to route runs to the
+celery queue configured for it in sifter_queues.
 """
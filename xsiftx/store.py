@@ -2,21 +2,213 @@
 This handles file uploads and hashing for placing the
 file on s3 using the edX platform settings
 """
+import errno
 import hashlib
+import logging
 import mimetypes
 import os
+import shutil
+import threading
 import urllib
+import uuid
+from multiprocessing.pool import ThreadPool
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+# boto is imported by S3Store when it's used, so runs writing to the
+# file system don't pay for loading it.
 
+log = logging.getLogger('xsiftx')  # pylint: disable=C0103
 
-class FSStore(object):
+# Number of files of a set stored at the same time
+STORE_THREADS = 8
+# Bytes read at a time when hashing a stored file
+HASH_CHUNK_SIZE = 1024 * 1024
+# Prefix under the S3 root path that files are staged in until the
+# whole set is published
+S3_STAGING_PREFIX = '.xsiftx-tmp'
+
+
+def file_digest(path):
+    """
+    Returns the size and SHA-256 hex digest of the file at path
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class BaseStore(object):
+    """
+    Storing of a set of files, which are staged in parallel and then
+    published together, or discarded if any of them fail.
+
+    If ``catalog`` is set to a ``ReportCatalog``, every stored file
+    is recorded in it.
+
+    Files are hashed as they're stored, and a file with the same
+    content as one the store already wrote is copied from it with
+    ``copy`` instead of being written again, so sending the same file
+    to every course only uploads it once.
+
+    Sets are stored on a pool of threads kept until ``close``, so
+    their connections are reused from one set to the next.
+    """
+
+    catalog = None
+
+    def __init__(self):
+        """
+        Start without any stored content to copy from
+        """
+        self._copies = {}
+        self._copies_lock = threading.Lock()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """
+        Threads storing the files of a set, started when first needed
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(STORE_THREADS)
+            return self._pool
+
+    def close(self):
+        """
+        Stop the store's threads
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def location_for(self, course_id, filename):
+        """
+        Returns where the file is stored, as recorded in the catalog
+        """
+        raise NotImplementedError
+
+    def _record(self, course_id, filename, sifter, size, digest):
+        """
+        Add a stored file to the catalog. The file is already stored
+        by now, so failing to catalog it is logged rather than raised.
+        """
+        # pylint: disable=R0913
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.record(course_id, filename, sifter, size, digest,
+                                self.location_for(course_id, filename))
+        except Exception:  # pylint: disable=W0703
+            log.exception('Failed to catalog %s for %s', filename, course_id)
+
+    def _stage_copy(self, digest, course_id, filename):
+        """
+        Stage a copy of a file stored earlier with the content of the
+        digest, or return None if there is none or copying fails.
+        """
+        with self._copies_lock:
+            source = self._copies.get(digest, None)
+        if source is None:
+            return None
+        try:
+            return self.copy(source, course_id, filename)
+        except Exception:  # pylint: disable=W0703
+            log.warning('Failed to copy %s for %s from %s, storing it '
+                        'instead', filename, course_id, source,
+                        exc_info=True)
+            return None
+
+    def _stored(self, digest, course_id, filename):
+        """
+        Remember a published file as the one to copy its content from
+        """
+        location = (course_id, filename)
+        with self._copies_lock:
+            for stale in [
+                    key for key, value in self._copies.items()
+                    if value == location
+            ]:
+                del self._copies[stale]
+            self._copies[digest] = location
+
+    def _stage_hashed(self, course_id, filename, path):
+        """
+        Hash the file and stage it, copying a file with the same
+        content if there is one.
+        """
+        size, digest = file_digest(path)
+        staged = self._stage_copy(digest, course_id, filename)
+        if staged is None:
+            staged = self.stage(course_id, filename, path)
+        return staged, (size, digest)
+
+    def copy(self, source, course_id, filename):
+        """
+        Stage a copy of the published (course_id, filename) source and
+        return a reference to it like ``stage``.
+        """
+        raise NotImplementedError
+
+    def stage(self, course_id, filename, path):
+        """
+        Store the file at path so it can be published later and
+        return a reference to it for publish and discard.
+        """
+        raise NotImplementedError
+
+    def publish(self, staged):
+        """
+        Make a staged file visible
+        """
+        pass
+
+    def discard(self, staged):
+        """
+        Remove a staged file
+        """
+        raise NotImplementedError
+
+    def store_many(self, course_id, outputs, sifter=None):
+        """
+        Store a list of (filename, path) outputs for the course.
+        Either all of them are published or, if any fail, none are.
+        """
+        results = [
+            self.pool.apply_async(self._stage_hashed,
+                                  (course_id, filename, path))
+            for filename, path in outputs
+        ]
+        staged = []
+        error = None
+        for result in results:
+            try:
+                staged.append(result.get())
+            except Exception as err:  # pylint: disable=W0703
+                error = error or err
+        if error:
+            for item, _ in staged:
+                self.discard(item)
+            raise error
+        self.pool.map(self.publish, [item for item, _ in staged])
+        for (filename, _), (_, (size, digest)) in zip(outputs, staged):
+            self._stored(digest, course_id, filename)
+            self._record(course_id, filename, sifter, size, digest)
+
+
+class FSStore(BaseStore):
     """
     This writes out the file to a local path
     """
 
     def __init__(self, settings):
+        super(FSStore, self).__init__()
         self.root_path = settings['root_path']
 
     def path_for(self, course_id, filename):
@@ -27,39 +219,130 @@ class FSStore(object):
                             urllib.quote(course_id, safe=''),
                             filename)
 
-    def store(self, course_id, filename, srcfile):
+    def location_for(self, course_id, filename):
         """
-        Actually writes out the file from wherever srcfile has been
-        seeked to.
+        Files are located by their path
+        """
+        return self.path_for(course_id, filename)
+
+    @staticmethod
+    def _make_dirs(full_path):
+        """
+        Create the directory the file goes in if it's missing
         """
-        full_path = self.path_for(course_id, filename)
         directory = os.path.dirname(full_path)
-        if not os.path.exists(directory):
+        try:
             os.makedirs(directory, 0o755)
-        with open(full_path, "wb") as output_file:
-            output_file.write(srcfile.read())
+        except OSError:
+            # Fine if another thread or process beat us to it
+            if not os.path.isdir(directory):
+                raise
+
+    def _temp_path_for(self, course_id, filename):
+        """
+        Returns the hidden temporary path a file is staged at and the
+        path it's published to. A temporary file left behind is
+        removed, since it may be a link to a published file.
+        """
+        full_path = self.path_for(course_id, filename)
+        self._make_dirs(full_path)
+        directory, basename = os.path.split(full_path)
+        temp_path = os.path.join(directory, '.{0}.xsiftx-tmp'.format(basename))
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        return temp_path, full_path
+
+    def store(self, course_id, filename, srcfile, sifter=None):
+        """
+        Actually writes out the file from wherever srcfile has been
+        seeked to.
+        """
+        data = srcfile.read()
+        digest = hashlib.sha256(data).hexdigest()
+        staged = self._stage_copy(digest, course_id, filename)
+        if staged is None:
+            staged = self._temp_path_for(course_id, filename)
+            with open(staged[0], "wb") as output_file:
+                output_file.write(data)
+        self.publish(staged)
+        self._stored(digest, course_id, filename)
+        self._record(course_id, filename, sifter, len(data), digest)
 
+    def stage(self, course_id, filename, path):
+        """
+        Copy the file to a hidden temporary name next to where
+        it will be published.
+        """
+        staged = self._temp_path_for(course_id, filename)
+        shutil.copyfile(path, staged[0])
+        return staged
+
+    def copy(self, source, course_id, filename):
+        """
+        Hard link the source file to the temporary name, which is
+        safe to share since files are only ever replaced by renaming,
+        or copy it if it's on another file system.
+        """
+        staged = self._temp_path_for(course_id, filename)
+        try:
+            os.link(self.path_for(*source), staged[0])
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(self.path_for(*source), staged[0])
+        return staged
+
+    def publish(self, staged):
+        """
+        Rename the file into place
+        """
+        os.rename(*staged)
 
-class S3Store(object):
+    def discard(self, staged):
+        """
+        Remove the temporary file
+        """
+        os.remove(staged[0])
+
+
+class S3Store(BaseStore):
     """
     This manages the connection and uploading of files
-    generated by the sifter
+    generated by the sifter. Files of a set are uploaded under
+    ``S3_STAGING_PREFIX`` and copied into place within S3 once all of
+    them are, so a failed set leaves the published files alone.
     """
 
     def __init__(self, settings):
+        super(S3Store, self).__init__()
         self.root_path = settings['root_path']
+        self.settings = settings
+        self._local = threading.local()
+        # Connect right away to fail early on bad settings
+        self.bucket  # pylint: disable=W0104
 
-        conn = S3Connection(
-            settings['aws_key_id'],
-            settings['aws_key']
-        )
-        self.bucket = conn.get_bucket(settings['bucket'])
+    @property
+    def bucket(self):
+        """
+        Bucket to store into, with a connection per thread
+        """
+        if not hasattr(self._local, 'bucket'):
+            from boto.s3.connection import S3Connection
+
+            conn = S3Connection(
+                self.settings['aws_key_id'],
+                self.settings['aws_key']
+            )
+            self._local.bucket = conn.get_bucket(self.settings['bucket'])
+        return self._local.bucket
 
     def key_for(self, course_id, filename):
         """
         Return the S3 key we would use to store and retrive the data for the
         given filename.
         """
+        from boto.s3.key import Key
+
         hashed_course_id = hashlib.sha1(course_id)
 
         key = Key(self.bucket)
@@ -70,17 +353,100 @@ class S3Store(object):
         )
         return key
 
-    def store(self, course_id, filename, srcfile):
+    def location_for(self, course_id, filename):
         """
-        This actually stores the file into s3
+        Files are located by their S3 URL
         """
+        return 's3://{0}/{1}'.format(
+            self.settings['bucket'], self.key_for(course_id, filename).key
+        )
 
+    def _key_with_type(self, course_id, filename):
+        """
+        Return the key for the file with its content type set
+        """
         key = self.key_for(course_id, filename)
+        type_guess = mimetypes.guess_type(filename)
+        key.content_type = type_guess[0]
+        key.content_encoding = type_guess[1]
+        return key
+
+    def _staging_key(self, filename):
+        """
+        Return a new key under the staging prefix for the file, with
+        its content type set
+        """
+        from boto.s3.key import Key
 
+        key = Key(self.bucket)
+        key.key = '{0}/{1}/{2}/{3}'.format(
+            self.root_path, S3_STAGING_PREFIX, uuid.uuid4().hex, filename
+        )
         type_guess = mimetypes.guess_type(filename)
-        data = srcfile.read()
-        key.size = len(data)
         key.content_type = type_guess[0]
         key.content_encoding = type_guess[1]
+        return key
+
+    def _copy_key(self, source_name, key):
+        """
+        Copy the key named source_name to key within S3 without
+        downloading it, with the content type of key.
+        """
+        headers = {}
+        if key.content_type:
+            headers['Content-Type'] = key.content_type
+        if key.content_encoding:
+            headers['Content-Encoding'] = key.content_encoding
+        self.bucket.copy_key(
+            key.key, self.settings['bucket'], source_name,
+            metadata={}, headers=headers
+        )
+
+    def store(self, course_id, filename, srcfile, sifter=None):
+        """
+        This actually stores the file into s3
+        """
+
+        data = srcfile.read()
+        digest = hashlib.sha256(data).hexdigest()
+        staged = self._stage_copy(digest, course_id, filename)
+        if staged is None:
+            key = self._key_with_type(course_id, filename)
+            key.size = len(data)
+            key.set_contents_from_string(data)
+        else:
+            self.publish(staged)
+        self._stored(digest, course_id, filename)
+        self._record(course_id, filename, sifter, len(data), digest)
 
-        key.set_contents_from_string(data)
+    def stage(self, course_id, filename, path):
+        """
+        Upload the file under the staging prefix, returning the
+        staging key name and the key to publish it to.
+        """
+        key = self._staging_key(filename)
+        key.set_contents_from_filename(path)
+        return key.key, self._key_with_type(course_id, filename)
+
+    def copy(self, source, course_id, filename):
+        """
+        Stage a copy of the source key within S3 without downloading
+        it, like ``stage``.
+        """
+        key = self._staging_key(filename)
+        self._copy_key(self.key_for(*source).key, key)
+        return key.key, self._key_with_type(course_id, filename)
+
+    def publish(self, staged):
+        """
+        Copy the staged file into place and delete it
+        """
+        staging_name, key = staged
+        self._copy_key(staging_name, key)
+        self.bucket.delete_key(staging_name)
+
+    def discard(self, staged):
+        """
+        Delete the staged file, leaving any published one alone
+        """
+        self.bucket.delete_key(staged[0])
@@ -2,14 +2,22 @@
 Unit tests for xisftx command line interface
 """
 import os
+import subprocess
 import sys
 import unittest
+from StringIO import StringIO
 
 from mock import patch
 
 from .util import nostderr, mkdtemp_clean
+import xsiftx
+import xsiftx.config
+from xsiftx.catalog import ReportCatalog
 from xsiftx.command_line import execute
-from xsiftx.util import XsiftxException, get_course_list
+from xsiftx.history import RunHistory
+from xsiftx.journal import RunJournal
+from xsiftx.shards import parse_shard, select_courses, shard_for
+from xsiftx.util import XsiftxException, SifterException, get_course_list
 
 
 class TestCommandLine(unittest.TestCase):
@@ -148,3 +156,337 @@ class TestCommandLine(unittest.TestCase):
                         'test_sifters', ]
             execute()
             self.assertTrue(mock_settings.called)
+
+    @patch('xsiftx.command_line.get_data_store')
+    @patch('xsiftx.command_line.sift')
+    @patch('xsiftx.command_line.get_course_list')
+    def test_resume(self, mock_courses, mock_run, _):
+        """
+        Make sure a resumed run only retries failed and pending courses
+        """
+        state_dir = mkdtemp_clean(self)
+        courses = ['org/course/{0}'.format(i) for i in range(4)]
+        mock_courses.return_value = courses
+
+        def die_at_third(_, course, *args):
+            """
+            Fail the second course and die on the third
+            """
+            # pylint: disable=W0613
+            if course == courses[1]:
+                raise SifterException('failed')
+            if course == courses[2]:
+                raise KeyboardInterrupt()
+        mock_run.return_value = None
+        mock_run.side_effect = die_at_third
+
+        base_argv = ['xsiftx', '--state-dir', state_dir]
+        sys.argv = base_argv + ['--run-id', 'sweep', 'test_sifters', 'arg']
+        with nostderr():
+            with self.assertRaises(KeyboardInterrupt):
+                execute()
+        journal = RunJournal.load(state_dir, 'sweep')
+        self.assertEqual(journal.succeeded(), set([courses[0]]))
+        self.assertEqual(journal.summary(), {'success': 1, 'failure': 1})
+
+        # Same run ID can't be reused for a new run
+        with self.assertRaisesRegexp(XsiftxException, 'already exists'):
+            execute()
+
+        mock_run.reset_mock()
+        mock_run.side_effect = None
+        sys.argv = base_argv + ['--resume', 'sweep', 'test_sifters']
+        with nostderr():
+            execute()
+        self.assertEqual([call[0][1] for call in mock_run.call_args_list],
+                         courses[1:])
+        self.assertEqual(mock_run.call_args[0][4], ['arg'])
+        self.assertEqual(
+            RunJournal.load(state_dir, 'sweep').succeeded(), set(courses)
+        )
+
+        # Resuming with the wrong sifter is refused
+        sys.argv = base_argv + ['--resume', 'sweep', 'copy_file']
+        with nostderr():
+            with self.assertRaises(SystemExit) as exception_context:
+                execute()
+        self.assertEqual(exception_context.exception.code, -3)
+
+    @patch('xsiftx.command_line.get_data_store')
+    @patch('xsiftx.command_line.sift')
+    @patch('xsiftx.command_line.get_course_list')
+    def test_configured_limits(self, mock_courses, mock_run, _):
+        """
+        Make sure the configured sifter_limits apply to command line
+        runs, with its options overriding them.
+        """
+        mock_courses.return_value = ['org/course/0']
+        mock_run.return_value = None
+        sifter_limits = {'default': {'timeout': 60, 'nice': 10},
+                         'test_sifters': {'max_memory': 1024}}
+        sys.argv = ['xsiftx', '--state-dir', mkdtemp_clean(self),
+                    '--timeout', '30', 'test_sifters']
+        with patch.dict(xsiftx.config.settings,
+                        {'sifter_limits': sifter_limits}):
+            with nostderr():
+                execute()
+        self.assertEqual(mock_run.call_args[0][5],
+                         {'timeout': 30, 'nice': 10, 'max_memory': 1024})
+
+    @patch('xsiftx.command_line.get_data_store')
+    @patch('xsiftx.command_line.get_course_activity')
+    @patch('xsiftx.command_line.sift')
+    @patch('xsiftx.command_line.get_course_list')
+    def test_incremental(self, mock_courses, mock_run, mock_activity, _):
+        """
+        Make sure incremental sweeps pass the last run time and skip
+        courses whose activity hasn't moved.
+        """
+        state_dir = mkdtemp_clean(self)
+        courses = ['org/course/{0}'.format(i) for i in range(3)]
+        mock_courses.return_value = courses
+        mock_run.return_value = None
+        mock_activity.return_value = {
+            courses[0]: '2014-01-01T00:00:00',
+            courses[1]: '2014-01-02T00:00:00',
+        }
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--incremental',
+                    '--skip-unchanged', 'test_sifters']
+
+        with nostderr():
+            execute()
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertEqual([call[0][6] for call in mock_run.call_args_list],
+                         [None, None, None])
+
+        # Only the course with new activity is run again
+        mock_run.reset_mock()
+        mock_activity.return_value[courses[1]] = '2014-02-01T00:00:00'
+        with nostderr():
+            execute()
+        self.assertEqual(mock_run.call_count, 1)
+        self.assertEqual(mock_run.call_args[0][1], courses[1])
+        self.assertRegexpMatches(mock_run.call_args[0][6],
+                                 r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ')
+
+        # Without probing, every course runs
+        mock_run.reset_mock()
+        sys.argv = ['xsiftx', '--state-dir', state_dir, 'test_sifters']
+        with nostderr():
+            execute()
+        self.assertEqual(mock_run.call_count, 3)
+        self.assertEqual(mock_run.call_args[0][6], None)
+
+    def test_list_reports(self):
+        """
+        Make sure cataloged reports are listed without a sifter
+        """
+        state_dir = mkdtemp_clean(self)
+        catalog = ReportCatalog(state_dir)
+        catalog.record('org/course/1', 'grades.csv', 'dump_grades', 10,
+                       'abc', '/tmp/grades.csv')
+        catalog.record('org/course/2', 'stats.csv', 'content_statistics',
+                       20, 'def', '/tmp/stats.csv')
+
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--list-reports',
+                    '-c', 'org/course/1']
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            execute()
+        lines = mock_stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(
+            lines[0].split('\t')[:4],
+            ['org/course/1', 'dump_grades', 'grades.csv', '10']
+        )
+
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--list-reports']
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            execute()
+        self.assertEqual(len(mock_stdout.getvalue().splitlines()), 2)
+
+    def test_lazy_imports(self):
+        """
+        Make sure starting the command line and finding an executable
+        sifter doesn't load the backends only some runs need.
+        """
+        root = os.path.dirname(os.path.dirname(xsiftx.__file__))
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, xsiftx.command_line, xsiftx.util; '
+            'xsiftx.command_line.get_parser().parse_args(["copy_file"]); '
+            'xsiftx.util.find_sifter("copy_file"); '
+            'print(" ".join(sorted(sys.modules)))'
+        ], cwd=root).split()
+        self.assertIn('xsiftx.command_line', loaded)
+        for module in ('boto', 'yaml', 'xsiftx.store', 'xsiftx.config',
+                       'pkg_resources'):
+            self.assertNotIn(module, loaded)
+
+    @patch('xsiftx.command_line.get_data_store')
+    @patch('xsiftx.command_line.sift')
+    @patch('xsiftx.command_line.get_course_list')
+    def test_longest_first(self, mock_courses, mock_run, _):
+        """
+        Make sure courses run longest first by their recorded
+        runtimes, and progress is reported with the time left.
+        """
+        state_dir = mkdtemp_clean(self)
+        courses = ['org/course/{0}'.format(i) for i in range(4)]
+        mock_courses.return_value = courses
+        mock_run.return_value = None
+        history = RunHistory(state_dir)
+        for course, runtime in zip(courses, [1, None, 100, 10]):
+            if runtime:
+                history.record('test_sifters', [], course, 0,
+                               runtime=runtime)
+
+        sys.argv = ['xsiftx', '--state-dir', state_dir, 'test_sifters']
+        with patch('sys.stderr', new_callable=StringIO) as mock_stderr:
+            execute()
+        # The unknown course is estimated at the median runtime
+        self.assertEqual(
+            [call[0][1] for call in mock_run.call_args_list],
+            [courses[2], courses[1], courses[3], courses[0]]
+        )
+        self.assertIn('[4/4] {0} took 0s, about 0s left'.format(courses[0]),
+                      mock_stderr.getvalue())
+        self.assertEqual(
+            sorted(RunHistory(state_dir).runtimes('test_sifters', [])),
+            courses
+        )
+
+        mock_run.reset_mock()
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--in-order',
+                    'test_sifters']
+        with nostderr():
+            execute()
+        self.assertEqual([call[0][1] for call in mock_run.call_args_list],
+                         courses)
+
+    @patch('xsiftx.command_line.get_data_store')
+    @patch('xsiftx.command_line.get_sifter_manifest')
+    @patch('xsiftx.command_line.sift_batch')
+    @patch('xsiftx.command_line.sift')
+    @patch('xsiftx.command_line.get_course_list')
+    def test_batch_sweep(self, mock_courses, mock_run, mock_batch,
+                         mock_manifest, _):
+        """
+        Make sure batch sifters are given several courses at a time
+        and each course's outcome is recorded.
+        """
+        state_dir = mkdtemp_clean(self)
+        courses = ['org/course/{0}'.format(i) for i in range(5)]
+        mock_courses.return_value = courses
+        mock_manifest.return_value = {'batch': True}
+        mock_run.return_value = None
+        mock_batch.side_effect = lambda _, batch, *args: dict(
+            (course, SifterException('failed') if course == courses[1]
+             else None)
+            for course in batch
+        )
+
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--run-id', 'batch',
+                    '--in-order', '--batch-size', '2', 'test_sifters']
+        with nostderr():
+            execute()
+        self.assertEqual([call[0][1] for call in mock_batch.call_args_list],
+                         [courses[:2], courses[2:4]])
+        self.assertEqual(mock_run.call_args[0][1], courses[4])
+        journal = RunJournal.load(state_dir, 'batch')
+        self.assertEqual(journal.summary(), {'success': 4, 'failure': 1})
+        self.assertEqual(journal.failed(), {courses[1]: 'failed'})
+
+        # Sifters that don't declare batch run one course at a time
+        mock_run.reset_mock()
+        mock_batch.reset_mock()
+        mock_manifest.return_value = {'batch': False}
+        sys.argv = ['xsiftx', '--state-dir', state_dir, 'test_sifters']
+        with nostderr():
+            execute()
+        self.assertFalse(mock_batch.called)
+        self.assertEqual(mock_run.call_count, 5)
+
+    def test_shards(self):
+        """
+        Make sure shards split courses disjointly and stably, and
+        include and exclude patterns filter them.
+        """
+        courses = ['org/course/{0}'.format(i) for i in range(300)]
+        shards = [select_courses(courses, (i, 3)) for i in range(1, 4)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(courses))
+        for shard in shards:
+            self.assertTrue(50 < len(shard) < 150)
+        # Adding a shard only moves courses into the new one
+        for course in courses:
+            if shard_for(course, 4) != 4:
+                self.assertEqual(shard_for(course, 4), shard_for(course, 3))
+
+        self.assertEqual(parse_shard('2/3'), (2, 3))
+        for value in ('0/3', '4/3', '3', 'a/b'):
+            with self.assertRaises(ValueError):
+                parse_shard(value)
+
+        courses = ['MITx/1/a', 'MITx/2/a', 'HarvardX/1/a']
+        self.assertEqual(
+            select_courses(courses, include=['MITx/*'], exclude=['*/2/*']),
+            ['MITx/1/a']
+        )
+
+    @patch('xsiftx.command_line.get_data_store')
+    @patch('xsiftx.command_line.sift')
+    @patch('xsiftx.command_line.get_course_list')
+    def test_sharded_sweep(self, mock_courses, mock_run, _):
+        """
+        Make sure each shard runs its own courses and their
+        summaries merge.
+        """
+        state_dir = mkdtemp_clean(self)
+        courses = ['org/course/{0}'.format(i) for i in range(10)]
+        mock_courses.return_value = courses
+
+        def fail_first(_, course, *args):
+            """
+            Fail the first course
+            """
+            # pylint: disable=W0613
+            if course == courses[0]:
+                raise SifterException('failed')
+        mock_run.side_effect = fail_first
+
+        for shard in ('1/2', '2/2'):
+            mock_run.reset_mock()
+            sys.argv = ['xsiftx', '--state-dir', state_dir, '--run-id',
+                        shard.replace('/', 'of'), '--shard', shard,
+                        'test_sifters']
+            with nostderr():
+                execute()
+            self.assertEqual(
+                sorted(call[0][1] for call in mock_run.call_args_list),
+                select_courses(courses, parse_shard(shard))
+            )
+        self.assertEqual(RunJournal.load(state_dir, '1of2').shard, '1/2')
+
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--merge-runs',
+                    '1of2', RunJournal.path_for(state_dir, '2of2')]
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            execute()
+        lines = mock_stdout.getvalue().splitlines()
+        self.assertEqual(lines[2], 'total\t-\t9 succeeded\t1 failed')
+        self.assertEqual(lines[3], 'failed\t{0}\tfailed'.format(courses[0]))
+
+        # Missing shards are pointed out
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--merge-runs',
+                    '1of2']
+        with patch('sys.stderr', new_callable=StringIO) as mock_stderr:
+            with patch('sys.stdout', new_callable=StringIO):
+                execute()
+        self.assertEqual(mock_stderr.getvalue(), 'Missing shards: 2/2\n')
+
+        # Patterns narrow down the sweep
+        mock_run.reset_mock()
+        sys.argv = ['xsiftx', '--state-dir', state_dir, '--include',
+                    'org/course/1*', '--exclude', '*/10', 'test_sifters']
+        with nostderr():
+            execute()
+        self.assertEqual([call[0][1] for call in mock_run.call_args_list],
+                         [courses[1]])
@@ -6,13 +6,22 @@ import logging
 import os
 import time
 import unittest
+import uuid
 
-from mock import patch
+from mock import patch, Mock
 
+from .util import mkdtemp_clean
 import xsiftx.config
+import xsiftx.lti
+from xsiftx.catalog import ReportCatalog
 from xsiftx.config import get_config, get_consumer, XsiftxNoConfigException
+from xsiftx.history import RunHistory
 from xsiftx.util import get_sifters
 from xsiftx.lti.decorators import LTI_STAFF_ROLES
+from xsiftx.lti.nonces import NonceCache, SharedNonceCache
+from xsiftx.lti.scheduler import (
+    CLAIM_TTL, ConsumerScheduler, QueueFullException
+)
 import xsiftx.web
 
 
@@ -45,7 +54,7 @@ class TestLTIWebApp(unittest.TestCase):
             'oauth_version': '1.0',
             'oauth_signature': '{0}&'.format(consumer.get('secret', '')),
             'oauth_timestamp': str(int(time.time())),
-            'oauth_nonce': '123456789',
+            'oauth_nonce': uuid.uuid4().hex,
             'context_id': 'MITx/A.we/some'
         })
         return params
@@ -192,6 +201,38 @@ class TestLTIWebApp(unittest.TestCase):
             response.data
         )
 
+    def test_replayed_launch(self):
+        """
+        Make sure a launch can't be replayed, and that stale launches
+        are refused rather than remembered forever.
+        """
+        params = self._oauth_request({'roles': 'Instructor'})
+        response = self.client.post('/', data=dict(params))
+        self.assertEqual(response.status_code, 200)
+        with xsiftx.web.app.test_client() as client:
+            response = client.post('/', data=dict(params))
+        self.assertEqual(response.status_code, 401)
+
+        # The same nonce is fine for another consumer
+        nonce = params['oauth_nonce']
+        params = self._oauth_request({'roles': 'Instructor'}, 1)
+        params['oauth_nonce'] = nonce
+        response = self.client.post('/', data=params)
+        self.assertEqual(response.status_code, 200)
+
+        params = self._oauth_request({'roles': 'Instructor'})
+        params['oauth_timestamp'] = str(int(time.time()) - 3600)
+        response = self.client.post('/', data=params)
+        self.assertEqual(response.status_code, 401)
+
+        # A forged launch doesn't spend the nonce of a real one
+        params = self._oauth_request({'roles': 'Instructor'})
+        forged = dict(params, oauth_signature='forged&')
+        response = self.client.post('/', data=forged)
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post('/', data=params)
+        self.assertEqual(response.status_code, 200)
+
     def test_lti_staff_decorator(self):
         """
         Make sure that our authorization of role is happening
@@ -361,6 +402,307 @@ class TestLTIWebApp(unittest.TestCase):
         reply_json = json.loads(response.data)
         self.assertTrue(len(reply_json['tasks']), 0)
 
+    @patch('xsiftx.lti.celery.AsyncResult')
+    def test_task_progress(self, mock_result):
+        """
+        Make sure runs reporting progress show it in their status
+        """
+        mock_result.return_value.state = 'PROGRESS'
+        mock_result.return_value.status = 'PROGRESS'
+        mock_result.return_value.info = {
+            'done': 3, 'total': 4, 'percent': 75.0, 'estimated_left': 20.0
+        }
+        reply_json = self._run_sifter()
+        self.assertEqual(reply_json['tasks'][0]['status'], 'PROGRESS')
+        self.assertEqual(reply_json['tasks'][0]['progress']['percent'], 75.0)
+
+        mock_result.return_value.state = 'FAILURE'
+        mock_result.return_value.status = 'FAILURE'
+        response = self.client.put('/api/v0.1/update_task_status',
+                                   data=self._oauth_request())
+        task = json.loads(response.data)['tasks'][0]
+        self.assertEqual(task['status'], 'FAILURE')
+        self.assertNotIn('progress', task)
+
+    @patch('xsiftx.lti.time.time')
+    def test_progress_reporter(self, mock_time):
+        """
+        Make sure progress updates are rate limited and estimate
+        the time left.
+        """
+        mock_time.return_value = 1000.0
+        task = Mock()
+        report = xsiftx.lti.progress_reporter(task)
+        report(1, 4)
+        self.assertFalse(task.update_state.called)
+
+        mock_time.return_value += xsiftx.lti.PROGRESS_INTERVAL
+        report(1, 4)
+        task.update_state.assert_called_once_with(state='PROGRESS', meta={
+            'done': 1, 'total': 4, 'percent': 25.0,
+            'estimated_left': 3 * xsiftx.lti.PROGRESS_INTERVAL
+        })
+        report(2, 4)
+        self.assertEqual(task.update_state.call_count, 1)
+
+        mock_time.return_value += xsiftx.lti.PROGRESS_INTERVAL
+        report(0, 0)
+        report(9, 4)
+        self.assertEqual(task.update_state.call_args[1]['meta']['percent'],
+                         100.0)
+
+    @patch('xsiftx.lti.celery.control.revoke')
+    @patch('xsiftx.lti.web_run_sifter.apply_async')
+    def test_cancel_task(self, mock_apply, mock_revoke):
+        """
+        Make sure cancelling revokes running tasks, drops queued ones
+        and frees their slots.
+        """
+        consumer = xsiftx.config.settings['consumers'][1]
+        consumer.update({'max_concurrent': 1})
+        self.addCleanup(consumer.pop, 'max_concurrent')
+        state_dir = xsiftx.config.settings['state_dir']
+        self.addCleanup(xsiftx.config.settings.__setitem__, 'state_dir',
+                        state_dir)
+        xsiftx.config.settings['state_dir'] = mkdtemp_clean(self)
+        xsiftx.lti._scheduler = None  # pylint: disable=W0212
+        self.addCleanup(setattr, xsiftx.lti, '_scheduler', None)
+        cancel_url = '/api/v0.1/cancel_task'
+
+        self._run_sifter()
+        reply_json = self._run_sifter()
+        running, queued = [task['task_id'] for task in reply_json['tasks']]
+
+        response = self.client.post(
+            cancel_url, data=self._oauth_request({'task_id': queued}, 1)
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(mock_revoke.called)
+        self.assertEqual(json.loads(response.data)['tasks'][1]['status'],
+                         'REVOKED')
+
+        response = self.client.post(
+            cancel_url, data=self._oauth_request({'task_id': running}, 1)
+        )
+        mock_revoke.assert_called_once_with(running, terminate=True,
+                                            signal='SIGTERM')
+        self.assertEqual(
+            [task['status'] for task in json.loads(response.data)['tasks']],
+            ['REVOKED', 'REVOKED']
+        )
+        # The slot is free again and the cancelled run didn't take it
+        self.assertEqual(mock_apply.call_count, 1)
+        self._run_sifter()
+        self.assertEqual(mock_apply.call_count, 2)
+
+        response = self.client.post(
+            cancel_url, data=self._oauth_request({'task_id': 'other'}, 1)
+        )
+        self.assertEqual(response.status_code, 404)
+
+    @patch('xsiftx.lti.web_run_sifter.apply_async')
+    def test_cached_result(self, mock_apply):
+        """
+        Make sure a recent run's reports are returned instead of
+        running the sifter again, unless a refresh is forced.
+        """
+        state_dir = xsiftx.config.settings['state_dir']
+        self.addCleanup(xsiftx.config.settings.__setitem__, 'state_dir',
+                        state_dir)
+        xsiftx.config.settings['state_dir'] = mkdtemp_clean(self)
+        xsiftx.config.settings['result_ttl'] = {'test_sifters': 600}
+        self.addCleanup(xsiftx.config.settings.pop, 'result_ttl')
+        mock_apply.return_value.task_id = 'fresh-task'
+
+        # Nothing to reuse yet
+        self._run_sifter()
+        self.assertEqual(mock_apply.call_count, 1)
+
+        # A run that finished a minute ago
+        finished_at = time.time() - 60
+        with patch('xsiftx.history.time.time', return_value=finished_at):
+            RunHistory(xsiftx.config.settings['state_dir']).record(
+                'test_sifters', [], 'MITx/A.we/some', finished_at - 5
+            )
+        ReportCatalog(xsiftx.config.settings['state_dir']).record(
+            'MITx/A.we/some', 'test.csv', 'test_sifters', 10, 'abc',
+            '/tmp/test.csv'
+        )
+        reply_json = self._run_sifter()
+        self.assertEqual(mock_apply.call_count, 1)
+        task = reply_json['tasks'][-1]
+        self.assertEqual(task['status'], 'CACHED')
+        self.assertEqual(
+            [report['filename'] for report in task['results']['reports']],
+            ['test.csv']
+        )
+        # Other arguments or sifters without a TTL still run
+        response = self.client.post('api/v0.1/run', data=self._oauth_request(
+            {'sifter': 'test_sifters', 'extra_args': 'other'}, 1
+        ))
+        self.assertEqual(response.status_code, 200)
+        self._run_sifter('xqanalyze')
+        self.assertEqual(mock_apply.call_count, 3)
+
+        response = self.client.post('api/v0.1/run', data=self._oauth_request(
+            {'sifter': 'test_sifters', 'force_refresh': 'true'}, 1
+        ))
+        self.assertEqual(json.loads(response.data)['tasks'][-1]['task_id'],
+                         'fresh-task')
+        self.assertEqual(mock_apply.call_count, 4)
+
+        xsiftx.config.settings['result_ttl'] = {'test_sifters': 30}
+        self._run_sifter()
+        self.assertEqual(mock_apply.call_count, 5)
+
+    @patch('xsiftx.lti.web_run_sifter.apply_async')
+    def test_profile_run(self, mock_apply):
+        """
+        Make sure runs can ask for a profile
+        """
+        mock_apply.return_value.task_id = 'profiled-task'
+        response = self.client.post('api/v0.1/run', data=self._oauth_request(
+            {'sifter': 'test_sifters', 'profile': 'true'}, 1
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_apply.call_args[0][1], {'profile': True})
+        self._run_sifter()
+        self.assertEqual(mock_apply.call_args[0][1], {'profile': False})
+
+    @patch('xsiftx.lti.run_sifter')
+    def test_run_recorded(self, _):
+        """
+        Make sure successful runs are recorded for reuse
+        """
+        state_dir = xsiftx.config.settings['state_dir']
+        self.addCleanup(xsiftx.config.settings.__setitem__, 'state_dir',
+                        state_dir)
+        xsiftx.config.settings['state_dir'] = mkdtemp_clean(self)
+        xsiftx.lti.web_run_sifter.apply(
+            ('/sifters/dump_grades', 'MITx/A.we/some', ['a'])
+        )
+        last_run = RunHistory(xsiftx.config.settings['state_dir']).last_run(
+            'dump_grades', ['a'], 'MITx/A.we/some'
+        )
+        self.assertLessEqual(last_run['started_at'], last_run['finished_at'])
+
+    @patch('xsiftx.lti.log')
+    @patch('xsiftx.lti.web_run_sifter.apply_async')
+    def test_run_max_queued_only(self, mock_apply, mock_log):
+        """
+        Make sure a consumer with only max_queued still goes through
+        the scheduler, and is warned the limit has no effect.
+        """
+        consumer = xsiftx.config.settings['consumers'][1]
+        consumer.update({'max_queued': 1})
+        self.addCleanup(consumer.pop, 'max_queued')
+        state_dir = xsiftx.config.settings['state_dir']
+        self.addCleanup(xsiftx.config.settings.__setitem__, 'state_dir',
+                        state_dir)
+        xsiftx.config.settings['state_dir'] = mkdtemp_clean(self)
+        xsiftx.lti._scheduler = None  # pylint: disable=W0212
+        self.addCleanup(setattr, xsiftx.lti, '_scheduler', None)
+
+        reply_json = self._run_sifter()
+        # Only the scheduler hands celery the task ID
+        self.assertEqual(mock_apply.call_count, 1)
+        self.assertEqual(mock_apply.call_args[1]['task_id'],
+                         reply_json['tasks'][0]['task_id'])
+        self.assertTrue(mock_log.warning.called)
+
+    @patch('xsiftx.lti.web_run_sifter.apply_async')
+    def test_run_admission_control(self, mock_apply):
+        """
+        Make sure consumers over their concurrency cap get a queue
+        position and are turned away once their queue is full.
+        """
+        consumer = xsiftx.config.settings['consumers'][1]
+        consumer.update({'max_concurrent': 1, 'max_queued': 1})
+        self.addCleanup(consumer.pop, 'max_concurrent')
+        self.addCleanup(consumer.pop, 'max_queued')
+        state_dir = xsiftx.config.settings['state_dir']
+        self.addCleanup(xsiftx.config.settings.__setitem__, 'state_dir',
+                        state_dir)
+        xsiftx.config.settings['state_dir'] = mkdtemp_clean(self)
+        xsiftx.lti._scheduler = None  # pylint: disable=W0212
+        self.addCleanup(setattr, xsiftx.lti, '_scheduler', None)
+
+        reply_json = self._run_sifter()
+        self.assertEqual(mock_apply.call_count, 1)
+        self.assertEqual(reply_json['tasks'][0]['status'], 'PENDING')
+
+        reply_json = self._run_sifter()
+        self.assertEqual(mock_apply.call_count, 1)
+        self.assertEqual(reply_json['tasks'][1]['status'], 'QUEUED')
+        self.assertEqual(reply_json['tasks'][1]['queue_position'], 1)
+
+        response = self.client.post(
+            'api/v0.1/run',
+            data=self._oauth_request({'sifter': 'test_sifters'}, 1)
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.data)['queue_depth'], 1)
+
+        # Finishing the running task starts the queued one
+        xsiftx.lti.get_scheduler().finish(reply_json['tasks'][0]['task_id'])
+        self.assertEqual(mock_apply.call_count, 2)
+        self.assertEqual(
+            mock_apply.call_args[1]['task_id'],
+            reply_json['tasks'][1]['task_id']
+        )
+
+    @patch('xsiftx.lti.web_run_sifter.apply_async')
+    def test_run_queue_routing(self, mock_apply):
+        """
+        Make sure runs go to the queue configured for the sifter's
+        cost class, and to the default queue otherwise.
+        """
+        mock_apply.return_value.task_id = 'routed-task'
+        self._run_sifter()
+        self.assertIsNone(mock_apply.call_args[1]['queue'])
+
+        xsiftx.config.settings['sifter_queues'] = {'light': 'fast_lane'}
+        self.addCleanup(xsiftx.config.settings.pop, 'sifter_queues')
+        self._run_sifter()
+        self.assertEqual(mock_apply.call_args[1]['queue'], 'fast_lane')
+        self._run_sifter('xqanalyze')
+        self.assertIsNone(mock_apply.call_args[1]['queue'])
+
+    def test_reports(self):
+        """
+        Make sure the reports API lists the cataloged reports of the
+        session's course only.
+        """
+        state_dir = xsiftx.config.settings['state_dir']
+        self.addCleanup(xsiftx.config.settings.__setitem__, 'state_dir',
+                        state_dir)
+        xsiftx.config.settings['state_dir'] = mkdtemp_clean(self)
+        catalog = ReportCatalog(xsiftx.config.settings['state_dir'])
+        catalog.record('MITx/A.we/some', 'grades.csv', 'dump_grades', 10,
+                       'abc', '/tmp/grades.csv')
+        catalog.record('MITx/A.we/some', 'stats.csv', 'content_statistics',
+                       20, 'def', '/tmp/stats.csv')
+        catalog.record('MITx/other/course', 'grades.csv', 'dump_grades', 30,
+                       'ghi', '/tmp/other.csv')
+
+        response = self.client.get(
+            '/api/v0.1/reports', query_string=self._oauth_request()
+        )
+        self.assertEqual(response.status_code, 200)
+        reports = json.loads(response.data)['reports']
+        self.assertEqual(
+            sorted(report['filename'] for report in reports),
+            ['grades.csv', 'stats.csv']
+        )
+
+        response = self.client.get(
+            '/api/v0.1/reports',
+            query_string=self._oauth_request({'sifter': 'dump_grades'})
+        )
+        reports = json.loads(response.data)['reports']
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]['sha256'], 'abc')
+
     def test_logging_level(self):
         """
         Tests to make sure logging config happens and handles
@@ -385,3 +727,133 @@ class TestLTIWebApp(unittest.TestCase):
 
         # Restore setting
         xsiftx.config.settings['log_level'] = 'debug'
+
+
+class TestConsumerScheduler(unittest.TestCase):
+    """
+    Test the per consumer scheduler on its own
+    """
+    # pylint: disable=r0904
+
+    def setUp(self):
+        """
+        Create a scheduler that records what it dispatches
+        """
+        # pylint: disable=C0103
+        self.dispatched = []
+        self.limits = {'busy': (2, 3), 'open': (None, None)}
+        self.scheduler = ConsumerScheduler(
+            os.path.join(mkdtemp_clean(self), 'scheduler.db'),
+            lambda task_id, job: self.dispatched.append(task_id),
+            self.limits.get
+        )
+
+    def test_fair_share(self):
+        """
+        A busy consumer's backlog waits on its own slots without
+        holding up anyone else.
+        """
+        busy = [self.scheduler.submit('busy', {}) for _ in range(5)]
+        self.assertEqual([position for _, position in busy],
+                         [0, 0, 1, 2, 3])
+        self.assertEqual(self.dispatched, [task for task, _ in busy[:2]])
+
+        with self.assertRaises(QueueFullException):
+            self.scheduler.submit('busy', {})
+
+        task_id, position = self.scheduler.submit('open', {})
+        self.assertEqual(position, 0)
+        self.assertEqual(self.dispatched[-1], task_id)
+
+        # Slots are handed on in order as runs finish
+        self.scheduler.finish(busy[0][0])
+        self.assertEqual(self.dispatched[-1], busy[2][0])
+        self.assertEqual(self.scheduler.position(busy[3][0]), 1)
+        self.assertIsNotNone(self.scheduler.estimated_wait(busy[3][0]))
+
+        # Dead tasks are released by reconciling with celery
+        self.scheduler.reconcile('busy', lambda task_id: True)
+        self.assertEqual(self.dispatched[-2:], [busy[3][0], busy[4][0]])
+        self.assertEqual(self.scheduler.position(busy[4][0]), 0)
+
+    def test_failed_dispatch(self):
+        """
+        Runs that can't be handed to celery give their slot to the
+        next queued run, and claims never dispatched expire.
+        """
+        busy = [self.scheduler.submit('busy', {}) for _ in range(5)]
+        dispatch = self.scheduler.dispatch
+        self.scheduler.dispatch = Mock(side_effect=IOError('No broker'))
+        with self.assertRaises(IOError):
+            self.scheduler.finish(busy[0][0])
+        self.assertEqual(self.scheduler.dispatch.call_count, 3)
+        self.assertEqual(self.scheduler.position(busy[4][0]), 0)
+
+        # A claim left behind by a process that died before handing
+        # it to celery is released once it expires
+        self.scheduler.dispatch = Mock(side_effect=SystemExit)
+        with self.assertRaises(SystemExit):
+            self.scheduler.submit('busy', {})
+        self.scheduler.dispatch = dispatch
+        task_id = self.scheduler.submit('busy', {})[0]
+        self.assertEqual(self.scheduler.position(task_id), 1)
+        self.scheduler.reconcile('busy', lambda task_id: False)
+        self.assertEqual(self.scheduler.position(task_id), 1)
+        later = time.time() + CLAIM_TTL + 1
+        with patch('xsiftx.lti.scheduler.time.time') as mock_time:
+            mock_time.return_value = later
+            self.scheduler.reconcile('busy', lambda task_id: False)
+        self.assertEqual(self.scheduler.position(task_id), 0)
+        self.assertEqual(self.dispatched[-1], task_id)
+
+
+class TestNonceCache(unittest.TestCase):
+    """
+    Test the nonce caches on their own
+    """
+    # pylint: disable=r0904
+
+    @patch('xsiftx.lti.nonces.time.time')
+    def test_nonce_cache(self, mock_time):
+        """
+        Nonces are refused until the TTL after their timestamp, and
+        the cache stays within its size.
+        """
+        mock_time.return_value = 1000
+        nonces = NonceCache(ttl=10, size=3)
+        self.assertFalse(nonces.seen('a', '1'))
+        self.assertFalse(nonces.seen('a', '1'))
+        self.assertTrue(nonces.record('a', '1', '1000'))
+        self.assertTrue(nonces.seen('a', '1'))
+        self.assertFalse(nonces.record('a', '1', '1000'))
+        self.assertFalse(nonces.seen('b', '1'))
+
+        # Launches from the future are remembered for longer
+        self.assertTrue(nonces.record('a', '2', '1005'))
+        mock_time.return_value = 1011
+        self.assertFalse(nonces.seen('a', '1'))
+        self.assertTrue(nonces.seen('a', '2'))
+        self.assertEqual(len(nonces), 1)
+
+        for nonce in range(5):
+            nonces.record('a', str(nonce + 3), '1011')
+        self.assertEqual(len(nonces), 3)
+
+    def test_shared_nonce_cache(self):
+        """
+        Nonces are shared by caches in the same state directory
+        """
+        state_dir = mkdtemp_clean(self)
+        first = SharedNonceCache(state_dir, ttl=10)
+        second = SharedNonceCache(state_dir, ttl=10)
+        now = int(time.time())
+        self.assertFalse(first.seen('a', '1'))
+        self.assertTrue(first.record('a', '1', now))
+        self.assertTrue(second.seen('a', '1'))
+        self.assertFalse(second.record('a', '1', now))
+        self.assertFalse(second.seen('b', '1'))
+
+        with patch('xsiftx.lti.nonces.time.time') as mock_time:
+            mock_time.return_value = now + 11
+            self.assertFalse(first.seen('a', '1'))
+            self.assertTrue(second.record('a', '1', now + 11))
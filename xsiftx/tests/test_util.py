@@ -1,23 +1,109 @@
 """
 Tests for xsiftx.util functions
 """
+import hashlib
 import os
+import pstats
+import shutil
+import signal
 import stat
+import sys
+import threading
+import time
 import unittest
+from StringIO import StringIO
+from datetime import datetime
 
-from mock import patch
+from mock import call, patch, Mock
 
 from .util import mkdtemp_clean
+from xsiftx.catalog import ReportCatalog
+from xsiftx.delta import DeltaReports
+from xsiftx.pipeline import UploadPipeline
+from xsiftx.store import (
+    FSStore, S3Store, S3_STAGING_PREFIX, STORE_THREADS
+)
+from xsiftx.tools import (
+    PROGRESS_FD_ENV,
+    BATCH_COURSE_ARG,
+    STATE_DIR_ENV,
+    get_course_structure,
+    iter_chunked,
+    iter_values,
+    load_state,
+    progress_callback,
+    report_progress,
+    write_csv
+)
 from xsiftx.util import (
+    find_sifter,
     get_sifters,
+    get_sifter_manifest,
     get_course_list,
     get_settings,
     run_sifter,
+    sift_batch,
+    SifterOutput,
     XsiftxException,
-    SifterException
+    SifterException,
+    SifterLimitException,
+    SifterCancelledException,
+    cancel_on_signal,
+    STDERR_TAIL
 )
 
 
+class FakeQuerySet(object):
+    """
+    Just enough of a Django queryset over a list of row dictionaries
+    to iterate it in chunks, recording the slices fetched.
+    """
+
+    def __init__(self, rows, fields=None, fetched=None):
+        """
+        Hold the rows, values_list fields and the shared fetch record
+        """
+        self.rows = rows
+        self.fields = fields
+        self.fetched = [] if fetched is None else fetched
+
+    def _copy(self, rows, fields=None):
+        """
+        Returns a queryset over the rows sharing the fetch record
+        """
+        return FakeQuerySet(rows, fields or self.fields, self.fetched)
+
+    def order_by(self, field):
+        """
+        Sort the rows by the field, only pk is supported
+        """
+        assert field == 'pk'
+        return self._copy(sorted(self.rows, key=lambda row: row['pk']))
+
+    def filter(self, pk__gt):
+        """
+        Rows with a greater primary key
+        """
+        return self._copy([row for row in self.rows if row['pk'] > pk__gt])
+
+    def values_list(self, *fields):
+        """
+        Fetch tuples of fields instead of objects
+        """
+        return self._copy(self.rows, fields)
+
+    def __getitem__(self, index):
+        """
+        Fetch a slice of the rows
+        """
+        self.fetched.append(index)
+        rows = self.rows[index]
+        if self.fields:
+            return [tuple(row[field] for field in self.fields)
+                    for row in rows]
+        return [Mock(**row) for row in rows]
+
+
 class TestUtils(unittest.TestCase):
     """
     Test series for util functions in xsiftx.util
@@ -37,17 +123,43 @@ class TestUtils(unittest.TestCase):
 
     BAD_SIFTER = 'testenv_sifter'
 
-    def _make_bad_sifter(self):
+    def _make_sifter(self, name, script):
         """
-        Create a sifter that raises an exception
+        Create a sifter with the given script in a new SIFTER_DIR
+        and return its path
         """
         temp_dir = mkdtemp_clean(self)
-        sifter_path = os.path.join(temp_dir, self.BAD_SIFTER)
+        sifter_path = os.path.join(temp_dir, name)
         with open(sifter_path, 'w+') as temp_sifter:
-            temp_sifter.write('#!/bin/bash\nfalse')
+            temp_sifter.write(script)
         perms = os.stat(sifter_path)
         os.chmod(sifter_path, perms.st_mode | stat.S_IEXEC)
         os.environ['SIFTER_DIR'] = temp_dir
+        return sifter_path
+
+    def _make_bad_sifter(self):
+        """
+        Create a sifter that raises an exception
+        """
+        self._make_sifter(self.BAD_SIFTER, '#!/bin/bash\nfalse')
+
+    def _mock_fs_settings(self):
+        """
+        Patch get_settings to write to a temporary FSStore and
+        return the storage root.
+        """
+        temp_dir = mkdtemp_clean(self)
+        patcher = patch('xsiftx.util.get_settings')
+        mock_settings = patcher.start()
+        self.addCleanup(patcher.stop)
+        mock_settings.return_value = {
+            'use_s3': False,
+            'aws_key': '',
+            'root_path': temp_dir,
+            'bucket': '',
+            'aws_key_id': ''
+        }
+        return temp_dir
 
     def test_sifter_list_locations(self):
         """
@@ -61,6 +173,27 @@ class TestUtils(unittest.TestCase):
         self._make_bad_sifter()
         self.assertTrue(self.BAD_SIFTER in get_sifters())
 
+    def test_sifter_manifests(self):
+        """
+        Make sure sidecar manifests are read with defaults filled in
+        """
+        manifests = get_sifters(with_manifests=True)
+        self.assertEqual(manifests['copy_file']['cost_class'], 'light')
+        self.assertEqual(manifests['xqanalyze']['cost_class'], 'heavy')
+        self.assertEqual(manifests['copy_file']['path'],
+                         get_sifters()['copy_file'])
+
+        sifter_path = self._make_sifter('bare_sifter', '#!/bin/bash\n')
+        manifest = get_sifter_manifest(sifter_path)
+        self.assertIsNone(manifest['cost_class'])
+        self.assertEqual(manifest['arguments'], [])
+
+        with open('{0}.yml'.format(sifter_path), 'w') as manifest_file:
+            manifest_file.write('cost_class: [light\n')
+        with self.assertRaisesRegexp(XsiftxException,
+                                     'Invalid sifter manifest'):
+            get_sifter_manifest(sifter_path)
+
     @unittest.skipUnless(os.environ.get('XSIFTX_TEST_EDX', None),
                          'Requires an edx environment and XSIFTX_TEST_EDX '
                          'environment variable set.')
@@ -137,3 +270,813 @@ class TestUtils(unittest.TestCase):
             self.assertTrue(os.path.exists(
                 os.path.join(temp_dir, course, 'test_sifter.txt')
             ))
+
+    def test_run_sifter_limits(self):
+        """
+        Make sure limits kill runaway sifters with a distinct error
+        and don't get in the way of well behaved ones.
+        """
+        temp_dir = self._mock_fs_settings()
+
+        slow_sifter = self._make_sifter(
+            'slow_sifter', '#!/bin/bash\necho slow.txt\nsleep 30\n'
+        )
+        start = time.time()
+        with self.assertRaisesRegexp(SifterLimitException,
+                                     'exceeded its timeout'):
+            run_sifter(slow_sifter, 'course', 'venv', 'edx', [],
+                       {'timeout': 0.5})
+        self.assertLess(time.time() - start, 10)
+
+        loud_sifter = self._make_sifter(
+            'loud_sifter', '#!/bin/bash\necho loud.txt\nyes\n'
+        )
+        with self.assertRaisesRegexp(SifterLimitException,
+                                     'exceeded its output limit'):
+            run_sifter(loud_sifter, 'course', 'venv', 'edx', [],
+                       {'max_output': 1024, 'nice': 5})
+        self.assertFalse(os.path.exists(
+            os.path.join(temp_dir, 'course', 'loud.txt')
+        ))
+
+        quick_sifter = self._make_sifter(
+            'quick_sifter', '#!/bin/bash\necho quick.txt\necho done\n'
+        )
+        run_sifter(quick_sifter, 'course', 'venv', 'edx', [],
+                   {'timeout': 30, 'max_output': 1024, 'max_cpu': 30})
+        self.assertTrue(os.path.exists(
+            os.path.join(temp_dir, 'course', 'quick.txt')
+        ))
+
+        busy_sifter = self._make_sifter(
+            'busy_sifter', '#!/bin/bash\nwhile :; do :; done\n'
+        )
+        with self.assertRaisesRegexp(SifterLimitException,
+                                     'exceeded its CPU limit'):
+            run_sifter(busy_sifter, 'course', 'venv', 'edx', [],
+                       {'timeout': 30, 'max_cpu': 1})
+
+        # Being killed by someone else isn't blamed on the CPU limit
+        killed_sifter = self._make_sifter(
+            'killed_sifter', '#!/bin/bash\nkill -9 $$\n'
+        )
+        with self.assertRaises(SifterException) as context:
+            run_sifter(killed_sifter, 'course', 'venv', 'edx', [],
+                       {'max_cpu': 30})
+        self.assertNotIsInstance(context.exception, SifterLimitException)
+
+    @patch('pkg_resources.iter_entry_points')
+    def test_python_sifters(self, mock_entry_points):
+        """
+        Make sure entry point sifters are listed and run in process
+        """
+        def rows_sifter(venv, edx_platform, course, extra_args, since=None):
+            """
+            Yield a CSV report of the arguments
+            """
+            yield 'rows.csv'
+            yield ['course', 'args', 'since']
+            yield [course, ' '.join(extra_args), since]
+
+        def failing_sifter(*args, **kwargs):
+            """
+            Fail like a buggy sifter would
+            """
+            raise ValueError('buggy')
+        rows_sifter.manifest = {'cost_class': 'light'}
+
+        entry_points = {'rows': rows_sifter, 'failing': failing_sifter}
+
+        def iter_entry_points(_, name=None):
+            """
+            Fake the registered entry points
+            """
+            for entry_name, func in sorted(entry_points.items()):
+                if name in (None, entry_name):
+                    entry_point = Mock(load=Mock(return_value=func))
+                    entry_point.name = entry_name
+                    yield entry_point
+        mock_entry_points.side_effect = iter_entry_points
+
+        sifters = get_sifters(with_manifests=True)
+        self.assertEqual(sifters['rows']['path'], 'python:rows')
+        self.assertEqual(sifters['rows']['cost_class'], 'light')
+        self.assertEqual(sifters['failing']['cost_class'], None)
+
+        # Entry points are only scanned for names no executable has
+        mock_entry_points.reset_mock()
+        self.assertTrue(find_sifter('copy_file').endswith('copy_file'))
+        self.assertFalse(mock_entry_points.called)
+        self.assertEqual(find_sifter('rows'), 'python:rows')
+        self.assertIsNone(find_sifter('missing'))
+
+        temp_dir = self._mock_fs_settings()
+        run_sifter('python:rows', 'course', 'venv', 'edx', ['a', 'b'],
+                   since='2014-01-01T00:00:00Z')
+        with open(os.path.join(temp_dir, 'course', 'rows.csv')) as report:
+            self.assertEqual(
+                report.read(),
+                'course,args,since\r\ncourse,a b,2014-01-01T00:00:00Z\r\n'
+            )
+
+        with self.assertRaisesRegexp(SifterLimitException, 'output limit'):
+            run_sifter('python:rows', 'course', 'venv', 'edx', [],
+                       {'max_output': 10})
+        with self.assertRaisesRegexp(SifterException, 'ValueError: buggy'):
+            run_sifter('python:failing', 'course', 'venv', 'edx', [])
+        with self.assertRaisesRegexp(XsiftxException, 'No Python sifter'):
+            run_sifter('python:missing', 'course', 'venv', 'edx', [])
+
+    def test_output_manifest(self):
+        """
+        Make sure sifters can write several reports through an output
+        manifest, and that a bad manifest stores nothing.
+        """
+        temp_dir = self._mock_fs_settings()
+        multi_sifter = self._make_sifter('multi_sifter', (
+            '#!/bin/bash\n'
+            'echo one > $XSIFTX_OUTPUT_DIR/one.csv\n'
+            'echo two > $XSIFTX_OUTPUT_DIR/summary.txt\n'
+            'echo xsiftx-output-manifest\n'
+            'echo one.csv\n'
+            'echo summary.txt\n'
+        ))
+        run_sifter(multi_sifter, 'course', 'venv', 'edx', [])
+        course_dir = os.path.join(temp_dir, 'course')
+        self.assertEqual(sorted(os.listdir(course_dir)),
+                         ['one.csv', 'summary.txt'])
+        with open(os.path.join(course_dir, 'summary.txt')) as summary:
+            self.assertEqual(summary.read(), 'two\n')
+
+        sneaky_sifter = self._make_sifter('sneaky_sifter', (
+            '#!/bin/bash\n'
+            'echo one > $XSIFTX_OUTPUT_DIR/three.csv\n'
+            'echo xsiftx-output-manifest\n'
+            'echo three.csv\n'
+            'echo ../../etc/passwd\n'
+        ))
+        with self.assertRaisesRegexp(SifterException, 'output manifest'):
+            run_sifter(sneaky_sifter, 'course', 'venv', 'edx', [])
+        self.assertFalse(os.path.exists(os.path.join(course_dir,
+                                                     'three.csv')))
+
+    def test_sift_batch(self):
+        """
+        Make sure a batch sifter's reports are split up by course
+        """
+        batch_sifter = self._make_sifter('batch_sifter', (
+            '#!/bin/bash\n'
+            'courses=$3\n'
+            'test "$3" = {0} && courses=$(cat)\n'
+            'echo xsiftx-batch-manifest\n'
+            'for course in $courses; do\n'
+            '  test $course = org/empty/1 && continue\n'
+            '  printf "%s\\treport.csv\\n" $course\n'
+            '  test $course = org/missing/1 && continue\n'
+            '  mkdir -p $XSIFTX_OUTPUT_DIR/${{course//\\//%2F}}\n'
+            '  echo $course > $XSIFTX_OUTPUT_DIR/${{course//\\//%2F}}/'
+            'report.csv\n'
+            'done\n'.format(BATCH_COURSE_ARG)
+        ))
+        courses = ['org/a/1', 'org/b/1', 'org/empty/1', 'org/missing/1']
+        results = sift_batch(batch_sifter, courses, 'venv', 'edx', [])
+        self.assertEqual(sorted(results), courses)
+        for course in courses[:2]:
+            self.assertEqual(results[course].course, course)
+            self.assertEqual(
+                [filename for filename, _ in results[course].outputs],
+                ['report.csv']
+            )
+            with open(results[course].outputs[0][1]) as report:
+                self.assertEqual(report.read(), course + '\n')
+            results[course].close()
+        self.assertIsNone(results['org/empty/1'])
+        self.assertIsInstance(results['org/missing/1'], SifterException)
+
+        # Run on a single course, its batch manifest is read the same
+        temp_dir = self._mock_fs_settings()
+        run_sifter(batch_sifter, 'course', 'venv', 'edx', [])
+        with open(os.path.join(temp_dir, 'course', 'report.csv')) as report:
+            self.assertEqual(report.read(), 'course\n')
+        with self.assertRaisesRegexp(SifterException, 'output directory'):
+            run_sifter(batch_sifter, 'org/missing/1', 'venv', 'edx', [])
+
+        not_batch_sifter = self._make_sifter('not_batch_sifter', (
+            '#!/bin/bash\n'
+            'echo report.csv\n'
+        ))
+        with self.assertRaisesRegexp(SifterException, 'batch-manifest'):
+            sift_batch(not_batch_sifter, courses, 'venv', 'edx', [])
+
+    def test_delta_reports(self):
+        """
+        Make sure keyed CSV reports are stored as deltas against the
+        last report, with the full report when a snapshot is due.
+        """
+        temp_dir = self._mock_fs_settings()
+        state_dir = mkdtemp_clean(self)
+        source = os.path.join(state_dir, 'source.csv')
+        delta_sifter = self._make_sifter('delta_sifter', (
+            '#!/bin/bash\n'
+            'echo grades.csv\n'
+            'cat {0}\n'.format(source)
+        ))
+        with open('{0}.yml'.format(delta_sifter), 'w') as manifest_file:
+            manifest_file.write('delta_key: [username]\n')
+        course_dir = os.path.join(temp_dir, 'course')
+
+        def run(report, extra_args=None, sifter=delta_sifter):
+            """
+            Run the sifter with the report and return what it stored
+            """
+            with open(source, 'w') as source_file:
+                source_file.write(report)
+            shutil.rmtree(course_dir, ignore_errors=True)
+            run_sifter(sifter, 'course', 'venv', 'edx',
+                       extra_args or [], state_dir=state_dir)
+            stored = {}
+            for filename in os.listdir(course_dir):
+                with open(os.path.join(course_dir, filename)) as report:
+                    stored[filename] = report.read()
+            return stored
+
+        # The first report has nothing to compare with
+        self.assertEqual(run('username,grade\nalice,1\nbob,2\n'),
+                         {'grades.csv': 'username,grade\nalice,1\nbob,2\n'})
+        self.assertEqual(
+            run('username,grade\nalice,1\nbob,3\ncarol,4\n'),
+            {'grades.delta.csv': 'change,username,grade\r\n'
+                                 'changed,bob,3\r\nadded,carol,4\r\n'}
+        )
+        self.assertEqual(
+            run('username,grade\nbob,3\ncarol,4\n'),
+            {'grades.delta.csv': 'change,username,grade\r\n'
+                                 'removed,alice,1\r\n'}
+        )
+        # Runs with other arguments are compared among themselves
+        self.assertEqual(run('username,grade\nbob,3\n', ['--all']),
+                         {'grades.csv': 'username,grade\nbob,3\n'})
+
+        with open('{0}.yml'.format(delta_sifter), 'a') as manifest_file:
+            manifest_file.write('snapshot_days: 0\n')
+        self.assertEqual(sorted(run('username,grade\nbob,3\n')),
+                         ['grades.csv', 'grades.delta.csv'])
+        # Reports that can't be compared are stored in full
+        self.assertEqual(run('username,score\nbob,3\n'),
+                         {'grades.csv': 'username,score\nbob,3\n'})
+        self.assertEqual(run('username,score\nbob,3\nbob,4\n'),
+                         {'grades.csv': 'username,score\nbob,3\nbob,4\n'})
+
+        # Reports named differently on every run, like the dated
+        # ones of dump_grades, only get a full report when it's due
+        dated_sifter = self._make_sifter('dated_sifter', (
+            '#!/bin/bash\n'
+            'echo grades_$(date +%s%N).csv\n'
+            'cat {0}\n'.format(source)
+        ))
+        with open('{0}.yml'.format(dated_sifter), 'w') as manifest_file:
+            manifest_file.write('delta_key: [username]\n')
+        first = run('username,grade\nbob,3\n', sifter=dated_sifter)
+        second = run('username,grade\nbob,4\n', sifter=dated_sifter)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+        self.assertNotEqual(first.keys(), second.keys())
+        self.assertTrue(second.keys()[0].endswith('.delta.csv'))
+        reports = DeltaReports(state_dir)
+        self.assertFalse(reports.snapshot_due('dated_sifter', [],
+                                              'course', 7))
+        self.assertTrue(reports.snapshot_due('dated_sifter', ['--all'],
+                                             'course', 7))
+        with open('{0}.yml'.format(dated_sifter), 'a') as manifest_file:
+            manifest_file.write('snapshot_days: 0\n')
+        self.assertEqual(
+            len(run('username,grade\nbob,5\n', sifter=dated_sifter)), 2
+        )
+
+        # Files stored along with the report keep counting to its size
+        attachment_dir = os.path.join(mkdtemp_clean(self), 'profile')
+        os.mkdir(attachment_dir)
+        attachment = os.path.join(attachment_dir, 'profile.pstats')
+        with open(attachment, 'w') as attachment_file:
+            attachment_file.write('profile')
+        spool = StringIO('grades.csv\nusername,grade\nbob,3\n')
+        output = SifterOutput('course', spool, sifter='delta_sifter')
+        output.attach([('grades_profile.pstats', attachment)],
+                      attachment_dir)
+        self.addCleanup(output.close)
+        reports.apply(output, [], ['username'], 7)
+        self.assertEqual(output.size, sum(
+            os.path.getsize(path)
+            for _, path in output.outputs + output.attachments
+        ))
+        self.assertEqual(len(output.outputs), 1)
+
+    def test_store_many_rollback(self):
+        """
+        Make sure a failed file discards the rest of its set
+        """
+        temp_dir = mkdtemp_clean(self)
+        good_path = os.path.join(temp_dir, 'good.csv')
+        with open(good_path, 'w') as good_file:
+            good_file.write('good')
+        data_store = FSStore({'root_path': os.path.join(temp_dir, 'store')})
+        with self.assertRaises(IOError):
+            data_store.store_many('course', [
+                ('good.csv', good_path),
+                ('bad.csv', os.path.join(temp_dir, 'missing.csv')),
+            ])
+        self.assertEqual(
+            os.listdir(os.path.join(temp_dir, 'store', 'course')), []
+        )
+
+    def test_store_identical_copies(self):
+        """
+        Make sure content the store already wrote is linked rather
+        than written again, and replacing a file leaves its copies.
+        """
+        temp_dir = mkdtemp_clean(self)
+        notice_path = os.path.join(temp_dir, 'notice.pdf')
+        with open(notice_path, 'w') as notice_file:
+            notice_file.write('notice')
+        data_store = FSStore({'root_path': os.path.join(temp_dir, 'store')})
+        with patch('xsiftx.store.shutil.copyfile',
+                   side_effect=shutil.copyfile) as mock_copy:
+            for course in ('course1', 'course2', 'course3'):
+                data_store.store_many(course, [('notice.pdf', notice_path)])
+        self.assertEqual(mock_copy.call_count, 1)
+        first = data_store.path_for('course1', 'notice.pdf')
+        self.assertEqual(os.stat(first).st_nlink, 3)
+
+        with open(notice_path) as notice_file:
+            data_store.store('course4', 'notice.pdf', notice_file)
+        self.assertEqual(os.stat(first).st_nlink, 4)
+        data_store.store('course1', 'notice.pdf', StringIO('changed'))
+        with open(data_store.path_for('course2', 'notice.pdf')) as copy:
+            self.assertEqual(copy.read(), 'notice')
+        with open(first) as changed:
+            self.assertEqual(changed.read(), 'changed')
+        self.assertEqual(sorted(os.listdir(os.path.dirname(first))),
+                         ['notice.pdf'])
+
+    @patch('boto.s3.connection.S3Connection')
+    def test_s3_identical_copies(self, mock_connection):
+        """
+        Make sure S3 copies content it already uploaded server side
+        """
+        bucket = mock_connection.return_value.get_bucket.return_value
+        data_store = S3Store({'root_path': 'reports', 'bucket': 'grades',
+                              'aws_key_id': '', 'aws_key': ''})
+        with patch('boto.s3.key.Key.set_contents_from_string') as mock_put:
+            for course in ('course1', 'course2'):
+                data_store.store(course, 'notice.pdf', StringIO('notice'))
+        self.assertEqual(mock_put.call_count, 1)
+        # The copy is staged and then copied into place
+        headers = {'Content-Type': 'application/pdf'}
+        staging_name = bucket.copy_key.call_args_list[0][0][0]
+        self.assertTrue(staging_name.startswith(
+            'reports/{0}/'.format(S3_STAGING_PREFIX)
+        ))
+        self.assertEqual(bucket.copy_key.call_args_list, [
+            call(staging_name, 'grades',
+                 data_store.key_for('course1', 'notice.pdf').key,
+                 metadata={}, headers=headers),
+            call(data_store.key_for('course2', 'notice.pdf').key,
+                 'grades', staging_name, metadata={}, headers=headers),
+        ])
+        bucket.delete_key.assert_called_once_with(staging_name)
+
+        # Sets of files are stored on the same threads, and so the same
+        # connections, from one course to the next
+        temp_dir = mkdtemp_clean(self)
+        notice_path = os.path.join(temp_dir, 'notice.pdf')
+        with open(notice_path, 'w') as notice_file:
+            notice_file.write('notice')
+        self.addCleanup(data_store.close)
+        threads = set()
+        bucket.copy_key.side_effect = (
+            lambda *args, **kwargs: threads.add(threading.current_thread())
+        )
+        for course in ('course3', 'course4', 'course5'):
+            data_store.store_many(course, [
+                ('{0}.csv'.format(index), notice_path)
+                for index in range(STORE_THREADS)
+            ])
+        self.assertEqual(bucket.copy_key.call_count,
+                         2 * (3 * STORE_THREADS + 1))
+        # pylint: disable=W0212
+        self.assertLessEqual(threads, set(data_store.pool._pool))
+        self.assertLessEqual(mock_connection.call_count, STORE_THREADS + 1)
+
+    @patch('boto.s3.connection.S3Connection')
+    def test_s3_failed_set_keeps_published(self, mock_connection):
+        """
+        Make sure a set of files that fails to store in S3 leaves the
+        files published before it in place.
+        """
+        bucket = mock_connection.return_value.get_bucket.return_value
+        data_store = S3Store({'root_path': 'reports', 'bucket': 'grades',
+                              'aws_key_id': '', 'aws_key': ''})
+        self.addCleanup(data_store.close)
+        temp_dir = mkdtemp_clean(self)
+        report_path = os.path.join(temp_dir, 'grades.csv')
+        with open(report_path, 'w') as report_file:
+            report_file.write('grades')
+        published = data_store.key_for('course', 'grades.csv').key
+
+        with patch('boto.s3.key.Key.set_contents_from_filename') as mock_put:
+            data_store.store_many('course', [('grades.csv', report_path)])
+            self.assertEqual(bucket.copy_key.call_args[0][0], published)
+            bucket.reset_mock()
+            with self.assertRaises(IOError):
+                data_store.store_many('course', [
+                    ('grades.csv', report_path),
+                    ('missing.csv', os.path.join(temp_dir, 'missing.csv')),
+                ])
+        self.assertEqual(mock_put.call_count, 1)
+        # Only the staged copy is deleted and nothing is copied into
+        # place, so the published report survives
+        self.assertNotIn(published, [
+            args[0][0] for args in bucket.copy_key.call_args_list
+        ])
+        staged_names = [
+            args[0][0] for args in bucket.delete_key.call_args_list
+        ]
+        self.assertEqual(len(staged_names), 1)
+        self.assertNotEqual(staged_names[0], published)
+        self.assertTrue(staged_names[0].startswith(
+            'reports/{0}/'.format(S3_STAGING_PREFIX)
+        ))
+
+    def test_sifter_progress(self):
+        """
+        Make sure progress lines a sifter writes to its progress
+        file descriptor reach the callback, skipping malformed ones.
+        """
+        self._mock_fs_settings()
+        progress_sifter = self._make_sifter('progress_sifter', (
+            '#!/bin/bash\n'
+            'echo 1/3 >&$XSIFTX_PROGRESS_FD\n'
+            'echo not progress >&$XSIFTX_PROGRESS_FD\n'
+            'echo 3/3 >&$XSIFTX_PROGRESS_FD\n'
+            'echo progress.txt\n'
+            'echo done\n'
+        ))
+        updates = []
+        run_sifter(progress_sifter, 'course', 'venv', 'edx', [],
+                   progress=lambda *update: updates.append(update))
+        self.assertEqual(updates, [(1, 3), (3, 3)])
+
+        # Without a listener the sifter still runs
+        run_sifter(progress_sifter, 'course', 'venv', 'edx', [])
+
+        with patch.dict(os.environ, {PROGRESS_FD_ENV: '1000'}):
+            report_progress(1, 2)
+
+        # In process sifters report to a callback while it is set
+        updates = []
+        with progress_callback(lambda *update: updates.append(update)):
+            report_progress(2, 4)
+        report_progress(3, 4)
+        self.assertEqual(updates, [(2, 4)])
+
+    def test_cancel_sifter(self):
+        """
+        Make sure cancelling a run with SIGTERM kills the whole
+        process tree of the sifter.
+        """
+        self._mock_fs_settings()
+        pid_path = os.path.join(mkdtemp_clean(self), 'pid')
+        slow_sifter = self._make_sifter('slow_sifter', (
+            '#!/bin/bash\n'
+            'sleep 60 &\n'
+            'echo $! > {0}\n'
+            'wait\n'.format(pid_path)
+        ))
+        previous = signal.getsignal(signal.SIGTERM)
+        timer = threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        with self.assertRaises(SifterCancelledException):
+            with cancel_on_signal():
+                run_sifter(slow_sifter, 'course', 'venv', 'edx', [])
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous)
+        with open(pid_path) as pid_file:
+            stat_path = '/proc/{0}/stat'.format(pid_file.read().strip())
+        # Gone, or a zombie waiting to be reaped
+        if os.path.exists(stat_path):
+            with open(stat_path) as stat_file:
+                self.assertEqual(stat_file.read().split()[2], 'Z')
+
+    def test_sifter_tools(self):
+        """
+        Make sure the streaming helpers for sifters fetch querysets
+        in primary key chunks and write CSV reports as they go.
+        """
+        rows = [{'pk': pk, 'state': '{{"n": {0}}}'.format(pk)}
+                for pk in range(4500, 0, -1)]
+        queryset = FakeQuerySet(rows)
+        values = list(iter_values(queryset, ('state',), chunk_size=2000))
+        self.assertEqual(values[0], ('{"n": 1}',))
+        self.assertEqual(len(values), 4500)
+        self.assertEqual(len(queryset.fetched), 3)
+        self.assertEqual([load_state(state)['n'] for state, in values],
+                         range(1, 4501))
+
+        queryset = FakeQuerySet(rows[:4000])
+        objects = list(iter_chunked(queryset, chunk_size=2000))
+        self.assertEqual([obj.pk for obj in objects], range(501, 4501))
+        # The last chunk is empty since it can't know it's the last
+        self.assertEqual(len(queryset.fetched), 3)
+
+        for state in (None, '', 'not json', '[1]'):
+            self.assertEqual(load_state(state), {})
+        self.assertEqual(load_state(None, {'attempts': 0}), {'attempts': 0})
+
+        output = StringIO()
+        count = write_csv('report.csv', iter([[u'caf\xe9', 1], ['b', 2]]),
+                          header=['name', 'count'], output=output)
+        self.assertEqual(count, 2)
+        self.assertEqual(output.getvalue(),
+                         'report.csv\nname,count\r\ncaf\xc3\xa9,1\r\nb,2\r\n')
+
+    @patch('xsiftx.tools.get_modulestore')
+    def test_course_structure(self, mock_modulestore):
+        """
+        Make sure course structures are cached in the state directory
+        until the course is published again.
+        """
+        store = mock_modulestore.return_value
+        store.get_course.return_value.course_version = 'v1'
+        location = Mock()
+        location.__unicode__ = Mock(return_value=u'i4x://org/num/problem/p1')
+        location.name = 'p1'
+        store.get_items.return_value = [
+            Mock(location=location, category='problem', display_name=u'P1')
+        ]
+
+        # Without a state directory nothing is cached
+        with patch.dict(os.environ, {}):
+            os.environ.pop(STATE_DIR_ENV, None)
+            get_course_structure('org/num/run')
+            get_course_structure('org/num/run')
+        self.assertEqual(store.get_items.call_count, 2)
+
+        with patch.dict(os.environ, {STATE_DIR_ENV: mkdtemp_clean(self)}):
+            for _ in range(3):
+                modules = get_course_structure('org/num/run')
+            self.assertEqual(store.get_items.call_count, 3)
+            self.assertEqual(
+                [module.to_list() for module in modules],
+                [[u'i4x://org/num/problem/p1', 'problem', u'P1', 'p1']]
+            )
+            store.get_course.return_value.course_version = 'v2'
+            get_course_structure('org/num/run')
+            get_course_structure('org/num/run')
+            self.assertEqual(store.get_items.call_count, 4)
+
+            # Old Mongo courses have no version, and their edit times
+            # aren't one, so they are walked every time
+            old_course = store.get_course.return_value
+            old_course.course_version = None
+            old_course.subtree_edited_on = datetime(2014, 1, 1)
+            old_course.edited_on = datetime(2014, 1, 1)
+            get_course_structure('org/num/old')
+            get_course_structure('org/num/old')
+            self.assertEqual(store.get_items.call_count, 6)
+
+    def test_sifter_state_dir(self):
+        """
+        Make sure sifters are told the state directory
+        """
+        temp_dir = self._mock_fs_settings()
+        state_dir = mkdtemp_clean(self)
+        state_sifter = self._make_sifter('state_sifter', (
+            '#!/bin/bash\n'
+            'echo state.txt\n'
+            'echo $XSIFTX_STATE_DIR\n'
+        ))
+        run_sifter(state_sifter, 'course', 'venv', 'edx', [],
+                   state_dir=state_dir)
+        with open(os.path.join(temp_dir, 'course', 'state.txt')) as report:
+            self.assertEqual(report.read(), state_dir + '\n')
+
+    @patch('xsiftx.util.sifter_log')
+    def test_stderr_tail(self, mock_log):
+        """
+        Make sure sifter stderr is logged as it's written and only
+        its tail is kept in the error.
+        """
+        self._mock_fs_settings()
+        noisy_sifter = self._make_sifter('noisy_sifter', (
+            '#!/bin/bash\n'
+            'for i in $(seq 1 20000); do echo "warning $i" >&2; done\n'
+            'exit 1\n'
+        ))
+        with self.assertRaises(SifterException) as exception_context:
+            run_sifter(noisy_sifter, 'course', 'venv', 'edx', [])
+        message = str(exception_context.exception)
+        self.assertLess(len(message), STDERR_TAIL + 1024)
+        self.assertIn('earlier output truncated', message)
+        self.assertTrue(message.endswith('warning 20000\n'))
+        self.assertNotIn('warning 1\n', message)
+        self.assertEqual(mock_log.info.call_count, 20000)
+        self.assertEqual(mock_log.info.call_args[0][1:],
+                         ('noisy_sifter', 'warning 20000'))
+
+    def test_precompiled_python_sifter(self):
+        """
+        Make sure Python script sifters are run from code cached in
+        the state directory as though the script itself was run, and
+        recompiled when they change.
+        """
+        temp_dir = self._mock_fs_settings()
+        state_dir = mkdtemp_clean(self)
+        script = (
+            '#!{0}\n'
+            'import os, sys\n'
+            'import helper\n'
+            'print("python.txt")\n'
+            'print(__file__ == sys.argv[0] == helper.SIFTER)\n'
+            'print(sys.argv[1:] == ["venv", "edx", "course", "arg"])\n'
+            'print(__name__)\n'.format(sys.executable)
+        )
+        python_sifter = self._make_sifter('python_sifter', script)
+        with open(os.path.join(os.path.dirname(python_sifter),
+                               'helper.py'), 'w') as helper_file:
+            helper_file.write('SIFTER = {0!r}\n'.format(python_sifter))
+        report_path = os.path.join(temp_dir, 'course', 'python.txt')
+        bytecode_dir = os.path.join(state_dir, 'bytecode')
+        expected = 'True\nTrue\n__main__\n'
+
+        run_sifter(python_sifter, 'course', 'venv', 'edx', ['arg'])
+        with open(report_path) as report:
+            self.assertEqual(report.read(), expected)
+
+        for _ in range(2):
+            run_sifter(python_sifter, 'course', 'venv', 'edx', ['arg'],
+                       state_dir=state_dir)
+            with open(report_path) as report:
+                self.assertEqual(report.read(), expected)
+            self.assertEqual(len(os.listdir(bytecode_dir)), 1)
+
+        with open(python_sifter, 'a') as sifter_file:
+            sifter_file.write('print("changed")\n')
+        run_sifter(python_sifter, 'course', 'venv', 'edx', ['arg'],
+                   state_dir=state_dir)
+        with open(report_path) as report:
+            self.assertEqual(report.read(), expected + 'changed\n')
+        self.assertEqual(len(os.listdir(bytecode_dir)), 2)
+
+    def test_profile_sifter(self):
+        """
+        Make sure profiled Python sifters store their profile and
+        collapsed stacks next to their report.
+        """
+        temp_dir = self._mock_fs_settings()
+        course_dir = os.path.join(temp_dir, 'course')
+        python_sifter = self._make_sifter('python_sifter', (
+            '#!{0}\n'
+            'def busy():\n'
+            '    return sum(i * i for i in range(2000000))\n'
+            'busy()\n'
+            'print("python.txt")\n'.format(sys.executable)
+        ))
+
+        def profiled_functions():
+            """
+            Returns the functions in the stored profile, and the
+            contents of the stored collapsed stacks
+            """
+            profiles = sorted(os.listdir(course_dir))
+            self.assertEqual(len(profiles), 2)
+            self.assertTrue(profiles[0].endswith('.collapsed.txt'))
+            self.assertTrue(profiles[1].endswith('.pstats'))
+            stats = pstats.Stats(os.path.join(course_dir, profiles[1]))
+            with open(os.path.join(course_dir, profiles[0])) as collapsed:
+                return [func[2] for func in stats.stats], collapsed.read()
+
+        run_sifter(python_sifter, 'course', 'venv', 'edx', [], profile=True)
+        os.remove(os.path.join(course_dir, 'python.txt'))
+        functions, collapsed = profiled_functions()
+        self.assertIn('busy', functions)
+        self.assertIn('python_sifter:busy', collapsed)
+
+        # In process sifters too
+        shutil.rmtree(course_dir)
+
+        def rows_sifter(venv, edx_platform, course, extra_args, since=None):
+            """
+            Yield a CSV report
+            """
+            # pylint: disable=W0613
+            yield 'rows.csv'
+            yield ['course']
+            yield [course]
+        with patch('xsiftx.util.load_python_sifter',
+                   return_value=rows_sifter):
+            run_sifter('python:rows', 'course', 'venv', 'edx', [],
+                       profile=True)
+        os.remove(os.path.join(course_dir, 'rows.csv'))
+        functions, _ = profiled_functions()
+        self.assertIn('rows_sifter', functions)
+
+    def test_report_catalog(self):
+        """
+        Make sure stored reports, single or from a manifest, are
+        recorded in the catalog with their size and hash.
+        """
+        temp_dir = self._mock_fs_settings()
+        state_dir = mkdtemp_clean(self)
+        single_sifter = self._make_sifter('single_sifter', (
+            '#!/bin/bash\n'
+            'echo report.csv\n'
+            'echo data\n'
+        ))
+        run_sifter(single_sifter, 'course', 'venv', 'edx', [],
+                   state_dir=state_dir)
+        multi_sifter = self._make_sifter('multi_sifter', (
+            '#!/bin/bash\n'
+            'echo one > $XSIFTX_OUTPUT_DIR/one.csv\n'
+            'echo xsiftx-output-manifest\n'
+            'echo one.csv\n'
+        ))
+        run_sifter(multi_sifter, 'course', 'venv', 'edx', [],
+                   state_dir=state_dir)
+
+        catalog = ReportCatalog(state_dir)
+        reports = dict(
+            (report['filename'], report)
+            for report in catalog.reports('course')
+        )
+        self.assertEqual(sorted(reports), ['one.csv', 'report.csv'])
+        self.assertEqual(reports['report.csv']['sifter'], 'single_sifter')
+        self.assertEqual(reports['report.csv']['size'], 5)
+        self.assertEqual(reports['report.csv']['sha256'],
+                         hashlib.sha256('data\n').hexdigest())
+        self.assertEqual(reports['report.csv']['location'],
+                         os.path.join(temp_dir, 'course', 'report.csv'))
+        self.assertEqual(reports['one.csv']['sifter'], 'multi_sifter')
+        self.assertEqual(reports['one.csv']['sha256'],
+                         hashlib.sha256('one\n').hexdigest())
+        self.assertEqual(catalog.reports('other'), [])
+        self.assertEqual(
+            [report['filename']
+             for report in catalog.reports(sifter='multi_sifter')],
+            ['one.csv']
+        )
+
+    def test_upload_pipeline(self):
+        """
+        Make sure the pipeline stores in the background, holds
+        sifting back once its spool budget is used, and reports
+        failed uploads.
+        """
+        release = threading.Event()
+
+        class SlowStore(object):
+            """
+            Store that waits to be released and fails on request
+            """
+            # pylint: disable=R0903
+            def __init__(self):
+                self.stored = []
+
+            def store(self, course, *_):
+                """
+                Pretend to upload
+                """
+                release.wait()
+                if course == 'bad':
+                    raise IOError('upload failed')
+                self.stored.append(course)
+
+        def make_output(course, size):
+            """
+            Fake sifter output of the given size
+            """
+            output = Mock(course=course, size=size)
+            output.store.side_effect = lambda data_store: data_store.store(
+                course
+            )
+            return output
+
+        data_store = SlowStore()
+        pipeline = UploadPipeline(data_store, max_spool=100)
+        pipeline.submit(make_output('first', 60), 'first')
+        self.assertEqual(pipeline.spooled, 60)
+
+        # Second output doesn't fit until the first is stored
+        submitted = threading.Event()
+        blocked = threading.Thread(target=lambda: (
+            pipeline.submit(make_output('bad', 60), 'bad'), submitted.set()
+        ))
+        blocked.start()
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        blocked.join()
+
+        results = dict(pipeline.close())
+        self.assertEqual(data_store.stored, ['first'])
+        self.assertIsNone(results['first'])
+        self.assertIsInstance(results['bad'], IOError)
+        self.assertEqual(pipeline.spooled, 0)
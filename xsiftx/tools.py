@@ -1,10 +1,58 @@
 """
 Tools for use by sifters to assist in setting up
 the django environment, output files, etc.
+
+Sifters reading course content should get the modulestore with
+``get_modulestore`` and the modules of a course with
+``get_course_structure``, which is cached on disk between runs until
+the course is published again.
+
+Sifters over large courses should stream: iterate querysets in
+primary key chunks with ``iter_values`` or ``iter_chunked`` rather
+than looping over them, which caches every row, and write reports
+with ``write_csv`` straight to standard out rather than building
+them in memory first.
+
+Sifters that pay a large fixed cost per run can opt in to sifting
+many courses at once with ``batch: true`` in their manifest. They are
+then given ``-`` instead of a course ID, read the courses with
+``get_batch_courses``, write each course's reports under
+``batch_output_path`` and finish with ``write_batch_manifest``.
 """
 
+import contextlib
+import csv
+import hashlib
+import json
 import os
 import sys
+import tempfile
+import urllib
+
+# Whether this process has already started the LMS, so in process
+# Python sifters in a warm worker only pay for it once.
+_LMS_ENTERED = []
+
+# The modulestore set up by get_modulestore for this process
+_MODULESTORE = []
+
+# Directory of the course structure cache in the xsiftx state
+# directory, which is passed to sifters in XSIFTX_STATE_DIR
+STATE_DIR_ENV = 'XSIFTX_STATE_DIR'
+STRUCTURE_CACHE_DIR = 'structure'
+
+# Course ID argument given to batch sifters, which read the courses
+# from standard in instead, one per line
+BATCH_COURSE_ARG = '-'
+
+# Rows fetched per query when iterating a queryset in chunks
+QUERY_CHUNK_SIZE = 2000
+
+# Environment variable with the file descriptor a sifter reports its
+# progress on, and the callback set by progress_callback for Python
+# sifters run in process.
+PROGRESS_FD_ENV = 'XSIFTX_PROGRESS_FD'
+_PROGRESS_CALLBACK = []
 
 
 def use_edx_venv(venv_path):
@@ -20,12 +68,296 @@ def enter_lms(venv_path, edx_path):
     """
     This will activate the edx virtual environment, and
     setup the environment as though the script was included
-    in the lms project.
+    in the lms project. It is safe to call again in the same process.
     """
     # pylint: disable=F0401
+    if _LMS_ENTERED:
+        return
     use_edx_venv(venv_path)
     sys.path.append(edx_path)
     os.environ['DJANGO_SETTINGS_MODULE'] = 'lms.envs.aws'
     os.environ['SERVICE_VARIANT'] = 'lms'
     import lms.startup as startup
     startup.run()
+    _LMS_ENTERED.append((venv_path, edx_path))
+
+
+@contextlib.contextmanager
+def progress_callback(callback):
+    """
+    Call the callback with the progress reported within the context,
+    instead of writing it to the progress file descriptor. A callback
+    of None leaves progress to the file descriptor.
+    """
+    _PROGRESS_CALLBACK[:] = [callback] if callback else []
+    try:
+        yield
+    finally:
+        del _PROGRESS_CALLBACK[:]
+
+
+def report_progress(done, total):
+    """
+    Report that the sifter has finished ``done`` of ``total`` units
+    of its work, e.g. problems or modules, so the LTI interface can
+    show how far along it is. Does nothing when nobody is listening.
+    """
+    if _PROGRESS_CALLBACK:
+        _PROGRESS_CALLBACK[0](done, total)
+        return
+    progress_fd = os.environ.get(PROGRESS_FD_ENV, None)
+    if not progress_fd:
+        return
+    try:
+        os.write(int(progress_fd), '{0}/{1}\n'.format(done, total))
+    except (OSError, ValueError):
+        # Progress is best effort, the run goes on without it
+        pass
+
+
+def get_modulestore():
+    """
+    Returns the LMS modulestore with the metadata inheritance cache,
+    request cache and update signal wired in, which makes walking a
+    course much faster. It's only set up once per process and must be
+    called after ``enter_lms``.
+    """
+    # pylint: disable=F0401
+    if _MODULESTORE:
+        return _MODULESTORE[0]
+    from django.core.cache import get_cache
+    from django.dispatch import Signal
+    from request_cache.middleware import RequestCache
+    from xmodule.modulestore.django import modulestore
+
+    store = modulestore()
+    store.metadata_inheritance_cache_subsystem = get_cache(
+        'mongo_metadata_inheritance'
+    )
+    store.request_cache = RequestCache.get_request_cache()
+    store.modulestore_update_signal = Signal(providing_args=[
+        'modulestore', 'course_id', 'location',
+    ])
+    _MODULESTORE.append(store)
+    return store
+
+
+class CourseModule(object):
+    """
+    The parts of a module of a course sifters need, which unlike the
+    module itself can be cached. ``location`` is the string form of
+    its usage key, e.g. ``i4x://MITx/3.091r/problem/p1``.
+    """
+    # pylint: disable=R0903
+
+    def __init__(self, location, category, display_name, name):
+        """
+        Hold the module's details
+        """
+        self.location = location
+        self.category = category
+        self.display_name = display_name
+        self.name = name
+
+    def to_list(self):
+        """
+        The module's details as stored in the cache
+        """
+        return [self.location, self.category, self.display_name, self.name]
+
+
+def _course_version(store, course_key):
+    """
+    Returns the version the course was last published as, or None for
+    courses without one, like those in the old Mongo modulestore, whose
+    edit times aren't reliably updated by every publish.
+    """
+    course = store.get_course(course_key, depth=0)
+    version = getattr(course, 'course_version', None)
+    if version:
+        return unicode(version)
+    return None
+
+
+def get_course_structure(course_key):
+    """
+    Returns a CourseModule for each module of the course, in the order
+    ``get_items`` gives them. When run by xsiftx with a state
+    directory, they are cached there by course and published version,
+    so other runs on the course skip walking it in the modulestore
+    until it's published again. Courses without a published version
+    are walked every time.
+    """
+    store = get_modulestore()
+    cache_path = None
+    version = None
+    state_dir = os.environ.get(STATE_DIR_ENV, None)
+    if state_dir:
+        version = _course_version(store, course_key)
+    if version:
+        cache_dir = os.path.join(state_dir, STRUCTURE_CACHE_DIR)
+        cache_path = os.path.join(cache_dir, '{0}.json'.format(
+            hashlib.sha1(unicode(course_key).encode('utf-8')).hexdigest()
+        ))
+        try:
+            with open(cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cached['version'] == version:
+                return [CourseModule(*module) for module in cached['modules']]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    modules = [
+        CourseModule(unicode(module.location), module.category,
+                     module.display_name, module.location.name)
+        for module in store.get_items(course_key)
+    ]
+    if cache_path:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            temp_file = tempfile.NamedTemporaryFile(dir=cache_dir,
+                                                    delete=False)
+            with temp_file:
+                json.dump({
+                    'version': version,
+                    'modules': [module.to_list() for module in modules],
+                }, temp_file)
+            os.rename(temp_file.name, cache_path)
+        except (IOError, OSError) as err:
+            sys.stderr.write('Failed to cache the structure of {0}: '
+                             '{1}\n'.format(course_key, err))
+    return modules
+
+
+def _pk_chunks(queryset, chunk_size, pk_of):
+    """
+    Yield lists of up to ``chunk_size`` rows of the queryset, which is
+    ordered by primary key, with ``pk_of`` giving the key of a row.
+    """
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = pk_of(chunk[-1])
+
+
+def iter_chunked(queryset, chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Yield the objects of the queryset, fetching them ``chunk_size``
+    at a time in primary key order, so memory use doesn't grow with
+    the number of rows the way iterating the queryset does.
+    """
+    for chunk in _pk_chunks(queryset.order_by('pk'), chunk_size,
+                            lambda obj: obj.pk):
+        for obj in chunk:
+            yield obj
+
+
+def iter_values(queryset, fields, chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Yield tuples of the fields of the queryset's rows, e.g.
+    ``('student__username', 'state')``, from ``values_list`` queries of
+    ``chunk_size`` rows at a time in primary key order. Skipping model
+    instances is much faster and lighter for large tables.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', *fields)
+    for chunk in _pk_chunks(queryset, chunk_size, lambda row: row[0]):
+        for row in chunk:
+            yield tuple(row[1:])
+
+
+def _csv_value(value):
+    """
+    Encode unicode for the Python 2 csv module
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def write_csv(filename, rows, header=None, output=None, **fmtparams):
+    """
+    Write a CSV report as the sifter's output: the filename line, the
+    optional header and then each row as it's produced, straight to
+    ``output`` (standard out by default). Unicode values are written
+    as UTF-8 and ``fmtparams`` go to ``csv.writer``. Returns the number
+    of rows written.
+    """
+    output = output or sys.stdout
+    output.write('{0}\n'.format(filename))
+    writer = csv.writer(output, **fmtparams)
+    if header:
+        writer.writerow([_csv_value(value) for value in header])
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        count += 1
+    return count
+
+
+def load_state(state, default=None):
+    """
+    Decode the JSON state of a StudentModule, returning ``default``
+    (an empty dictionary unless given) for empty or corrupt state
+    instead of failing the whole report.
+    """
+    if default is None:
+        default = {}
+    if not state:
+        return default
+    try:
+        decoded = json.loads(state)
+    except ValueError:
+        return default
+    if not isinstance(decoded, dict):
+        return default
+    return decoded
+
+
+def get_batch_courses(course_arg):
+    """
+    Returns the courses to sift, given the course ID argument, which
+    is a list of the courses on standard in for a batch run.
+    """
+    if course_arg != BATCH_COURSE_ARG:
+        return [course_arg]
+    return [line.strip() for line in sys.stdin if line.strip()]
+
+
+def batch_output_dir(output_dir, course_id):
+    """
+    Returns the directory in the output directory that the reports
+    of the course go in during a batch run
+    """
+    return os.path.join(output_dir, urllib.quote(course_id, safe=''))
+
+
+def batch_output_path(course_id, filename):
+    """
+    Returns the path to write the course's report to in a batch run,
+    creating its directory if needed.
+    """
+    course_dir = batch_output_dir(os.environ['XSIFTX_OUTPUT_DIR'], course_id)
+    if not os.path.isdir(course_dir):
+        os.makedirs(course_dir)
+    return os.path.join(course_dir, filename)
+
+
+def write_batch_manifest(outputs, output=None):
+    """
+    Print the manifest of a batch run to standard out, given a list of
+    tuples of the course ID and filename of each report written with
+    ``batch_output_path``.
+    """
+    output = output or sys.stdout
+    output.write('xsiftx-batch-manifest\n')
+    for course_id, filename in outputs:
+        output.write('{0}\t{1}\n'.format(course_id, filename))
+    output.flush()
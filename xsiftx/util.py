@@ -1,19 +1,131 @@
 """
 Utility functions for xsiftx.
 """
+import collections
+import contextlib
+import csv
+import fcntl
+import hashlib
 import json
+import logging
 import os
+import resource
+import shutil
+import signal
 import stat
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import traceback
+from distutils.spawn import find_executable
 
 import xsiftx.sifters
-import xsiftx.store
+
+# PyYAML, pkg_resources and the stores (boto) are imported where they
+# are used, since together they take most of the time spent starting
+# the command line, and each sifter run only needs some of them.
+
+log = logging.getLogger('xsiftx')  # pylint: disable=C0103
+# Standard error of sifters is logged here line by line as it's written
+sifter_log = logging.getLogger('xsiftx.sifter')  # pylint: disable=C0103
 
 ENV_JSON_FILENAME = 'lms.env.json'
 AUTH_JSON_FILENAME = 'lms.auth.json'
 VENV = ('edx_venv_path', '/edx/app/edxapp/venvs/edxapp')
 EDX_PLATFORM = ('edx_platform_path', '/edx/app/edxapp/edx-platform')
+STATE_DIR = ('state_dir', os.environ.get(
+    'XSIFTX_STATE_DIR',
+    os.path.join(os.path.expanduser('~'), '.xsiftx')
+))
+
+# A sifter that prints this as its first line is writing several
+# reports. The rest of its output lists their filenames, one per line,
+# relative to the directory given to it in XSIFTX_OUTPUT_DIR.
+OUTPUT_MANIFEST_MARKER = 'xsiftx-output-manifest'
+# First line printed by a batch sifter, followed by lines of the
+# course ID and file name of each report separated by a tab
+BATCH_MANIFEST_MARKER = 'xsiftx-batch-manifest'
+
+# Python sifters are callables registered under this entry point
+# group, and are referred to as this prefix plus the entry point name
+# instead of by path.
+ENTRY_POINT_GROUP = 'xsiftx.sifters'
+PYTHON_SIFTER_PREFIX = 'python:'
+# Bytes of Python sifter output kept in memory before spooling to disk
+PYTHON_SPOOL_SIZE = 8 * 1024 * 1024
+
+# Sidecar manifest files describing a sifter are named after the
+# sifter with this extension added, e.g. copy_file.yml
+MANIFEST_EXTENSION = '.yml'
+# Python script sifters are compiled to marshalled code objects kept
+# in this directory of the state directory, by COMPILE_SCRIPT run with
+# the sifter's own interpreter as: script sifter_path bytecode_path
+BYTECODE_DIR = 'bytecode'
+COMPILE_SCRIPT = (
+    'import marshal, os, sys\n'
+    'with open(sys.argv[1], "rb") as source_file:\n'
+    '    source = source_file.read()\n'
+    'code = compile(source, sys.argv[1], "exec", 0, True)\n'
+    'temp_path = "%s.%d" % (sys.argv[2], os.getpid())\n'
+    'with open(temp_path, "wb") as code_file:\n'
+    '    marshal.dump(code, code_file)\n'
+    'os.rename(temp_path, sys.argv[2])\n'
+)
+# and run by RUN_SCRIPT as: script bytecode_path sifter_path [args],
+# which gives the code the __file__, sys.argv and sys.path[0] it would
+# have run as a script
+RUN_SCRIPT = (
+    'def run(bytecode_path, script):\n'
+    '    import marshal, os, sys\n'
+    '    with open(bytecode_path, "rb") as code_file:\n'
+    '        code = marshal.load(code_file)\n'
+    '    sys.argv = sys.argv[2:]\n'
+    '    sys.path[0] = os.path.dirname(os.path.realpath(script))\n'
+    '    namespace = sys.modules["__main__"].__dict__\n'
+    '    del namespace["run"]\n'
+    '    namespace["__file__"] = script\n'
+    '    exec(code, namespace)\n'
+    'run(*__import__("sys").argv[1:3])\n'
+)
+
+# Defaults for everything a sifter manifest can declare
+MANIFEST_DEFAULTS = {
+    'description': None,
+    'cost_class': None,  # e.g. light or heavy, used for queue routing
+    'arguments': [],  # Extra arguments as dicts of name, help, required
+    'output_type': None,  # Mime type of the report, if one is written
+    'batch': False,  # Whether it can sift many courses in one run
+    'delta_key': None,  # CSV columns keying rows of delta reports
+    'snapshot_days': 7,  # Days between full reports with delta_key
+}
+
+# Resource limits that can be applied to a sifter run, all of them
+# are disabled when unset or None.
+SIFTER_LIMITS = [
+    'timeout',  # Wall clock seconds before the run is killed
+    'max_memory',  # Address space in bytes (RLIMIT_AS)
+    'max_cpu',  # CPU seconds (RLIMIT_CPU)
+    'max_output',  # Bytes of report output allowed
+    'nice',  # Niceness increment for the sifter
+    'ionice',  # IO scheduling class (1-3 or realtime/best-effort/idle)
+    'ionice_level',  # IO priority within the class (0-7)
+]
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# Seconds between the soft and hard CPU limit so the sifter gets
+# SIGXCPU before SIGKILL.
+CPU_LIMIT_GRACE = 5
+# Seconds to wait after SIGTERM before killing the sifter process group
+KILL_GRACE = 5
+# Bounds in seconds of the backoff used while watching a limited sifter
+POLL_INTERVAL = (0.01, 0.25)
+# Bytes at the end of a failed sifter's standard error kept for its
+# error message, and the most read from it at a time
+STDERR_TAIL = 64 * 1024
+STDERR_READ_SIZE = 8 * 1024
+# Longest progress line read from a sifter
+PROGRESS_LINE_SIZE = 256
 
 
 class XsiftxException(Exception):
@@ -25,6 +137,13 @@ class XsiftxException(Exception):
     pass
 
 
+class XsiftxNoConfigException(Exception):
+    """
+    Customized exception for when the configuration doesn't exist
+    """
+    pass
+
+
 class SifterException(Exception):
     """
     Customized exception raised for sifter errors
@@ -32,12 +151,108 @@ class SifterException(Exception):
     pass
 
 
-def get_sifters():
+class SifterLimitException(SifterException):
+    """
+    Raised when a sifter is killed for exceeding one of
+    its resource limits.
+    """
+    pass
+
+
+class SifterCancelledException(SifterException):
+    """
+    Raised when a sifter run is cancelled while it's running
+    """
+    pass
+
+
+def is_python_sifter(sifter):
+    """
+    Whether the sifter is an in process Python sifter
+    """
+    return sifter.startswith(PYTHON_SIFTER_PREFIX)
+
+
+def get_sifter_name(sifter):
     """
-    Get list of currently installed sifters
+    Returns the name of the sifter given its path, or its
+    ``python:<name>`` reference for Python sifters.
     """
+    if is_python_sifter(sifter):
+        return sifter[len(PYTHON_SIFTER_PREFIX):]
+    return os.path.basename(sifter)
 
+
+def load_yaml(stream):
+    """
+    Parse YAML data with the C loader when PyYAML has it
+    """
+    import yaml
+
+    return yaml.load(
+        stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    )
+
+
+def load_python_sifter(sifter):
+    """
+    Load the callable of a Python sifter from its entry point
+    """
+    import pkg_resources
+
+    name = get_sifter_name(sifter)
+    for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP,
+                                                       name):
+        return entry_point.load()
+    raise XsiftxException(
+        'No Python sifter named {0} is installed'.format(name)
+    )
+
+
+def get_sifter_manifest(sifter_path):
+    """
+    Read the sidecar manifest of the sifter at ``sifter_path`` and
+    return it with defaults for anything it doesn't declare. Python
+    sifters declare theirs as a ``manifest`` attribute instead.
+    """
+    import yaml
+
+    manifest = dict(MANIFEST_DEFAULTS)
+    manifest_path = '{0}{1}'.format(sifter_path, MANIFEST_EXTENSION)
+    if is_python_sifter(sifter_path):
+        manifest.update(
+            getattr(load_python_sifter(sifter_path), 'manifest', None) or {}
+        )
+    elif os.path.isfile(manifest_path):
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest.update(load_yaml(manifest_file) or {})
+        except yaml.YAMLError as err:
+            raise XsiftxException(
+                'Invalid sifter manifest {0}: {1}'.format(manifest_path, err)
+            )
+    manifest['path'] = sifter_path
+    return manifest
+
+
+def get_sifters(with_manifests=False, python_sifters=True):
+    """
+    Get list of currently installed sifters, as a dictionary of
+    sifter name to path, or to manifest if ``with_manifests`` is set.
+    Python sifters come first, so executables can override them, and
+    are left out without ``python_sifters`` since scanning their entry
+    points is slow.
+    """
     sifter_dict = {}
+    if python_sifters:
+        import pkg_resources
+
+        for entry_point in pkg_resources.iter_entry_points(
+                ENTRY_POINT_GROUP):
+            sifter_dict[entry_point.name] = '{0}{1}'.format(
+                PYTHON_SIFTER_PREFIX, entry_point.name
+            )
+
     # List of paths to look for sifters, ordered
     # in reverse precedence (most important last)
     # to replace sifter dictionary
@@ -60,9 +275,37 @@ def get_sifters():
                     if mode & executable:
                         sifter_dict[filename] = fullpath
 
+    if with_manifests:
+        sifter_dict = dict(
+            (name, get_sifter_manifest(path))
+            for name, path in sifter_dict.items()
+        )
     return sifter_dict
 
 
+def find_sifter(name):
+    """
+    Returns the path of the sifter with the name, or None if there is
+    none. Python sifters are only looked for when no executable has
+    the name.
+    """
+    sifter = get_sifters(python_sifters=False).get(name, None)
+    if sifter is None:
+        sifter = get_sifters().get(name, None)
+    return sifter
+
+
+def get_state_path(state_dir, filename):
+    """
+    Return the path of a file in the xsiftx state directory,
+    creating the directory if needed.
+    """
+    state_dir = os.path.expanduser(state_dir)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, 0o700)
+    return os.path.join(state_dir, filename)
+
+
 def get_course_list(venv, edx_root):
     """
     Get a list of courses by using the management commands in edx.
@@ -89,6 +332,33 @@ def get_course_list(venv, edx_root):
     return course_raw.split('\n')[:-1]
 
 
+def get_course_activity(venv, edx_root):
+    """
+    Get a dictionary of course ID to activity watermark, the latest
+    StudentModule modification time, for every course with activity.
+    """
+    activity_raw = ''
+    try:
+        activity_raw = subprocess.check_output(
+            [sys.executable, '-m', 'xsiftx.activity', venv, edx_root],
+            cwd=edx_root, stderr=subprocess.PIPE
+        )
+    except OSError as ex:
+        raise XsiftxException(
+            'No such file or directory: {0!r}\n'.format(str(ex))
+        )
+
+    except subprocess.CalledProcessError as ex:
+        raise XsiftxException(
+            'Course activity probe failed, output was: {0!r}\n'.format(
+                ex.output
+            )
+        )
+    return dict(
+        line.split('\t', 1) for line in activity_raw.split('\n') if line
+    )
+
+
 def get_settings(edx_root):
     """
     This will pull out the json settings for the
@@ -135,45 +405,760 @@ def get_settings(edx_root):
                 bucket=bucket, root_path=root_path, use_s3=use_s3)
 
 
-def run_sifter(sifter, course, venv, edx_platform, extra_args):
+def _limit_preexec(limits):
     """
-    This handles running the actual sifter given a course
-    and sifter
+    Build the function run in the sifter child before exec. It
+    places the sifter in its own process group, so the whole tree
+    can be killed together, and applies the kernel enforced limits.
     """
-    settings = get_settings(edx_platform)
-    data_store = None
+    def preexec():
+        """
+        Runs in the forked child
+        """
+        os.setsid()
+        if limits.get('max_memory'):
+            max_memory = int(limits['max_memory'])
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+        if limits.get('max_cpu'):
+            max_cpu = int(limits['max_cpu'])
+            resource.setrlimit(resource.RLIMIT_CPU,
+                               (max_cpu, max_cpu + CPU_LIMIT_GRACE))
+        if limits.get('nice'):
+            os.nice(int(limits['nice']))
+    return preexec
+
+
+def _children_cpu():
+    """
+    CPU seconds used by the children of this process reaped so far
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _ionice_prefix(limits):
+    """
+    Return the command prefix needed to run the sifter with the
+    requested IO priority, or an empty list if none was requested.
+    """
+    io_class = limits.get('ionice', None)
+    if io_class is None:
+        return []
+    io_class = IONICE_CLASSES.get(io_class, io_class)
+    ionice = find_executable('ionice')
+    if not ionice:
+        raise XsiftxException(
+            'An ionice limit was specified, but ionice is not installed'
+        )
+    prefix = [ionice, '-c', str(io_class)]
+    if limits.get('ionice_level') is not None and int(io_class) != 3:
+        prefix.extend(['-n', str(limits['ionice_level'])])
+    return prefix
+
+
+def _python_interpreter(sifter):
+    """
+    Returns the interpreter command from the shebang of a Python
+    script sifter as a list, or None for any other sifter.
+    """
+    try:
+        with open(sifter) as sifter_file:
+            first_line = sifter_file.readline(256)
+    except IOError:
+        return None
+    if not first_line.startswith('#!'):
+        return None
+    command = first_line[2:].split()
+    program = command[:1]
+    if program and os.path.basename(program[0]) == 'env':
+        program = command[1:2]
+    if program and os.path.basename(program[0]).startswith('python'):
+        return command
+    return None
+
+
+def _sifter_command(sifter, env, state_dir):
+    """
+    Returns the command that starts the sifter. Python scripts
+    without a .py extension get no cached bytecode and would be
+    compiled on every run, so they are compiled once into the state
+    directory, per interpreter and version of the script, and their
+    code run from there as though the script itself was run.
+    """
+    interpreter = _python_interpreter(sifter) if state_dir else None
+    if not interpreter:
+        return [sifter]
+    stats = os.stat(sifter)
+    key = hashlib.sha1('\0'.join([
+        ' '.join(interpreter), os.path.abspath(sifter),
+        repr(stats.st_mtime), str(stats.st_size),
+    ])).hexdigest()
+    bytecode = get_state_path(
+        os.path.join(state_dir, BYTECODE_DIR),
+        '{0}-{1}.code'.format(get_sifter_name(sifter), key[:16])
+    )
+    if not os.path.isfile(bytecode):
+        with open(os.devnull, 'w') as devnull:
+            ret_code = subprocess.call(
+                interpreter + ['-c', COMPILE_SCRIPT, sifter, bytecode],
+                stdout=devnull, stderr=devnull, env=env
+            )
+        if ret_code != 0:
+            # Leave it to the sifter to fail, or not, as it would have
+            log.warning('Could not precompile sifter %s, running it '
+                        'as is', sifter)
+            return [sifter]
+    return interpreter + ['-c', RUN_SCRIPT, bytecode, sifter]
+
+
+def _kill_sifter(sift):
+    """
+    Terminate the process group of a running sifter, escalating to
+    SIGKILL if it doesn't exit within the grace period.
+    """
+    for kill_signal in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(sift.pid, kill_signal)
+        except OSError:
+            # Group is already gone
+            break
+        deadline = time.time() + KILL_GRACE
+        while sift.poll() is None and time.time() < deadline:
+            time.sleep(POLL_INTERVAL[0])
+        if sift.returncode is not None:
+            break
+    sift.wait()
+
+
+def _dir_size(directory):
+    """
+    Total bytes of the files under the directory
+    """
+    size = 0
+    for path, _, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(path, filename))
+            except OSError:
+                # Removed while we were looking
+                pass
+    return size
+
 
+def _wait_for_sifter(sift, output_size, limits):
+    """
+    Wait for the sifter to finish, killing it and raising
+    SifterLimitException if it runs past its wall clock timeout
+    or writes more output, as measured by calling ``output_size``,
+    than it is allowed.
+    """
+    timeout = limits.get('timeout')
+    max_output = limits.get('max_output')
+    if not (timeout or max_output):
+        return sift.wait()
+
+    start = time.time()
+    interval = POLL_INTERVAL[0]
+    while sift.poll() is None:
+        violation = None
+        if timeout and time.time() - start > float(timeout):
+            violation = 'exceeded its timeout of {0} seconds'.format(timeout)
+        elif max_output and output_size() > int(max_output):
+            violation = 'exceeded its output limit of {0} bytes'.format(
+                max_output
+            )
+        if violation:
+            _kill_sifter(sift)
+            raise SifterLimitException(violation)
+        time.sleep(interval)
+        interval = min(interval * 2, POLL_INTERVAL[1])
+    return sift.returncode
+
+
+def _manifest_outputs(manifest_file, output_dir):
+    """
+    Read the filenames listed by a sifter's output manifest and
+    return them as (filename, path) pairs in its output directory.
+    """
+    outputs = []
+    for line in manifest_file:
+        filename = line.strip()
+        if not filename:
+            continue
+        path = os.path.normpath(os.path.join(output_dir, filename))
+        if (os.path.isabs(filename) or
+                not path.startswith(output_dir + os.sep) or
+                not os.path.isfile(path)):
+            raise SifterException(
+                'Sifter listed {0!r} in its output manifest, which is '
+                'not a file in its output directory'.format(filename)
+            )
+        outputs.append((filename, path))
+    return outputs
+
+
+class StderrTail(object):
+    """
+    Drains the standard error pipe of a sifter on a thread, logging
+    each line as it's written and keeping only the last ``size``
+    bytes, so a noisy sifter can't bloat its error message.
+    """
+
+    def __init__(self, pipe, sifter, size=STDERR_TAIL):
+        """
+        Start draining the pipe
+        """
+        self.sifter = sifter
+        self.size = size
+        self.truncated = False
+        self._chunks = collections.deque()
+        self._kept = 0
+        self._thread = threading.Thread(target=self._drain, args=(pipe,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self, pipe):
+        """
+        Read the pipe until it's closed
+        """
+        for chunk in iter(lambda: pipe.readline(STDERR_READ_SIZE), ''):
+            sifter_log.info('%s: %s', self.sifter, chunk.rstrip('\n'))
+            self._chunks.append(chunk)
+            self._kept += len(chunk)
+            while self._kept > self.size and len(self._chunks) > 1:
+                self._kept -= len(self._chunks.popleft())
+                self.truncated = True
+        pipe.close()
+
+    def tail(self, timeout=KILL_GRACE):
+        """
+        Wait for the sifter to close standard error, or at most
+        ``timeout`` seconds if something it started holds it open,
+        and return the kept end of it.
+        """
+        self._thread.join(timeout)
+        output = ''.join(list(self._chunks))[-self.size:]
+        if self.truncated:
+            output = '[earlier output truncated]\n' + output
+        return output
+
+
+class ProgressReader(object):
+    """
+    Reads the ``done/total`` lines a sifter writes to its progress
+    pipe on a thread and passes them on to the callback.
+    """
+
+    def __init__(self, pipe, sifter, callback):
+        """
+        Start reading the pipe
+        """
+        self.sifter = sifter
+        self.callback = callback
+        self._thread = threading.Thread(target=self._read, args=(pipe,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, pipe):
+        """
+        Read the pipe until it's closed, skipping malformed lines
+        """
+        for line in iter(lambda: pipe.readline(PROGRESS_LINE_SIZE), ''):
+            try:
+                done, total = [int(part) for part in line.split('/')]
+            except ValueError:
+                continue
+            try:
+                self.callback(done, total)
+            except Exception:  # pylint: disable=W0703
+                log.exception('Failed to report progress of %s', self.sifter)
+        pipe.close()
+
+    def close(self, timeout=KILL_GRACE):
+        """
+        Wait for the sifter to close the pipe, or at most ``timeout``
+        seconds if something it started holds it open.
+        """
+        self._thread.join(timeout)
+
+
+@contextlib.contextmanager
+def cancel_on_signal(signum=signal.SIGTERM):
+    """
+    Raise SifterCancelledException when the process gets the signal,
+    instead of dying, so a sifter being waited on has its process
+    group killed and its spooled output removed. Only the main thread
+    can handle signals, so elsewhere this does nothing.
+    """
+    def cancel(*_):
+        """
+        Interrupt the run
+        """
+        raise SifterCancelledException('The sifter run was cancelled')
+
+    try:
+        previous = signal.signal(signum, cancel)
+    except ValueError:
+        yield
+        return
+    try:
+        yield
+    finally:
+        signal.signal(signum, previous)
+
+
+def get_data_store(edx_platform, state_dir=None):
+    """
+    Returns the store reports are written to for the platform. When
+    a state directory is given, stored reports are recorded in the
+    report catalog kept there.
+    """
+    # The catalog is imported here since it depends on this module
+    from xsiftx.catalog import ReportCatalog
+    import xsiftx.store
+
+    settings = get_settings(edx_platform)
     if settings['use_s3']:
         data_store = xsiftx.store.S3Store(settings)
     else:
         data_store = xsiftx.store.FSStore(settings)
+    if state_dir:
+        data_store.catalog = ReportCatalog(state_dir)
+    return data_store
 
-    with tempfile.NamedTemporaryFile() as tmpfile:
-        with tempfile.NamedTemporaryFile() as stderr_tmp:
-            cmd = [
-                sifter,
-                venv,
-                edx_platform,
-                course,
-            ]
-            cmd.extend(extra_args)
-            sift = subprocess.Popen(cmd, stdout=tmpfile, stderr=stderr_tmp,
-                                    universal_newlines=True)
-            ret_code = sift.wait()
-            if ret_code != 0:
-                stderr_tmp.flush()
-                stderr_tmp.seek(0)
-                error_output = stderr_tmp.read()
-                raise SifterException(
-                    'Sifter {0} called with {1} failed '
-                    'with non zero exit code printing output '
-                    'and aborting\nError Output:\n{2}'.format(
-                        sifter, ' '.join(cmd), error_output
-                    )
+
+class SifterOutput(object):
+    """
+    Reports written by a sifter run for a course, spooled locally
+    until they are stored.
+    """
+
+    def __init__(self, course, spool, output_dir=None, sifter=None):
+        """
+        Take ownership of the spool file, positioned at the start of
+        the report after its first line, and the output directory.
+        """
+        self.course = course
+        self.sifter = sifter
+        self.spool = spool
+        self.output_dir = output_dir
+        self.filename = None
+        self.outputs = None
+        # Called once the reports are stored
+        self.on_stored = []
+        # Files stored along with the reports, like profiles
+        self.attachments = []
+        self._attachment_dirs = []
+        first_line = spool.readline()[:-1]
+        if first_line == OUTPUT_MANIFEST_MARKER:
+            self.outputs = _manifest_outputs(spool, output_dir)
+        else:
+            self.filename = first_line
+        position = spool.tell()
+        spool.seek(0, os.SEEK_END)
+        self.size = spool.tell()
+        spool.seek(position)
+        if output_dir:
+            self.size += _dir_size(output_dir)
+
+    def store(self, data_store):
+        """
+        Store the reports with the data store
+        """
+        if self.outputs is not None:
+            data_store.store_many(self.course,
+                                  self.outputs + self.attachments,
+                                  self.sifter)
+        else:
+            data_store.store(self.course, self.filename, self.spool,
+                             self.sifter)
+            if self.attachments:
+                data_store.store_many(self.course, self.attachments,
+                                      self.sifter)
+        for callback in self.on_stored:
+            callback()
+
+    def attach(self, outputs, directory):
+        """
+        Store the (filename, path) outputs in the directory along with
+        the reports, and remove the directory when closed.
+        """
+        self.attachments.extend(outputs)
+        self._attachment_dirs.append(directory)
+        self.size += sum(os.path.getsize(path) for _, path in outputs)
+
+    def close(self):
+        """
+        Remove the spooled reports
+        """
+        self.spool.close()
+        for directory in [self.output_dir] + self._attachment_dirs:
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def _sift_python(sifter, course, venv, edx_platform, extra_args, limits,
+                 since, progress, profile=False):
+    """
+    Run a Python sifter inside this process. The sifter is called
+    with the same arguments as an executable sifter, plus ``since``,
+    and returns or yields the filename followed by the report as
+    strings, or as rows that are written out as CSV.
+    """
+    # pylint: disable=R0913
+    from xsiftx.tools import progress_callback
+
+    with progress_callback(progress):
+        if not profile:
+            return _sift_python_output(sifter, course, venv, edx_platform,
+                                       extra_args, limits, since)
+        from xsiftx.profiling import Profiler, profile_outputs
+
+        profiler = Profiler()
+        with profiler:
+            output = _sift_python_output(sifter, course, venv, edx_platform,
+                                         extra_args, limits, since)
+        if output:
+            profile_dir = tempfile.mkdtemp(prefix='xsiftx')
+            profiler.save(profile_dir)
+            output.attach(
+                profile_outputs(profile_dir, get_sifter_name(sifter)),
+                profile_dir
+            )
+        return output
+
+
+def _sift_python_output(sifter, course, venv, edx_platform, extra_args,
+                        limits, since):
+    """
+    Collect the output of a Python sifter into a SifterOutput
+    """
+    # pylint: disable=R0913
+    if set(limits) - set(['max_output']):
+        log.warning('Only max_output applies to Python sifter %s, '
+                    'ignoring its other limits', sifter)
+    spool = tempfile.SpooledTemporaryFile(PYTHON_SPOOL_SIZE)
+    try:
+        output = iter(load_python_sifter(sifter)(
+            venv, edx_platform, course, extra_args, since=since
+        ) or [])
+        filename = next(output, None)
+        if filename is None:
+            spool.close()
+            return None
+        spool.write('{0}\n'.format(filename))
+        writer = csv.writer(spool)
+        for chunk in output:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            if isinstance(chunk, str):
+                spool.write(chunk)
+            else:
+                writer.writerow(chunk)
+            if (limits.get('max_output') and
+                    spool.tell() > int(limits['max_output'])):
+                raise SifterLimitException(
+                    'Sifter {0} for {1} exceeded its output limit of '
+                    '{2} bytes'.format(sifter, course, limits['max_output'])
                 )
+        spool.seek(0)
+        return SifterOutput(course, spool, sifter=get_sifter_name(sifter))
+    except (SifterException, XsiftxException):
+        spool.close()
+        raise
+    except Exception:  # pylint: disable=W0703
+        spool.close()
+        raise SifterException(
+            'Sifter {0} for {1} with arguments {2} failed and '
+            'aborted\nError Output:\n{3}'.format(
+                sifter, course, ' '.join(extra_args), traceback.format_exc()
+            )
+        )
+
+
+def _sifter_env(since, state_dir, output_dir):
+    """
+    Returns the environment to run an executable sifter in
+    """
+    import xsiftx.tools
+
+    env = dict(os.environ)
+    if since:
+        env['XSIFTX_SINCE'] = since
+    if state_dir:
+        env[xsiftx.tools.STATE_DIR_ENV] = os.path.expanduser(state_dir)
+    env['XSIFTX_OUTPUT_DIR'] = output_dir
+    return env
+
+
+def _run_executable(sifter, args, env, tmpfile, limits, state_dir,
+                    progress=None, stdin=None, profile_dir=None):
+    """
+    Run an executable sifter with the arguments after its path and
+    its standard out written to tmpfile, which is rewound once it has
+    finished. Python script sifters are profiled into profile_dir
+    when it's given. Raises SifterException if it fails, or
+    SifterLimitException if it runs past its limits.
+    """
+    # pylint: disable=R0913,R0914
+    import xsiftx.tools
+
+    output_dir = env['XSIFTX_OUTPUT_DIR']
+    cmd = [sifter] + args
+    progress_reader = None
+    try:
+        if progress:
+            # The sifter inherits the write end of the progress pipe
+            read_fd, write_fd = os.pipe()
+            fcntl.fcntl(read_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            progress_reader = ProgressReader(
+                os.fdopen(read_fd), get_sifter_name(sifter), progress
+            )
+            env[xsiftx.tools.PROGRESS_FD_ENV] = str(write_fd)
+        command = _sifter_command(sifter, env, state_dir)
+        if profile_dir:
+            interpreter = _python_interpreter(sifter)
+            if interpreter:
+                command = interpreter + ['-m', 'xsiftx.profiling',
+                                         profile_dir, sifter]
+            else:
+                log.warning('Only Python sifters can be profiled, running '
+                            '%s without profiling', sifter)
+        cpu_start = _children_cpu()
+        try:
+            sifter_proc = subprocess.Popen(
+                _ionice_prefix(limits) + command + cmd[1:],
+                stdin=stdin, stdout=tmpfile, stderr=subprocess.PIPE,
+                universal_newlines=True,
+                preexec_fn=_limit_preexec(limits),
+                env=env
+            )
+        finally:
+            if progress:
+                os.close(write_fd)
+        stderr_tail = StderrTail(sifter_proc.stderr, get_sifter_name(sifter))
+        output_size = lambda: (os.fstat(tmpfile.fileno()).st_size +
+                               _dir_size(output_dir))
+        try:
+            ret_code = _wait_for_sifter(sifter_proc, output_size, limits)
+        except SifterLimitException as err:
+            raise SifterLimitException(
+                'Sifter {0} called with {1} {2} and was '
+                'killed'.format(sifter, ' '.join(cmd), err)
+            )
+        finally:
+            # Never leave the sifter's process group behind us
+            if sifter_proc.returncode is None:
+                _kill_sifter(sifter_proc)
+            error_output = stderr_tail.tail()
+    finally:
+        if progress_reader:
+            progress_reader.close()
+
+    # The kernel sends SIGXCPU at the CPU limit and SIGKILL once past
+    # its grace, but SIGKILL may also come from the OOM killer or
+    # anyone else, so it only counts if the sifter used up its CPU
+    if limits.get('max_cpu') and (
+            ret_code == -signal.SIGXCPU or
+            (ret_code == -signal.SIGKILL and
+             _children_cpu() - cpu_start >= int(limits['max_cpu']))):
+        raise SifterLimitException(
+            'Sifter {0} called with {1} exceeded its CPU limit '
+            'of {2} seconds and was killed'.format(
+                sifter, ' '.join(cmd), limits['max_cpu']
+            )
+        )
+    if ret_code != 0:
+        raise SifterException(
+            'Sifter {0} called with {1} failed '
+            'with non zero exit code printing output '
+            'and aborting\nError Output:\n{2}'.format(
+                sifter, ' '.join(cmd), error_output
+            )
+        )
+
+    tmpfile.flush()
+    tmpfile.seek(0)
+    if (limits.get('max_output') and
+            output_size() > int(limits['max_output'])):
+        raise SifterLimitException(
+            'Sifter {0} called with {1} exceeded its output '
+            'limit of {2} bytes'.format(
+                sifter, ' '.join(cmd), limits['max_output']
+            )
+        )
+
+
+def sift(sifter, course, venv, edx_platform, extra_args, limits=None,
+         since=None, state_dir=None, progress=None, profile=False):
+    """
+    Run the sifter for the course and return a SifterOutput with
+    the reports it wrote, or None if it didn't write any. The
+    arguments are the same as for ``run_sifter``.
+    """
+    # pylint: disable=R0913
+    limits = limits or {}
+    if is_python_sifter(sifter):
+        return _sift_python(
+            sifter, course, venv, edx_platform, extra_args, limits, since,
+            progress, profile
+        )
+
+    output_dir = tempfile.mkdtemp(prefix='xsiftx')
+    env = _sifter_env(since, state_dir, output_dir)
+    tmpfile = tempfile.NamedTemporaryFile()
+    profile_dir = tempfile.mkdtemp(prefix='xsiftx') if profile else None
+    output = result = None
 
-            tmpfile.flush()
+    try:
+        _run_executable(sifter, [venv, edx_platform, course] + extra_args,
+                        env, tmpfile, limits, state_dir, progress,
+                        profile_dir=profile_dir)
+        if os.fstat(tmpfile.fileno()).st_size == 0:
+            pass
+        elif tmpfile.readline()[:-1] == BATCH_MANIFEST_MARKER:
+            # A batch sifter run on a single course
+            tmpfile.seek(0)
+            result = _batch_outputs(sifter, [course], tmpfile,
+                                    output_dir)[course]
+            if isinstance(result, SifterException):
+                raise result
+        else:
             tmpfile.seek(0)
-            if os.fstat(tmpfile.fileno()).st_size > 0:
-                filename = tmpfile.readline()[:-1]
-                data_store.store(course, filename, tmpfile)
+            result = output = SifterOutput(course, tmpfile, output_dir,
+                                           get_sifter_name(sifter))
+        if result and profile_dir:
+            from xsiftx.profiling import profile_outputs
+
+            result.attach(
+                profile_outputs(profile_dir, get_sifter_name(sifter)),
+                profile_dir
+            )
+            profile_dir = None
+        return result
+    finally:
+        if output is None:
+            tmpfile.close()
+            shutil.rmtree(output_dir, ignore_errors=True)
+        if profile_dir:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+
+def _batch_outputs(sifter, courses, manifest_file, output_dir):
+    """
+    Split the reports listed in a batch manifest into a SifterOutput
+    for each course, moving each course's output directory out of the
+    batch's. Returns them as for ``sift_batch``.
+    """
+    import xsiftx.tools
+
+    if manifest_file.readline()[:-1] != BATCH_MANIFEST_MARKER:
+        raise SifterException(
+            'Batch sifter {0} must print {1} as its first line'.format(
+                sifter, BATCH_MANIFEST_MARKER
+            )
+        )
+    filenames = collections.defaultdict(list)
+    for line in manifest_file:
+        if not line.strip():
+            continue
+        course, _, filename = line.rstrip('\n').partition('\t')
+        filenames[course].append(filename)
+    unknown = set(filenames) - set(courses)
+    if unknown:
+        log.warning('Batch sifter %s wrote reports for courses it was not '
+                    'given: %s', sifter, ', '.join(sorted(unknown)))
+
+    results = {}
+    for course in courses:
+        if not filenames[course]:
+            results[course] = None
+            continue
+        course_dir = tempfile.mkdtemp(prefix='xsiftx')
+        os.rmdir(course_dir)
+        spool = tempfile.SpooledTemporaryFile(PYTHON_SPOOL_SIZE)
+        spool.write('{0}\n{1}\n'.format(OUTPUT_MANIFEST_MARKER,
+                                        '\n'.join(filenames[course])))
+        spool.seek(0)
+        try:
+            try:
+                os.rename(xsiftx.tools.batch_output_dir(output_dir, course),
+                          course_dir)
+            except OSError:
+                raise SifterException(
+                    'Batch sifter {0} listed reports for {1} without '
+                    'writing its output directory'.format(sifter, course)
+                )
+            results[course] = SifterOutput(course, spool, course_dir,
+                                           get_sifter_name(sifter))
+        except SifterException as err:
+            spool.close()
+            shutil.rmtree(course_dir, ignore_errors=True)
+            results[course] = err
+    return results
+
+
+def sift_batch(sifter, courses, venv, edx_platform, extra_args,
+               limits=None, since=None, state_dir=None):
+    """
+    Run a sifter whose manifest declares ``batch`` once for all the
+    courses, which it's given one per line on standard in, instead
+    of the course ID argument. Returns a dictionary of each course to
+    a SifterOutput with its reports, None if it has none, or the
+    SifterException raised reading them. The sifter failing or going
+    over its limits raises for the whole batch.
+    """
+    # pylint: disable=R0913
+    import xsiftx.tools
+
+    limits = limits or {}
+    output_dir = tempfile.mkdtemp(prefix='xsiftx')
+    env = _sifter_env(since, state_dir, output_dir)
+    tmpfile = tempfile.NamedTemporaryFile()
+    course_list = tempfile.TemporaryFile()
+    try:
+        course_list.write(''.join('{0}\n'.format(course)
+                                  for course in courses))
+        course_list.seek(0)
+        _run_executable(
+            sifter,
+            [venv, edx_platform, xsiftx.tools.BATCH_COURSE_ARG] + extra_args,
+            env, tmpfile, limits, state_dir, stdin=course_list
+        )
+        return _batch_outputs(sifter, courses, tmpfile, output_dir)
+    finally:
+        course_list.close()
+        tmpfile.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def run_sifter(sifter, course, venv, edx_platform, extra_args, limits=None,
+               since=None, state_dir=None, progress=None, profile=False):
+    """
+    This handles running the actual sifter given a course
+    and sifter. ``limits`` is an optional dictionary of
+    ``SIFTER_LIMITS`` to apply to the run, and ``since`` an optional
+    ISO 8601 time of the last run passed on as XSIFTX_SINCE for
+    sifters that can work incrementally. When ``state_dir`` is given,
+    reports are cataloged, kept for delta reports and Python script
+    sifters precompiled there.
+    ``progress`` is called with (done, total) as the sifter reports
+    its progress. With ``profile``, Python sifters are profiled and
+    the profile stored next to the report.
+    """
+    # pylint: disable=R0913
+    # Delta reports are imported here since they depend on this module
+    from xsiftx.delta import delta_output
+
+    data_store = get_data_store(edx_platform, state_dir)
+    output = delta_output(
+        sift(sifter, course, venv, edx_platform, extra_args, limits, since,
+             state_dir, progress, profile),
+        sifter, extra_args, state_dir
+    )
+    if output:
+        try:
+            output.store(data_store)
+        finally:
+            output.close()
+            data_store.close()